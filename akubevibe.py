@@ -0,0 +1,500 @@
+# KubeVibe
+# asyncio FSM engine: many runs on one event loop
+#
+# Mirrors tvibe/execute_stage from kubevibeZ.py with async stage handlers.
+# External tools run as asyncio subprocesses (with cwd instead of chdir) and
+# LLM requests go through llm.arequest, so a run waiting on docker, kubectl
+# or the model does not hold a thread.
+
+import os
+import sys
+import time
+import yaml
+import json
+import asyncio
+import datetime
+import traceback
+import fsmStages as fsm
+from log import log, inlog
+import log as runlog
+from ctl import *
+from parameters import CONTEXT
+import llm
+from llm import extractanswer
+from generate import generation_request
+from build import save_artifacts, build_plan, build_image, probe_commands, content_tag
+import build
+import delivery
+import buildcache
+import dockerapi
+from chart import write_chart, CHART_CMDS
+from check import check
+import fix
+import fixmemo
+from history import History
+from intent import get_intent
+from connect import service_targets, candidate_ports, probe, probe_report
+import kube
+import nspool
+import openapi
+from validate import use_openapi
+from kubevibeZ import node, store_artifacts, write_manifest, refresh_manifest, imageRep, fixfromzero, mergedeployconnect
+
+async def arun(cmd, cwd=None, stdin=None):
+    # Shell command as an asyncio subprocess, returns (returncode, output)
+    p = await asyncio.create_subprocess_shell(cmd, cwd=cwd, stdin=asyncio.subprocess.PIPE if stdin else None,
+                                              stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+    try:
+        out, _ = await p.communicate(stdin.encode() if stdin else None)
+    except asyncio.CancelledError:
+        if p.returncode is None:
+            p.kill()
+            await p.wait()
+        raise
+    return p.returncode, out.decode()
+
+def rawlog(D):
+    return os.path.join(D["outputfolder"], D["logfile"])
+
+async def ahandle_generate(D):
+    t0 = time.time()
+    data = generation_request(D["model"], D["intent"], CONTEXT["generate"])
+    ans = extractanswer(await llm.arequest(data, data["format"], rawlog(D), "artifact-generation", 300, None, "generate"))
+    success = store_artifacts(D, ans)
+    return time.time() - t0, ans, success, ""
+
+async def ahandle_build(D):
+    t0 = time.time()
+    success = 1
+    outputfolder = D["outputfolder"]
+    summ = ""
+    datet = datetime.datetime.now()
+
+    d = None
+    try:
+        d = list(yaml.safe_load_all(D["node"]["manifest"]["content"]))
+    except yaml.YAMLError:
+        success = 0
+
+    cf = D["node"]["container"].get("content")
+    pf = D["node"]["code"].get("content")
+    rqs = D["node"]["requirements"].get("content")
+    tag = content_tag(cf, pf, rqs)
+    ref = delivery.image_ref(tag, imageRep)
+
+    events = []
+    if cf and pf:
+        saving = save_artifacts(outputfolder, cf, pf, rqs)
+        need, cmds = True, delivery.deliver_commands(ref)
+        # latest is mutable, it is always rebuilt
+        if build.skipUnchanged and tag != "latest" and ref in build.delivered:
+            need, cmds = False, []
+        elif build.skipUnchanged and tag != "latest":
+            localcmd, remotecmd = probe_commands(imageRep, tag)
+            local = (await arun(localcmd))[0] == 0
+            remote = local and remotecmd is not None and (await arun(remotecmd))[0] == 0
+            need, cmds = build_plan(imageRep, tag, local, remote)
+        if not need and not cmds:
+            summ += inlog(f"{ref} already built and delivered ({delivery.strategy}), build skipped\n", "build")
+        await asyncio.wait([asyncio.wrap_future(saving)])
+        build.saved(saving, rawlog(D))
+        if need:
+            # Socket or pipe I/O for the whole build: a worker thread
+            ok, events, out = await asyncio.to_thread(build_image, cf, pf, rqs, imageRep, tag)
+            summ += inlog(out, "build")
+            summ += inlog(buildcache.cache_report(buildcache.cache_stats(out)), "build:cache")
+            if not ok:
+                success = 0
+                cmds = []
+        for cmd in cmds:
+            rc, out = await arun(cmd)
+            summ += inlog(out, "build")
+            if rc != 0:
+                success = 0
+                break
+        if success:
+            build.delivered.add(ref)
+        log(rawlog(D), summ, "phase", datet)
+
+    write_manifest(D, d, tag)
+    return time.time() - t0, {"image": ref, "cache": buildcache.cache_stats(summ), "build": dockerapi.summary(events, t0)}, success, summ
+
+async def ahandle_check(D):
+    # Pure Python on strings, milliseconds: runs on the loop
+    t0 = time.time()
+    ok, issues, out = check(D, imageRep)
+    log(rawlog(D), out, "check")
+    return time.time() - t0, issues, int(ok), inlog(out, "check")
+
+async def ahandle_validate(D):
+    t0 = time.time()
+    vibefile = os.path.join(D["outputfolder"], D["node"]["manifest"]["file"])
+    errors = []
+    if use_openapi():
+        # In process, a few ms: not worth a thread
+        errors = openapi.validate_file(vibefile)
+        rc, out = int(bool(errors)), openapi.report(errors, D["node"]["manifest"]["file"])
+    else:
+        rc, out = await arun(f"kubectl create --dry-run=client -f {vibefile}")
+    log(rawlog(D), out, "validate")
+    return time.time() - t0, errors, int(rc == 0), inlog(out, "validate")
+
+async def kube_op(fn, args, cmd, stdin=None):
+    # With the API client, fn(*args) runs on a worker thread (it blocks on
+    # its connection); with kubectl, cmd runs as an asyncio subprocess
+    if kube.api():
+        return await asyncio.to_thread(fn, *args)
+    return await arun(cmd, stdin=stdin)
+
+async def create_namespace(D, stage):
+    # Returns (returncode, output, namespace used)
+    ns = kube.stage_namespace(D, stage)
+    labels, annotations = kube.run_metadata(D, stage)
+    if nspool.enabled or kube.api():
+        return await asyncio.to_thread(nspool.acquire, ns, labels, annotations)
+    rc, out = await arun("kubectl create -f -", stdin=kube.namespace_manifest(ns, labels, annotations))
+    return rc, out, ns
+
+async def create_manifest(D, stage, ns, vfile):
+    labels, annotations = kube.run_metadata(D, stage)
+    return await kube_op(kube.create_manifest, (ns, vfile, labels), f"kubectl -n {ns} create -f -",
+                         kube.labeled_manifest(vfile, labels))
+
+def delete_namespace(ns):
+    # Hands the namespace to the reaper (or back to the pool), nothing to
+    # await and nothing a cancellation could interrupt
+    return nspool.release(ns)
+
+async def await_ready(ns, bound=None, tick=1.0):
+    # kube.wait_ready on the event loop: the pod watch is an asyncio
+    # subprocess and each wake-up re-reads the namespace snapshot
+    bound = kube.readyTimeout if bound is None else bound
+    if kube.api():
+        return await asyncio.to_thread(kube.wait_ready, ns, bound, tick)
+    deadline = time.time() + bound
+    watch = await asyncio.create_subprocess_exec("kubectl", "-n", ns, "get", "pods", "--watch", "-o", "name",
+                                                 stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+    alive = True
+    try:
+        while True:
+            rc, out = await arun(f"kubectl -n {ns} {kube.READY_QUERY} -o json 2>/dev/null")
+            try:
+                doc = json.loads(out) if rc == 0 else None
+            except json.JSONDecodeError:
+                doc = None
+            state, reason = kube.readiness(doc)
+            if state != "waiting":
+                return state == "ready", reason
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False, f"not ready after {bound:g} s: {reason}"
+            if not alive:
+                await asyncio.sleep(min(tick, remaining))
+                continue
+            try:
+                alive = bool(await asyncio.wait_for(watch.stdout.read(4096), min(tick, remaining)))
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        if watch.returncode is None:
+            watch.kill()
+        await watch.wait()
+
+async def ahandle_deploy(D):
+    t0 = time.time()
+    vfile = os.path.join(D["outputfolder"], D["node"]["manifest"]["file"])
+    ok = True
+    summ = ""
+
+    keep = False
+    rc, out, ns = await create_namespace(D, "deploy")
+    summ += inlog(out, "deploy:namespace")
+    ok = ok and rc == 0
+    try:
+        rc, out = await create_manifest(D, "deploy", ns, vfile)
+        summ += inlog(out, "deploy:create")
+        ok = ok and rc == 0
+        # Merged round-trip: CONNECT probes this deployment and tears it down
+        keep = ok and mergedeployconnect
+    finally:
+        if not keep:
+            rc, out = delete_namespace(ns)
+            summ += inlog(out, "deploy:delete")
+    if keep:
+        D["live"] = ns
+
+    log(rawlog(D), summ, "phase")
+    return time.time() - t0, "", int(ok), summ
+
+async def ahandle_connect(D):
+    t0 = time.time()
+    live = D.pop("live", None)
+    ns = live
+    vfile = os.path.join(D["outputfolder"], D["node"]["manifest"]["file"])
+    ok = True
+    endpoint = None
+    summ = ""
+
+    if not live:
+        rc, out, ns = await create_namespace(D, "connect")
+        summ += inlog(out, "connect:namespace")
+        ok = ok and rc == 0
+    try:
+        if not live:
+            rc, out = await create_manifest(D, "connect", ns, vfile)
+            summ += inlog(out, "connect:create")
+            ok = ok and rc == 0
+
+        if kube.api():
+            targets = service_targets(await asyncio.to_thread(kube.get_services, ns))
+        else:
+            rc, out = await arun(f"kubectl -n {ns} get svc -o json 2>/dev/null")
+            try:
+                targets = service_targets(json.loads(out)) if rc == 0 else {}
+            except json.JSONDecodeError:
+                targets = {}
+        summ += inlog(json.dumps(targets) + "\n", "connect:svc")
+        if not targets:
+            ok = False
+        else:
+            ready, reason = await await_ready(ns)
+            summ += inlog(reason + "\n", "connect:ready")
+            ok = ok and ready
+        if ok:
+            # Probes are short and bounded by PROBE_TIMEOUT, a worker thread is fine
+            endpoint = await asyncio.to_thread(probe, targets, candidate_ports(vfile, targets))
+            summ += inlog(probe_report(endpoint), "connect:probe")
+            ok = endpoint["endpoint"] is not None
+    finally:
+        rc, out = delete_namespace(ns)
+        summ += inlog(out, "connect:delete")
+
+    log(rawlog(D), summ, "phase")
+    return time.time() - t0, endpoint, int(ok), summ
+
+async def ahandle_chart(D):
+    t0 = time.time()
+    chartdir = write_chart(D["outputfolder"], D["intent"])
+    success = 1
+    for cmd in CHART_CMDS:
+        rc, out = await arun(cmd, cwd=chartdir)
+        log(rawlog(D), out, "postprocess:*")
+        if rc != 0:
+            success = 0
+            break
+    return time.time() - t0, "genchart-0.1.0.tgz", success, ""
+
+async def ahandle_fix(D):
+    t0 = time.time()
+    fixes, plan = fix.plan_fix(D, rawlog(D))
+    if plan:
+        # Candidates concurrently; screening them is milliseconds, on the loop
+        answers = await asyncio.gather(*[llm.arequest(data, data["format"], rawlog(D), "fix", 300, None, "fix") for data in plan["requests"]])
+        fixes = fix.choose_fix(D, plan, answers, rawlog(D))
+        if fixes is None:
+            data = plan["rewrite"]
+            fixes = fix.rewrite_fix(D, plan, await llm.arequest(data, data["format"], rawlog(D), "fix", 300, None, "fix"))
+    for key in fixes:
+        D["node"][key]["content"] = fixes[key]["json2"]
+    D["rev"] += 1
+    D["fixed"] = sorted(fixes)
+    if "manifest" in fixes:
+        refresh_manifest(D)
+    return time.time() - t0, fixes, 1, ""
+
+AHANDLERS = {
+    "GENERATE": ahandle_generate,
+    "CHECK": ahandle_check,
+    "BUILD": ahandle_build,
+    "VALIDATE": ahandle_validate,
+    "DEPLOY": ahandle_deploy,
+    "CONNECT": ahandle_connect,
+    "CHART": ahandle_chart,
+    "FIX": ahandle_fix
+}
+
+async def aexecute_stage(stage, D):
+    tag = D.get("runid") or "-"
+    print(f"[{tag}] {colorise('green', stage.lower())}")
+    runlog.phase(rawlog(D), stage)
+    runlog.state(rawlog(D), D)
+
+    digest = fsm.digest(D["node"], stage) if stage in fsm.CACHEABLE and fsm.reentryfix else None
+    if digest and D.setdefault("passed", {}).get(stage) == digest:
+        # Passed before with byte-identical inputs: reuse the result
+        log(rawlog(D), f"{stage} inputs unchanged, result reused", "phase")
+        if stage == "BUILD":
+            refresh_manifest(D)
+        tm, ans, success, logs = 0, "reused", 1, ""
+    else:
+        tm, ans, success, logs = await AHANDLERS[stage](D)
+    # Logs of the last stage that ran, for FIX
+    if stage != "FIX":
+        D["node"]["logs"] = logs
+        fixmemo.settle(D, stage, success)
+    if digest and success:
+        D["passed"][stage] = digest
+
+    D["node"]["stage"] = stage
+    D["node"]["result"] = success
+    return tm, D["node"], success
+
+async def atvibe(D, timeout=None, tries=None):
+    # Same transitions as tvibe. The deadline is enforced by the caller
+    # (arun_prompt) through cancellation, timeout here only stops between steps.
+    history = History(os.path.join(D["outputfolder"], "history"))
+    trace = []
+    it = 0
+    fcount = 0
+    t0 = time.time()
+
+    current = node("", "", "", "", 0)
+    stage = "GENERATE"
+    D["failed"] = None
+    D["fixed"] = None
+    D["noops"] = 0
+
+    while True:
+        history.append(current)
+        D["node"] = current.copy()
+
+        if stage in ("SUCCESS", "FAIL"):
+            break
+
+        tm, new_current, success = await aexecute_stage(stage, D)
+        success = bool(success)
+        new_current["step"] = it
+
+        if fcount >= 10:
+            stage = "FAIL"
+            break
+
+        changed = fsm.effective(D["failed"], D["fixed"]) if stage == "FIX" and success else None
+        if changed is not None:
+            D["noops"] = 0 if changed else D["noops"] + 1
+        next_stage = fsm.next_stage(stage, success, fixfromzero, changed, D["failed"], D["noops"])
+        fcount = 0 if success and changed != [] else fcount + 1
+        if next_stage == "FIX" and stage != "FIX":
+            D["failed"] = stage
+        elif next_stage == "GENERATE":
+            D["noops"] = 0
+
+        trace.append({"step": it+1, "from": stage, "result": success, "to": next_stage})
+
+        stage = next_stage
+        current = new_current
+        it += 1
+
+        if timeout and ((time.time() - t0) > timeout):
+            break
+        if tries and (it > tries):
+            break
+
+    log(rawlog(D), json.dumps(history.stats()), "history")
+    return time.time() - t0, current, history, trace, stage == "SUCCESS"
+
+async def arun_prompt(entry, model, batchfolder, deadline=None, tries=None, intentmethod="none"):
+    runid = kube.run_id()
+    model = entry.get("model", model)
+    outputfolder = os.path.join(batchfolder, f"{entry['id']}_{runid}_output")
+    os.makedirs(outputfolder, exist_ok=True)
+    logfile = "kubevibe.rawlog"
+    runlog.start(os.path.join(outputfolder, logfile))
+
+    intent = entry["prompt"]
+    if intentmethod != "none":
+        # Curation is a short sequence of blocking LLM calls, keep it off the loop
+        try:
+            tm, intent, intent_success = await asyncio.to_thread(get_intent, intent, model, intentmethod, outputfolder, os.path.join(outputfolder, logfile))
+        except Exception as e:
+            log(os.path.join(outputfolder, logfile), f"{type(e).__name__}: {e}", "error")
+            tm, intent_success = 0, False
+        if not intent_success:
+            runlog.close(os.path.join(outputfolder, logfile))
+            return {"id": entry["id"], "prompt": entry["prompt"], "model": model, "runid": runid,
+                    "outputfolder": outputfolder, "ok": False, "time": tm, "steps": 0, "stage": "INTENT"}
+
+    D = {
+        "intent": intent,
+        "node": node("", "", "", "", 0),
+        "outputfolder": outputfolder,
+        "logfile": logfile,
+        "rev": 1,
+        "model": model,
+        "runid": runid,
+        "namespaces": kube.namespaces(runid)
+    }
+    summary = {"id": entry["id"], "prompt": entry["prompt"], "model": model, "runid": runid,
+               "outputfolder": outputfolder, "ok": False, "time": 0, "steps": 0, "stage": None}
+
+    t0 = time.time()
+    trace = []
+    try:
+        tt, current, history, trace, ok = await asyncio.wait_for(atvibe(D, None, tries), deadline)
+        summary["ok"] = ok
+        summary["stage"] = trace[-1]["to"] if trace else None
+    except asyncio.TimeoutError:
+        summary["stage"] = "DEADLINE"
+    except Exception as e:
+        # One broken run (an unreachable endpoint...) must not end the batch
+        summary["stage"] = "ERROR"
+        summary["error"] = f"{type(e).__name__}: {e}"
+        log(os.path.join(outputfolder, logfile), traceback.format_exc(), "error")
+    finally:
+        if D.get("live"):
+            delete_namespace(D.pop("live"))
+        rc, out = await asyncio.shield(kube_op(kube.cleanup_run, (runid,), f"kubectl {kube.cleanup_args(runid)}"))
+        log(os.path.join(outputfolder, logfile), out, "cleanup")
+    summary["time"] = time.time() - t0
+    summary["steps"] = len(trace)
+    log(os.path.join(outputfolder, logfile), f"Process finished in {summary['time']} seconds with result {summary['ok']}")
+    runlog.close(os.path.join(outputfolder, logfile))
+    return summary
+
+async def arun_many(prompts, model, batchfolder, concurrency=16, deadline=None, tries=None, intentmethod="none"):
+    # Runs every prompt with at most concurrency FSMs in flight. Summaries
+    # are appended to summary.jsonl as runs finish.
+    os.makedirs(batchfolder, exist_ok=True)
+    summaryfile = os.path.join(batchfolder, "summary.jsonl")
+    slots = asyncio.Semaphore(concurrency)
+    results = []
+
+    async def one(entry):
+        async with slots:
+            return await arun_prompt(entry, model, batchfolder, deadline, tries, intentmethod)
+
+    for fut in asyncio.as_completed([one(entry) for entry in prompts]):
+        summary = await fut
+        results.append(summary)
+        f = open(summaryfile, "a")
+        print(json.dumps(summary), file=f)
+        f.close()
+        mark = colorise("green", "ok") if summary["ok"] else colorise("red", summary["stage"] or "fail")
+        print(f"[{len(results)}/{len(prompts)}] {summary['id']} {mark} {summary['time']:.1f} s")
+    return results
+
+if __name__ == "__main__":
+    from batch import read_prompts
+
+    if len(sys.argv) != 2:
+        print("Usage: akubevibe.py <prompts.txt|prompts.jsonl>")
+        sys.exit(1)
+
+    model = os.getenv("MODEL", "deepseek-r1:32b")
+    concurrency = int(os.getenv("CONCURRENCY", "16"))
+    envdeadline = os.getenv("TIMEOUT")
+    envtries = os.getenv("N")
+    intentmethod = os.getenv("INTENT_METHOD", "none")
+
+    prompts = read_prompts(sys.argv[1])
+    date_str = datetime.datetime.now().strftime("%d-%m-%Y_%H_%M_%S")
+    batchfolder = f"myto/{model}/{date_str}_abatch"
+
+    print(f"Running {len(prompts)} prompts, {concurrency} at a time, into {colorise('violet', batchfolder)}")
+    kube.sweep_orphans()
+    nspool.warmup()
+    t0 = time.time()
+    results = asyncio.run(arun_many(prompts, model, batchfolder, concurrency,
+                                    float(envdeadline) if envdeadline else None, int(envtries) if envtries else None, intentmethod))
+    okcount = sum(1 for r in results if r["ok"])
+    print(f"Finished in {time.time() - t0:.1f} seconds: {okcount}/{len(results)} succeeded")
@@ -0,0 +1,117 @@
+# KubeVibe
+# Batch runner: many prompts through tvibe on a process pool
+
+import os
+import sys
+import json
+import time
+import kube
+import datetime
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from ctl import *
+
+def read_prompts(path):
+    # Plain text: one prompt per line ('#' starts a comment).
+    # JSONL: one object per line with "prompt" and optionally "id" and "model".
+    prompts = []
+    f = open(path)
+    for n, line in enumerate(f):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        if line.startswith("{"):
+            entry = json.loads(line)
+        else:
+            entry = {"prompt": line}
+        entry.setdefault("id", str(len(prompts)))
+        entry["line"] = n + 1
+        prompts.append(entry)
+    f.close()
+    return prompts
+
+def run_one(entry, model, batchfolder, intentmethod, validationmethod, timeout, tries, do_graph):
+    # Executed in a worker process. Console output goes to the run folder so
+    # concurrent runs do not interleave on the terminal.
+    from kubevibeZ import run
+
+    runid = kube.run_id()
+    model = entry.get("model", model)
+    outputfolder = os.path.join(batchfolder, f"{entry['id']}_{runid}_output")
+    os.makedirs(outputfolder, exist_ok=True)
+
+    t0 = time.time()
+    with open(os.path.join(outputfolder, "console.log"), "w") as out:
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(out):
+            try:
+                summary = run(entry["prompt"], model, outputfolder, intentmethod, validationmethod, timeout, tries, do_graph, runid)
+            except Exception as e:
+                summary = {
+                    "prompt": entry["prompt"],
+                    "model": model,
+                    "runid": runid,
+                    "outputfolder": outputfolder,
+                    "ok": False,
+                    "time": time.time() - t0,
+                    "steps": 0,
+                    "stage": "ERROR",
+                    "error": f"{type(e).__name__}: {e}"
+                }
+    summary["id"] = entry["id"]
+    return summary
+
+def run_batch(prompts, model, batchfolder, workers=4, intentmethod="none", validationmethod="none", timeout=None, tries=None, do_graph=False):
+    os.makedirs(batchfolder, exist_ok=True)
+    summaryfile = os.path.join(batchfolder, "summary.jsonl")
+    results = []
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(run_one, entry, model, batchfolder, intentmethod, validationmethod, timeout, tries, do_graph): entry
+            for entry in prompts
+        }
+        for fut in as_completed(futures):
+            entry = futures[fut]
+            try:
+                summary = fut.result()
+            except Exception as e:
+                summary = {"id": entry["id"], "prompt": entry["prompt"], "ok": False, "stage": "ERROR", "error": f"{type(e).__name__}: {e}"}
+            results.append(summary)
+
+            # One line per finished run, flushed so the file can be tailed
+            f = open(summaryfile, "a")
+            print(json.dumps(summary), file=f)
+            f.close()
+
+            mark = colorise("green", "ok") if summary["ok"] else colorise("red", summary.get("stage") or "fail")
+            print(f"[{len(results)}/{len(prompts)}] {summary['id']} {mark} {summary.get('time', 0):.1f} s")
+
+    return results
+
+if __name__ == "__main__":
+
+    if len(sys.argv) != 2:
+        print("Usage: batch.py <prompts.txt|prompts.jsonl>")
+        sys.exit(1)
+
+    model = os.getenv("MODEL", "deepseek-r1:32b")
+    workers = int(os.getenv("WORKERS", "4"))
+    intentmethod = os.getenv("INTENT_METHOD", "none")
+    validationmethod = os.getenv("IVAL_METHOD", "none")
+    envtimeout = os.getenv("TIMEOUT")
+    envtries = os.getenv("N")
+    do_graph = bool(int(os.getenv("GRAPH", "0")))
+
+    prompts = read_prompts(sys.argv[1])
+
+    date_str = datetime.datetime.now().strftime("%d-%m-%Y_%H_%M_%S")
+    batchfolder = f"myto/{model}/{date_str}_batch"
+
+    print(f"Running {len(prompts)} prompts with {workers} workers into {colorise('violet', batchfolder)}")
+
+    kube.sweep_orphans()
+    t0 = time.time()
+    results = run_batch(prompts, model, batchfolder, workers, intentmethod, validationmethod,
+                        int(envtimeout) if envtimeout else None, int(envtries) if envtries else None, do_graph)
+    okcount = sum(1 for r in results if r["ok"])
+    print(f"Batch finished in {time.time() - t0:.1f} seconds: {okcount}/{len(results)} succeeded")
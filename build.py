@@ -1,10 +1,22 @@
 # KubeVibe
 # Stage 2 - Build
 import os
+import hashlib
 import subprocess
 import yaml
+import time
 import datetime
+from concurrent.futures import ThreadPoolExecutor
 from log import log, inlog
+import delivery
+import buildcache
+import dockerapi
+
+# Skip building and pushing images that already exist for the same artifacts
+skipUnchanged = bool(int(os.getenv("BUILD_SKIP_UNCHANGED", "1")))
+
+# Images built and pushed by this process
+delivered = set()
 
 def smartyamldump(d):
     if type(d) == str or type(d) == dict or d is None:
@@ -14,52 +26,148 @@ def smartyamldump(d):
     else:
         raise Exception("YAML format unknown")
 
-def preprocess(outputfolder, cf, pf, rqs, rawlogfile, imageRep = "satt70"):
-    pycode = os.path.join(outputfolder, "myapp.py")
-    containerfile = os.path.join(outputfolder, "Dockerfile")
-    requirements = os.path.join(outputfolder, "requirements.txt")
-
+def image_name(image):
+    # Repository of an image reference, without tag or digest
+    image = image.split("@", 1)[0]
+    head, _, last = image.rpartition("/")
+    return f"{head}/{last.split(':', 1)[0]}" if head else last.split(":", 1)[0]
+
+def retag(docs, repository, tag, policy=None):
+    # Points every container image named like repository (whatever registry
+    # the manifest wrote, e.g. satt70/myapp or localhost:32000/myapp) at
+    # repository:tag, with imagePullPolicy set to policy if given
+    name = image_name(repository).rsplit("/", 1)[-1]
+    for doc in docs:
+        if not isinstance(doc, dict):
+            continue
+        spec = doc.get("spec") or {}
+        if doc.get("kind") in ("Deployment", "StatefulSet", "DaemonSet", "ReplicaSet", "Job"):
+            spec = ((spec.get("template") or {}).get("spec")) or {}
+        for container in (spec.get("containers") or []) + (spec.get("initContainers") or []):
+            image = container.get("image") if isinstance(container, dict) else None
+            if image and image_name(image).rsplit("/", 1)[-1] == name:
+                container["image"] = f"{repository}:{tag}"
+                if policy:
+                    container["imagePullPolicy"] = policy
+    return docs
+
+def context_files(cf, pf, rqs):
+    # Build context, as written to the output folder
+    files = {"myapp.py": pf, "Dockerfile": cf, "requirements.txt": rqs or ""}
+    # The Dockerfile actually built when BuildKit caching is on
+    if buildcache.buildkit:
+        files[buildcache.DOCKERFILE] = buildcache.adapt_dockerfile(cf)
+    return files
+
+def write_artifacts(outputfolder, cf, pf, rqs):
+    for name, content in context_files(cf, pf, rqs).items():
+        f = open(os.path.join(outputfolder, name), "w")
+        f.write(content or "")
+        f.close()
+
+# Artifacts are written for reproducibility only, the build does not read
+# them: one writer thread keeps that off the hot path and in order
+writer = ThreadPoolExecutor(max_workers=1)
+
+def save_artifacts(outputfolder, cf, pf, rqs):
+    # Returns the future of the write, for saved()
+    return writer.submit(write_artifacts, outputfolder, cf, pf, rqs)
+
+def saved(future, rawlogfile):
+    # Waits for save_artifacts. A failed write is logged, not raised: the
+    # build goes on without the files.
+    try:
+        future.result()
+    except OSError as e:
+        log(rawlogfile, f"could not write the artifacts: {e}", "build")
+
+def content_tag(cf, pf, rqs):
+    # Same Dockerfile, code and requirements, same image: the tag is a hash
+    # of the three, so it is immutable and shared by runs that agree
+    h = hashlib.sha256()
+    for part in (cf, pf, rqs):
+        data = (part or "").encode()
+        h.update(f"{len(data)}:".encode() + data)
+    return h.hexdigest()[:16]
+
+def probe_commands(imageRep = None, tag = "latest"):
+    # Image present locally, image present where the cluster takes it from
+    # (None: cannot tell, deliver again)
+    ref = delivery.image_ref(tag, imageRep)
+    return [f"docker image inspect {ref}", delivery.present_command(ref)]
+
+def build_plan(imageRep, tag, local, remote):
+    # (build needed, delivery commands to run) when the image already exists
+    # locally and/or on the cluster side
+    deliver = delivery.deliver_commands(delivery.image_ref(tag, imageRep))
+    if not local:
+        return True, deliver
+    return False, [] if remote else deliver
+
+def build_image(cf, pf, rqs, imageRep = None, tag = "latest", on_event = None):
+    # Builds from an in-memory context, tagged myapp:<tag> and the delivered
+    # reference. Returns (ok, events, output text).
+    files = context_files(cf, pf, rqs)
+    tags = [f"myapp:{tag}", delivery.image_ref(tag, imageRep)]
+    if dockerapi.use_api(buildcache.buildkit):
+        # Classic builder: the generated Dockerfile as is
+        files.pop(buildcache.DOCKERFILE, None)
+        return dockerapi.api_build(dockerapi.build_context(files), tags, "Dockerfile", on_event)
+    dockerfile = buildcache.DOCKERFILE if buildcache.buildkit else "Dockerfile"
+    env = {"DOCKER_BUILDKIT": "1" if buildcache.buildkit else "0"}
+    return dockerapi.cli_build(dockerapi.build_context(files), tags, dockerfile, on_event, env, buildcache.build_flags())
+
+def quiet(cmd):
+    return subprocess.run(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode
+
+def preprocess(outputfolder, cf, pf, rqs, rawlogfile, imageRep = None, tag = "latest"):
+    # Returns (ok, logs, build summary: steps, image id, errors)
     summ = ""
     datet = datetime.datetime.now()
+    t0 = time.time()
 
-    f = open(pycode, "w")
-    f.write(pf)
-    f.close()
-
-    f = open(containerfile, "w")
-    f.write(cf)
-    f.close()
-
-    f = open(requirements, "w")
-    f.write(rqs)
-    f.close()
+    saving = save_artifacts(outputfolder, cf, pf, rqs)
 
     # Fixup: increase chances by adding empty requirements
     # Update: it still seems to be required to mention it on the prompt 
     #f = open(os.path.join(outputfolder, "requirements.txt"), "w")
     #f.close()
 
-    cmds = ["docker build -t myapp .",
-            f"docker tag myapp:latest {imageRep}/myapp:latest",
-            f"docker push {imageRep}/myapp:latest"]
-
-    origdir = os.getcwd()
-    os.chdir(outputfolder)
-
+    ref = delivery.image_ref(tag, imageRep)
+    need, cmds = True, delivery.deliver_commands(ref)
+    # latest is mutable, it is always rebuilt
+    if skipUnchanged and tag != "latest" and ref in delivered:
+        need, cmds = False, []
+    elif skipUnchanged and tag != "latest":
+        localcmd, remotecmd = probe_commands(imageRep, tag)
+        local = quiet(localcmd) == 0
+        remote = local and remotecmd is not None and quiet(remotecmd) == 0
+        need, cmds = build_plan(imageRep, tag, local, remote)
+    if not need and not cmds:
+        summ += inlog(f"{ref} already built and delivered ({delivery.strategy}), build skipped\n", "build")
+
+    saved(saving, rawlogfile)
     preret = True
-    for cmd in cmds:
+    events = []
+    if need:
+        preret, events, out = build_image(cf, pf, rqs, imageRep, tag)
+        summ += inlog(out, "build")
+        summ += inlog(buildcache.cache_report(buildcache.cache_stats(out)), "build:cache")
+
+    for cmd in cmds if preret else []:
         p = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
         #log(rawlogfile, p.stdout.decode(), "build:*")
-        summ += inlog(p.stdout.decode(), "connect:curl")
+        summ += inlog(p.stdout.decode(), "build")
         if p.returncode != 0:
             preret = False
             break
-    
-    os.chdir(origdir)
+
+    if preret:
+        delivered.add(ref)
 
     log(rawlogfile, summ, "phase", datet)
 
-    return preret, summ
+    return preret, summ, dockerapi.summary(events, t0)
 
 if __name__ == "__main__":
 
@@ -110,7 +218,7 @@ if __name__ == "__main__":
     rawlogfile = os.path.join(outputfolder, "kubevibe.rawlog")
 
     if cf and pf:
-        ret, logs = preprocess(outputfolder, cf, pf, rqs, os.path.abspath(rawlogfile))
+        ret, logs, info = preprocess(outputfolder, cf, pf, rqs, os.path.abspath(rawlogfile))
         print(logs)
         if not ret:
             print("build failed")
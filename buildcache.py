@@ -0,0 +1,103 @@
+# KubeVibe
+# BuildKit caching for BUILD
+#
+# Generated Dockerfiles install requirements with pip from scratch on every
+# build. With BUILDKIT=1 (default) the Dockerfile actually built is an
+# adapted copy (Dockerfile.kubevibe, the generated one is left as is) whose
+# pip installs run with a cache mount shared by every build on the daemon,
+# and, if WHEELHOUSE names a directory of wheels, with that directory bound
+# in as --find-links (WHEELHOUSE_OFFLINE=1 adds --no-index). Layer and pip
+# cache hits are parsed from the plain progress output of each build.
+#
+#   python3 buildcache.py wheelhouse flask requests ...   fills WHEELHOUSE
+
+import os
+import re
+import sys
+import subprocess
+
+buildkit = bool(int(os.getenv("BUILDKIT", "1")))
+wheelhouse = os.getenv("WHEELHOUSE", "")
+wheelhouseOffline = bool(int(os.getenv("WHEELHOUSE_OFFLINE", "0")))
+# Platform of the wheels the generated images need (python:3.11-slim)
+wheelPython = os.getenv("WHEELHOUSE_PYTHON", "3.11")
+wheelPlatform = os.getenv("WHEELHOUSE_PLATFORM", "manylinux2014_x86_64")
+
+DOCKERFILE = "Dockerfile.kubevibe"
+PIP_CACHE = "--mount=type=cache,id=kubevibe-pip,target=/root/.cache/pip"
+WHEELS = "--mount=type=bind,from=wheelhouse,target=/wheels"
+
+PIP_INSTALL = re.compile(r"\b(pip3?|python3?\s+-m\s+pip)\s+install\b")
+
+def adapt_dockerfile(cf):
+    # Shell-form RUN lines installing with pip get the cache (and wheelhouse)
+    # mounts; --no-cache-dir would defeat the cache mount and goes away.
+    # Lines after a USER instruction are left alone (the cache is root's).
+    out = []
+    user = False
+    for line in re.sub(r"\\\s*\n", " ", cf or "").splitlines():
+        words = line.split(None, 1)
+        ins = words[0].upper() if words else ""
+        if ins == "USER":
+            user = True
+        rest = words[1] if len(words) > 1 else ""
+        if ins == "RUN" and not user and not rest.startswith("[") and PIP_INSTALL.search(rest):
+            mounts = [PIP_CACHE]
+            rest = re.sub(r"\s--no-cache-dir\b", "", rest)
+            if wheelhouse:
+                mounts.append(WHEELS)
+                links = " --find-links /wheels" + (" --no-index" if wheelhouseOffline else "")
+                rest = PIP_INSTALL.sub(lambda m: m.group(0) + links, rest)
+            line = f"RUN {' '.join(mounts)} {rest}"
+        out.append(line)
+    return "\n".join(out) + "\n"
+
+def build_flags():
+    # Extra docker build arguments for the adapted Dockerfile
+    if not buildkit:
+        return ""
+    flags = "--progress=plain"
+    if wheelhouse:
+        flags += f" --build-context wheelhouse={os.path.abspath(wheelhouse)}"
+    return flags
+
+def cache_stats(out):
+    # Cache hits of one build from its output (BuildKit plain progress or
+    # classic builder): {"steps", "cached", "packages", "pip_cached", "wheelhouse"}
+    plain = set(re.findall(r"^#(\d+) \[[^\]]*\d+/\d+\]", out, re.M))
+    steps = len(plain) + len(re.findall(r"^Step \d+/\d+ :", out, re.M))
+    cached = len(set(re.findall(r"^#(\d+) CACHED", out, re.M)) & plain) + len(re.findall(r"^ ---> Using cache", out, re.M))
+    usingCached = len(re.findall(r"Using cached \S+", out))
+    fromWheels = len(re.findall(r"Processing /wheels/\S+", out))
+    downloaded = len(re.findall(r"Downloading \S+\.(?:whl|tar\.gz|zip)\b", out))
+    return {
+        "steps": steps,
+        "cached": cached,
+        "packages": usingCached + fromWheels + downloaded,
+        "pip_cached": usingCached,
+        "wheelhouse": fromWheels
+    }
+
+def cache_report(stats):
+    layers = f"{stats['cached']}/{stats['steps']} steps cached" if stats["steps"] else "no steps"
+    pkgs = stats["packages"]
+    hits = stats["pip_cached"] + stats["wheelhouse"]
+    pip = f"{hits}/{pkgs} packages from cache ({stats['wheelhouse']} from the wheelhouse)" if pkgs else "no package downloads"
+    return f"{layers}, {pip}\n"
+
+def fill_wheelhouse(packages, directory=None):
+    # Downloads binary wheels for the image platform into the wheelhouse
+    directory = directory or wheelhouse
+    if not directory:
+        raise ValueError("WHEELHOUSE is not set")
+    os.makedirs(directory, exist_ok=True)
+    cmd = [sys.executable, "-m", "pip", "download", "--only-binary=:all:", "--python-version", wheelPython,
+           "--platform", wheelPlatform, "-d", directory] + list(packages)
+    return subprocess.run(cmd).returncode
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["wheelhouse"]:
+        sys.exit(fill_wheelhouse(sys.argv[2:]))
+    cf = "FROM python:3.11-slim\nCOPY requirements.txt /requirements.txt\nRUN pip install --no-cache-dir -r /requirements.txt\nCOPY myapp.py /myapp.py\nEXPOSE 5000\nCMD [\"python\", \"/myapp.py\"]"
+    print(adapt_dockerfile(cf), end="")
+    print(f"docker build {build_flags()} -f {DOCKERFILE} -")
@@ -15,7 +15,13 @@ def smartyamldump(d):
     else:
         raise Exception("YAML format unknown")
     
-def postprocess(outputfolder, intent, rawlogfile):
+CHART_CMDS = [
+    "helm lint",
+    "helm package .",
+    "mv genchart-0.1.0.tgz .."
+]
+
+def write_chart(outputfolder, intent):
     d = {
         "apiVersion": "v2",
         "name": "genchart",
@@ -34,20 +40,18 @@ def postprocess(outputfolder, intent, rawlogfile):
     f = open(os.path.join(chartdir, "Chart.yaml"), "w")
     f.write(smartyamldump(d))
     f.close()
+    return chartdir
+
+def postprocess(outputfolder, intent, rawlogfile):
+    chartdir = write_chart(outputfolder, intent)
 
     abs_log = os.path.abspath(rawlogfile)
 
     origdir = os.getcwd()
     os.chdir(chartdir)
 
-    cmds = [
-        "helm lint",
-        "helm package .",
-        "mv genchart-0.1.0.tgz ../.."
-    ]
-
     preret = True
-    for cmd in cmds:
+    for cmd in CHART_CMDS:
         p = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
         log(abs_log, p.stdout.decode(), "postprocess:*")
         if p.returncode != 0:
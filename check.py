@@ -0,0 +1,397 @@
+# KubeVibe
+# Stage 1b - Check
+#
+# Static cross-artifact consistency between myapp.py, Dockerfile,
+# requirements.txt and vibe.yaml, run after GENERATE and FIX so that
+# mismatches the prompts already warn about go back to FIX in milliseconds
+# instead of after a build, a push and a deploy:
+#   - the port the app listens on vs EXPOSE, containerPort and targetPort
+#   - the app listening on localhost only
+#   - Services selecting no pod
+#   - the Deployment image vs the image BUILD produces
+#   - imports in myapp.py missing from requirements.txt
+#   - COPY sources and CMD targets that are not generated files
+# Checks that cannot be decided statically (port from a variable...) are
+# skipped rather than guessed.
+
+import os
+import re
+import ast
+import sys
+import json
+import shlex
+import yaml
+from build import image_name
+import delivery
+
+CODEFILE = "myapp.py"
+GENERATED = ("myapp.py", "requirements.txt", "Dockerfile")
+WORKLOADS = ("Deployment", "StatefulSet", "DaemonSet", "ReplicaSet", "Job")
+SERVERS = ("gunicorn", "uvicorn", "hypercorn", "waitress-serve", "flask")
+
+# Import name -> distribution name where they differ
+DISTRIBUTIONS = {
+    "yaml": "pyyaml",
+    "cv2": "opencv-python",
+    "sklearn": "scikit-learn",
+    "skimage": "scikit-image",
+    "PIL": "pillow",
+    "bs4": "beautifulsoup4",
+    "dotenv": "python-dotenv",
+    "jwt": "pyjwt",
+    "dateutil": "python-dateutil",
+    "magic": "python-magic",
+    "multipart": "python-multipart",
+    "jose": "python-jose",
+    "psycopg2": "psycopg2-binary",
+    "MySQLdb": "mysqlclient",
+    "serial": "pyserial",
+    "Crypto": "pycryptodome",
+    "OpenSSL": "pyopenssl",
+    "socketio": "python-socketio",
+    "flask_socketio": "flask-socketio",
+    "flask_cors": "flask-cors",
+    "flask_sqlalchemy": "flask-sqlalchemy",
+    "attr": "attrs",
+    "zmq": "pyzmq",
+    "docx": "python-docx",
+    "fitz": "pymupdf",
+    "Levenshtein": "python-levenshtein"
+}
+
+# Distributions whose alternatives satisfy the same import
+ALTERNATIVES = {
+    "psycopg2-binary": ("psycopg2",),
+    "opencv-python": ("opencv-python-headless", "opencv-contrib-python"),
+    "pycryptodome": ("pycryptodomex", "pycrypto")
+}
+
+# Packages that pull in others commonly imported on their own
+PROVIDES = {
+    "flask": ("werkzeug", "jinja2", "markupsafe", "itsdangerous", "click"),
+    "fastapi": ("starlette", "pydantic"),
+    "requests": ("urllib3", "idna", "certifi", "charset-normalizer"),
+    "uvicorn": ("click", "h11"),
+    "pandas": ("numpy", "python-dateutil", "pytz"),
+    "scikit-learn": ("numpy", "scipy", "joblib"),
+    "matplotlib": ("numpy",),
+    "celery": ("kombu",),
+    "flask-sqlalchemy": ("sqlalchemy",)
+}
+
+def issue(artifacts, error):
+    return {"artifacts": list(artifacts), "error": error}
+
+def normalize(name):
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+def requirement_names(rqs):
+    names = set()
+    for line in (rqs or "").splitlines():
+        line = line.split("#", 1)[0].strip()
+        if not line or line.startswith("-"):
+            continue
+        m = re.match(r"[A-Za-z0-9][A-Za-z0-9._-]*", line)
+        if m:
+            names.add(normalize(m.group(0)))
+    for name in list(names):
+        names.update(PROVIDES.get(name, ()))
+    return names
+
+# myapp.py
+
+def constant_int(node):
+    # Port from 5000, "5000", int(...) or os.environ.get("PORT", 5000)
+    if isinstance(node, ast.Constant):
+        if isinstance(node.value, int) and not isinstance(node.value, bool):
+            return node.value
+        if isinstance(node.value, str) and node.value.isdigit():
+            return int(node.value)
+        return None
+    if isinstance(node, ast.Call):
+        name = call_name(node)
+        if name == "int" and node.args:
+            return constant_int(node.args[0])
+        if name in ("get", "getenv") and len(node.args) > 1:
+            return constant_int(node.args[1])
+    return None
+
+def constant_str(node):
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return node.value
+    if isinstance(node, ast.Call) and len(node.args) > 1:
+        return constant_str(node.args[1])
+    return None
+
+def call_name(node):
+    func = node.func
+    return func.attr if isinstance(func, ast.Attribute) else getattr(func, "id", "")
+
+def code_server(tree):
+    # (host, port) the code listens on when run as a script; None for what
+    # cannot be known. Flask, uvicorn and socketio default to localhost.
+    apps = {"uvicorn"}
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Assign) and isinstance(node.value, ast.Call) and call_name(node.value) in ("Flask", "SocketIO", "Quart"):
+            apps.update(t.id for t in node.targets if isinstance(t, ast.Name))
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Call):
+            continue
+        func = node.func
+        name = call_name(node)
+        owner = getattr(func.value, "id", "") if isinstance(func, ast.Attribute) else ""
+        kw = {k.arg: k.value for k in node.keywords if k.arg}
+        if (name == "run" and (owner in apps or "port" in kw)) or name == "run_app":
+            default = 8000 if owner == "uvicorn" else 8080 if name == "run_app" else 5000
+            port = constant_int(kw["port"]) if "port" in kw else default
+            host = constant_str(kw["host"]) if "host" in kw else ("0.0.0.0" if name == "run_app" else "127.0.0.1")
+            return host, port
+        if name.endswith("HTTPServer") or name.endswith("TCPServer"):
+            if node.args and isinstance(node.args[0], ast.Tuple) and len(node.args[0].elts) == 2:
+                return constant_str(node.args[0].elts[0]), constant_int(node.args[0].elts[1])
+            return None, None
+    return None, None
+
+def imports(tree):
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.update(a.name.split(".")[0] for a in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            names.add(node.module.split(".")[0])
+    return names
+
+# Dockerfile
+
+def instructions(cf):
+    # [(INSTRUCTION, arguments)] with line continuations joined
+    out = []
+    text = re.sub(r"\\\s*\n", " ", cf or "")
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        parts = line.split(None, 1)
+        out.append((parts[0].upper(), parts[1] if len(parts) > 1 else ""))
+    return out
+
+def command(args):
+    # Exec form must be a JSON array, anything else runs through /bin/sh -c
+    if args.startswith("["):
+        try:
+            return json.loads(args), None
+        except ValueError:
+            return None, f"exec form {args} is not a JSON array (use double quotes)"
+    try:
+        return shlex.split(args), None
+    except ValueError:
+        return args.split(), None
+
+def cmd_server(argv):
+    # (is a server, host, port) from a command line; host or port None when
+    # it does not say
+    words = [os.path.basename(w) for w in argv]
+    server = next((w for w in words if w in SERVERS), None)
+    if not server:
+        return False, None, None
+    host, port = None, None
+    if server == "flask":
+        host, port = "127.0.0.1", 5000
+    elif server == "uvicorn":
+        host, port = "127.0.0.1", 8000
+    elif server in ("gunicorn", "hypercorn"):
+        host, port = "127.0.0.1", 8000
+    elif server == "waitress-serve":
+        host, port = "0.0.0.0", 8080
+    for i, w in enumerate(argv):
+        value = argv[i + 1] if i + 1 < len(argv) else ""
+        if "=" in w and w.startswith("--"):
+            w, value = w.split("=", 1)
+        if w in ("-b", "--bind", "--listen"):
+            h, _, p = value.rpartition(":")
+            host, port = h or host, int(p) if p.isdigit() else None
+        elif w in ("--port", "-p"):
+            port = int(value) if value.isdigit() else None
+        elif w in ("--host", "-h"):
+            host = value
+    return True, host, port
+
+# vibe.yaml
+
+SHAPES = {dict: "mapping", list: "list", str: "string"}
+
+def shaped(value, kind, where, issues):
+    # value if it has the expected shape (dict, list or str). A missing one
+    # is empty, a wrong one is empty too and an issue for FIX.
+    if value is None:
+        return kind()
+    if not isinstance(value, kind):
+        issues.append(issue(["vibe.yaml"], f"{where} should be a {SHAPES[kind]}, not {type(value).__name__} {value!r}"))
+        return kind()
+    return value
+
+def pod_specs(docs, issues):
+    # (doc, pod labels, pod spec, "Kind name") of every workload and Pod
+    for doc in docs:
+        if not isinstance(doc, dict) or doc.get("kind") not in WORKLOADS + ("Pod",):
+            continue
+        meta = shaped(doc.get("metadata"), dict, f"{doc['kind']} metadata", issues)
+        where = f"{doc['kind']} {meta.get('name')}"
+        if doc["kind"] == "Pod":
+            labels = shaped(meta.get("labels"), dict, f"{where} metadata.labels", issues)
+            yield doc, labels, shaped(doc.get("spec"), dict, f"{where} spec", issues), where
+            continue
+        spec = shaped(doc.get("spec"), dict, f"{where} spec", issues)
+        template = shaped(spec.get("template"), dict, f"{where} spec.template", issues)
+        tmeta = shaped(template.get("metadata"), dict, f"{where} spec.template.metadata", issues)
+        labels = shaped(tmeta.get("labels"), dict, f"{where} spec.template.metadata.labels", issues)
+        yield doc, labels, shaped(template.get("spec"), dict, f"{where} spec.template.spec", issues), where
+
+def containers(spec, where, issues):
+    listed = shaped(spec.get("containers"), list, f"{where} containers", issues)
+    for c in listed:
+        if not isinstance(c, dict):
+            issues.append(issue(["vibe.yaml"], f"{where} container {c!r} is not a mapping"))
+    return [c for c in listed if isinstance(c, dict)]
+
+def check(D, imageRep=None):
+    # imageRep only names the image in the report: BUILD rewrites any
+    # <registry>/myapp reference to the image it delivers
+    # Returns (success, issues, report). issues are {artifacts, error} dicts.
+    node = D["node"]
+    pf = node["code"].get("content") or ""
+    cf = node["container"].get("content") or ""
+    mf = node["manifest"].get("content") or ""
+    rqs = node["requirements"].get("content") or ""
+    issues = []
+
+    tree = None
+    try:
+        tree = ast.parse(pf)
+    except SyntaxError as e:
+        issues.append(issue(["myapp.py"], f"syntax error line {e.lineno}: {e.msg}"))
+
+    docs = []
+    try:
+        docs = [d for d in yaml.safe_load_all(mf) if d is not None]
+    except yaml.YAMLError as e:
+        issues.append(issue(["vibe.yaml"], f"invalid YAML: {getattr(e, 'problem', None) or e}"))
+
+    # Where the container process listens
+    host, port, served = None, None, None
+    exposed = []
+    for ins, args in instructions(cf):
+        if ins == "EXPOSE":
+            for p in args.split():
+                p = p.split("/")[0]
+                if p.isdigit():
+                    exposed.append(int(p))
+        elif ins in ("COPY", "ADD"):
+            argv, err = command(args)
+            if not argv or any(a.startswith("--from") for a in argv):
+                continue
+            argv = [a for a in argv if not a.startswith("--")]
+            for src in argv[:-1]:
+                src = os.path.normpath(src).lstrip("/")
+                if src != "." and not any(c in src for c in "*?$") and src not in GENERATED:
+                    issues.append(issue(["Dockerfile"], f"{ins} {src}: not a generated file ({', '.join(GENERATED)})"))
+        elif ins in ("CMD", "ENTRYPOINT"):
+            argv, err = command(args)
+            if err:
+                issues.append(issue(["Dockerfile"], f"{ins} {err}"))
+                continue
+            for w in argv:
+                if w.endswith(".py") and os.path.basename(w) != CODEFILE:
+                    issues.append(issue(["Dockerfile", "myapp.py"], f"{ins} runs {w}, the code is in {CODEFILE}"))
+                m = re.match(r"^([A-Za-z_][\w.]*):[A-Za-z_]\w*$", w)
+                if m and m.group(1) != CODEFILE[:-3]:
+                    issues.append(issue(["Dockerfile", "myapp.py"], f"{ins} loads module {m.group(1)}, the code is in {CODEFILE}"))
+            isserver, h, p = cmd_server(argv)
+            if isserver:
+                served, host, port = "Dockerfile", h, p
+    if not served and tree is not None:
+        host, port = code_server(tree)
+        served = "myapp.py"
+
+    if served and host in ("127.0.0.1", "localhost"):
+        issues.append(issue([served], f"the app listens on {host}:{port}, unreachable from outside the container (listen on 0.0.0.0)"))
+
+    if port and exposed and port not in exposed:
+        issues.append(issue(["Dockerfile", "myapp.py"], f"EXPOSE {' '.join(map(str, exposed))} but the app listens on {port}"))
+
+    # Manifest against the app and the image BUILD produces
+    named = {}
+    declared = []
+    pods = list(pod_specs(docs, issues))
+    image = f"{imageRep or delivery.imageRep}/myapp"
+    images = []
+    for doc, labels, spec, where in pods:
+        for c in containers(spec, where, issues):
+            images.append(shaped(c.get("image"), str, f"{where} container image", issues))
+            for p in shaped(c.get("ports"), list, f"{where} container ports", issues):
+                if isinstance(p, dict) and isinstance(p.get("containerPort"), int):
+                    declared.append(p["containerPort"])
+                    if isinstance(p.get("name"), str):
+                        named[p["name"]] = p["containerPort"]
+    if port and declared and port not in declared:
+        issues.append(issue(["vibe.yaml", "myapp.py"], f"containerPort {' '.join(map(str, declared))} but the app listens on {port}"))
+    if pods and not any(image_name(i).rsplit("/", 1)[-1] == "myapp" for i in images):
+        issues.append(issue(["vibe.yaml"], f"image {', '.join(i or '<none>' for i in images)} is not the image BUILD produces ({image}:<tag>)"))
+
+    for doc in docs:
+        if not isinstance(doc, dict) or doc.get("kind") != "Service":
+            continue
+        name = shaped(doc.get("metadata"), dict, "Service metadata", issues).get("name")
+        spec = shaped(doc.get("spec"), dict, f"Service {name} spec", issues)
+        selector = shaped(spec.get("selector"), dict, f"Service {name} selector", issues)
+        if selector and pods and not any(all(labels.get(k) == v for k, v in selector.items()) for d, labels, s, w in pods):
+            issues.append(issue(["vibe.yaml"], f"Service {name} selector {json.dumps(selector, default=str)} matches no pod template labels"))
+        for p in shaped(spec.get("ports"), list, f"Service {name} ports", issues):
+            if not isinstance(p, dict):
+                continue
+            target = p.get("targetPort", p.get("port"))
+            if isinstance(target, str) and not target.isdigit():
+                if target not in named:
+                    issues.append(issue(["vibe.yaml"], f"Service {name} targetPort {target} is not a named container port"))
+                    continue
+                target = named[target]
+            target = int(target) if isinstance(target, (int, str)) else None
+            if port and target and target != port:
+                issues.append(issue(["vibe.yaml", "myapp.py"], f"Service {name} targetPort {target} but the app listens on {port}"))
+            elif not port and target and exposed and target not in exposed:
+                issues.append(issue(["vibe.yaml", "Dockerfile"], f"Service {name} targetPort {target} but EXPOSE {' '.join(map(str, exposed))}"))
+
+    # Imports against requirements.txt
+    if tree is not None:
+        have = requirement_names(rqs)
+        local = {CODEFILE[:-3]}
+        for mod in sorted(imports(tree) - set(sys.stdlib_module_names) - local):
+            dist = DISTRIBUTIONS.get(mod, normalize(mod))
+            if dist in have or normalize(mod) in have or any(a in have for a in ALTERNATIVES.get(dist, ())):
+                continue
+            # Namespace packages (google.cloud -> google-cloud-storage)
+            if not any(h.startswith(normalize(mod) + "-") for h in have):
+                issues.append(issue(["requirements.txt", "myapp.py"], f"myapp.py imports {mod} but requirements.txt has no {dist}"))
+
+    out = "".join(f"{', '.join(i['artifacts'])}: {i['error']}\n" for i in issues) or "artifacts consistent\n"
+    return not issues, issues, out
+
+if __name__ == "__main__":
+
+    codefilecontent = "from flask import Flask, request\n\napp = Flask(__name__)\n\n@app.route('/check_credit_card', methods=['POST'])\ndef check_credit_card():\n    card_number = request.json.get('card_number')\n    # Logic to check credit card validity would go here\n    return {'valid': True}\n\nif __name__ == '__main__':\n    app.run(host='0.0.0.0', port=5000)"
+    containerfilecontent = "FROM python:3.11-slim\nCOPY myapp.py /myapp.py\nCOPY requirements.txt /requirements.txt\nRUN pip install --no-cache-dir -r /requirements.txt\nEXPOSE 5000\nCMD ['python', '/myapp.py']"
+    requirements = "Flask==2.3.2"
+    yamlfilecontent = "apiVersion: apps/v1\nkind: Deployment\nmetadata:\n  name: credit-card-checker-deployment\nspec:\n  replicas: 1\n  selector:\n    matchLabels:\n      app: credit-card-checker\n  template:\n    metadata:\n      labels:\n        app: credit-card-checker\n    spec:\n      containers:\n      - name: credit-card-checker-container\n        image: satt70/myapp:latest\n        ports:\n        - containerPort: 5000\n---\napiVersion: v1\nkind: Service\nmetadata:\n  name: credit-card-checker-service\nspec:\n  type: ClusterIP\n  selector:\n    app: credit-card-checker\n  ports:\n  - protocol: TCP\n    port: 80\n    targetPort: 5000"
+
+    D = {
+        "node": {
+            "code": {"file": "myapp.py", "content": codefilecontent},
+            "container": {"file": "Dockerfile", "content": containerfilecontent},
+            "manifest": {"file": "vibe.yaml", "content": yamlfilecontent},
+            "requirements": {"file": "requirements.txt", "content": requirements}
+        }
+    }
+
+    print("checking...")
+    ok, issues, out = check(D)
+    print(out, end="")
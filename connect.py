@@ -1,90 +1,139 @@
 # KubeVibe 
 # Stage 5 - Connect
 
-import subprocess
 import os
+import ssl
 import time
+import json
 import datetime
+import http.client
+import yaml
+from concurrent.futures import ThreadPoolExecutor
 from log import log, inlog
+import kube
+import nspool
 
-def connect(deployfile, rawlogfile):
-    ns = "vibe-test-service"
+# Ports tried on every ClusterIP besides the ones the manifest declares
+DEFAULT_PORTS = (80, 443, 5000)
+# Per-port connect/response timeout (seconds)
+probeTimeout = float(os.getenv("PROBE_TIMEOUT", "1"))
+
+def service_targets(svcs):
+    # {clusterIP: [service ports]} from a kubectl get svc document
+    targets = {}
+    for svc in (svcs or {}).get("items", []):
+        ip = svc.get("spec", {}).get("clusterIP")
+        if not ip or ip == "None":
+            continue
+        targets[ip] = [p["port"] for p in svc["spec"].get("ports", []) if "port" in p]
+    return targets
+
+def candidate_ports(deployfile, targets):
+    # Declared ports first (Service ports, then container ports), then the
+    # defaults, without duplicates
+    ports = [p for plist in targets.values() for p in plist]
+    try:
+        f = open(deployfile)
+        docs = [d for d in yaml.safe_load_all(f) if isinstance(d, dict)]
+        f.close()
+    except (OSError, yaml.YAMLError):
+        docs = []
+    for d in docs:
+        if d.get("kind") == "Service":
+            ports += [p.get("port") for p in d.get("spec", {}).get("ports", []) or []]
+        spec = d.get("spec", {}).get("template", {}).get("spec", {}) if d.get("kind") in ("Deployment", "StatefulSet", "DaemonSet") else {}
+        for c in spec.get("containers", []) or []:
+            ports += [p.get("containerPort") for p in c.get("ports", []) or []]
+    ports += list(DEFAULT_PORTS)
+    return [p for i, p in enumerate(ports) if isinstance(p, int) and p not in ports[:i]]
+
+def probe_port(ip, port, timeout=None):
+    # One HTTP GET /. Any HTTP answer counts, even an error status: the
+    # service is listening and speaking HTTP.
+    timeout = probeTimeout if timeout is None else timeout
+    scheme = "https" if port == 443 else "http"
+    res = {"ip": ip, "port": port, "scheme": scheme, "status": None, "latency": None, "error": None}
+    t0 = time.time()
+    try:
+        if scheme == "https":
+            conn = http.client.HTTPSConnection(ip, port, timeout=timeout, context=ssl._create_unverified_context())
+        else:
+            conn = http.client.HTTPConnection(ip, port, timeout=timeout)
+        conn.request("GET", "/")
+        res["status"] = conn.getresponse().status
+        conn.close()
+    except (OSError, http.client.HTTPException) as e:
+        res["error"] = f"{type(e).__name__}: {e}"
+    res["latency"] = round(time.time() - t0, 4)
+    return res
+
+def probe(targets, ports, timeout=None):
+    # Every (ip, port) at once; the answer is the first responding port in
+    # the order of ports (declared before defaults), not the fastest one
+    pairs = [(ip, port) for ip in targets for port in ports]
+    result = {"endpoint": None, "ip": None, "port": None, "status": None, "latency": None, "probes": []}
+    if not pairs:
+        return result
+    with ThreadPoolExecutor(max_workers=len(pairs)) as ex:
+        result["probes"] = list(ex.map(lambda pair: probe_port(pair[0], pair[1], timeout), pairs))
+    for res in result["probes"]:
+        if res["status"] is not None:
+            result.update({
+                "endpoint": f"{res['scheme']}://{res['ip']}:{res['port']}",
+                "ip": res["ip"],
+                "port": res["port"],
+                "status": res["status"],
+                "latency": res["latency"]
+            })
+            break
+    return result
+
+def probe_report(result):
+    lines = []
+    for res in result["probes"]:
+        outcome = f"HTTP {res['status']}" if res["status"] is not None else res["error"]
+        lines.append(f"{res['scheme']}://{res['ip']}:{res['port']} {outcome} ({res['latency'] * 1000:.0f} ms)")
+    return "\n".join(lines) + "\n"
+
+def connect(deployfile, rawlogfile, ns="vibe-test-service", labels=None, annotations=None, live=False):
+    # live: the manifest was already created in ns by DEPLOY (merged round-trip)
     ok = True
     endpoint = None
     summ = ""
     datet = datetime.datetime.now()
 
-    p = subprocess.run(f"kubectl create namespace {ns}", shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    #log(rawlogfile, p.stdout.decode(), "connect:namespace")
-    summ += inlog(p.stdout.decode(),"connect:namespace")
-    if p.returncode != 0:
-        ok = False
-    p = subprocess.run(f"kubectl -n {ns} create -f {deployfile}", shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    #log(rawlogfile, p.stdout.decode(), "connect:create")
-    #summ += f"--Internal-Log: {datetime.datetime.now()} --connect:create--\n"
-    #summ += p.stdout.decode()
-    summ += inlog(p.stdout.decode(), "connect:create")
-    if p.returncode != 0:
-        ok = False
+    if not live:
+        rc, out, ns = nspool.acquire(ns, labels, annotations)
+        #log(rawlogfile, p.stdout.decode(), "connect:namespace")
+        summ += inlog(out, "connect:namespace")
+        if rc != 0:
+            ok = False
+        rc, out = kube.create_manifest(ns, deployfile, labels)
+        #log(rawlogfile, p.stdout.decode(), "connect:create")
+        summ += inlog(out, "connect:create")
+        if rc != 0:
+            ok = False
 
-    p = subprocess.run(f"kubectl -n {ns} get svc -o json | jq -r '.items[].spec.clusterIP'", shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    #log(rawlogfile, p.stdout.decode(), "connect:svc")
-    #summ += f"--Internal-Log: {datetime.datetime.now()} --connect:namespace--\n"
-    #summ += p.stdout.decode()
-    summ += inlog(p.stdout.decode(), "connect:namespace")
-    if p.returncode != 0:
-        ok = False
-    output = p.stdout.decode()
-    if not output:
+    svcs = kube.get_services(ns)
+    targets = service_targets(svcs)
+    summ += inlog(json.dumps(targets) + "\n", "connect:svc")
+    if not targets:
         ok = False
     else:
-        ipaddress = output.strip()
-        # FIXME Kubernetes service exposure needs around ~1-2 seconds to wait for pod readiness, fails hard before
-        time.sleep(10)
-        p = subprocess.run(f"curl --connect-timeout 1 http://{ipaddress}", shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        #log(rawlogfile, p.stdout.decode(), "connect:curl")
-        #summ += f"--Internal-Log: {datetime.datetime.now()} --connect:curl--\n"
-        #summ += p.stdout.decode()
-        summ += inlog(p.stdout.decode(), "connect:curl")
-        port = None
-        if p.returncode != 0:
-            #time.sleep(2)
-            p = subprocess.run(f"curl --connect-timeout 1 http://{ipaddress}:443", shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-            #log(rawlogfile, p.stdout.decode(), "connect:curl")
-            #summ += f"--Internal-Log: {datetime.datetime.now()} --connect:curl--\n"
-            #summ += p.stdout.decode()
-            summ += inlog(p.stdout.decode(), "connect:curl")
-            if p.returncode != 0:
-                #time.sleep(2)
-                p = subprocess.run(f"curl --connect-timeout 1 http://{ipaddress}:5000", shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-                #log(rawlogfile, p.stdout.decode(), "connect:curl")  
-                #summ += f"--Internal-Log: {datetime.datetime.now()} --connect:curl--\n"
-                #summ += p.stdout.decode()
-                summ += inlog(p.stdout.decode(), "connect:curl")
-                if p.returncode != 0:
-                    ok = False
-                else:
-                    endpoint = f"http://{ipaddress}"
-                    port = 5000
-            else:
-                endpoint = f"http://{ipaddress}" #This wont be the real endpoint after all
-                port = 443
-        else:
-            endpoint = f"http://{ipaddress}"
-            port = 80
-
-        #if port:
-        #    f = open("ports.csv", "a")
-        #    print(port, file=f)
-        #    f.close()
+        ready, reason = kube.wait_ready(ns)
+        summ += inlog(reason + "\n", "connect:ready")
+        if not ready:
+            ok = False
+    if ok:
+        result = probe(targets, candidate_ports(deployfile, targets))
+        summ += inlog(probe_report(result), "connect:probe")
+        endpoint = result
+        if not result["endpoint"]:
+            ok = False
 
-    p = subprocess.run(f"kubectl delete namespace {ns}", shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    rc, out = nspool.release(ns)
     #log(rawlogfile, p.stdout.decode(), "connect:delete")
-    #summ += f"--Internal-Log: {datetime.datetime.now()} --connect:delete--\n"
-    #summ += p.stdout.decode()
-    summ += inlog(p.stdout.decode(), "connect:curl")
-    if p.returncode != 0:
-        ok = False
+    summ += inlog(out, "connect:delete")
 
     #print(summ)
     log(rawlogfile, summ, "phase", datet)
@@ -131,6 +180,6 @@ if __name__ == "__main__":
     success, endpoint, logs = connect(vfile, rawlogfile)
 
     if success:
-        print("success in ", endpoint)
+        print("success in ", endpoint["endpoint"])
     else:
         print("failed")
\ No newline at end of file
@@ -0,0 +1,67 @@
+# KubeVibe
+# Image delivery: how the image BUILD produces gets to the cluster nodes
+#
+# IMAGE_DELIVERY selects the strategy:
+#   push        docker push to a remote registry (IMAGE_REPO, default satt70)
+#   registry    docker push to a local registry (LOCAL_REGISTRY, default localhost:5000)
+#   kind        kind load docker-image into the nodes of KIND_CLUSTER
+#   k3d         k3d image import into K3D_CLUSTER
+#   containerd  docker save piped into CONTAINERD_IMPORT on the node
+#   none        nothing, the cluster uses the local docker daemon (minikube
+#               docker-env, Docker Desktop)
+# Every image goes to <repository>/myapp:<tag>; the manifest is rewritten
+# to it and, when the image is not in a registry, pods never pull it.
+
+import os
+
+strategy = os.getenv("IMAGE_DELIVERY", "push")
+localRegistry = os.getenv("LOCAL_REGISTRY", "localhost:5000")
+kindCluster = os.getenv("KIND_CLUSTER", "kind")
+k3dCluster = os.getenv("K3D_CLUSTER", "k3s-default")
+containerdImport = os.getenv("CONTAINERD_IMPORT", "ctr -n k8s.io images import -")
+
+STRATEGIES = ("push", "registry", "kind", "k3d", "containerd", "none")
+if strategy not in STRATEGIES:
+    raise ValueError(f"IMAGE_DELIVERY={strategy}, expected one of {', '.join(STRATEGIES)}")
+
+DEFAULT_REPOS = {"push": "satt70", "registry": localRegistry}
+imageRep = os.getenv("IMAGE_REPO", DEFAULT_REPOS.get(strategy, "kubevibe.local"))
+
+def image_ref(tag, repository=None):
+    return f"{repository or imageRep}/myapp:{tag}"
+
+def deliver_commands(ref):
+    # Run after docker build/tag, in order
+    if strategy in ("push", "registry"):
+        return [f"docker push {ref}"]
+    if strategy == "kind":
+        return [f"kind load docker-image {ref} --name {kindCluster}"]
+    if strategy == "k3d":
+        return [f"k3d image import {ref} -c {k3dCluster}"]
+    if strategy == "containerd":
+        return [f"docker save {ref} | {containerdImport}"]
+    return []
+
+def present_command(ref):
+    # Command succeeding when the image is already where the cluster takes
+    # it from; None when that cannot be asked cheaply
+    if strategy == "push":
+        return f"docker manifest inspect {ref}"
+    if strategy == "registry":
+        return f"docker manifest inspect --insecure {ref}"
+    if strategy == "kind":
+        return f"docker exec {kindCluster}-control-plane crictl inspecti {ref}"
+    if strategy == "k3d":
+        return f"docker exec k3d-{k3dCluster}-server-0 crictl inspecti {ref}"
+    return None
+
+def pull_policy():
+    # Images that are in no registry must never be pulled
+    return None if strategy in ("push", "registry") else "IfNotPresent"
+
+if __name__ == "__main__":
+    ref = image_ref("0123456789abcdef")
+    print(f"strategy: {strategy}\nimage: {ref}")
+    for cmd in deliver_commands(ref):
+        print(f"deliver: {cmd}")
+    print(f"present: {present_command(ref)}\npull policy: {pull_policy()}")
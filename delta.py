@@ -0,0 +1,82 @@
+# KubeVibe
+# Deltas between JSON states
+#
+# delta(old, new) lists what changed between two JSON-able values (the FSM
+# state D, a node) as operations on paths of dict keys:
+#   ["set", ["node", "stage"], "BUILD"]
+#   ["del", ["spares"]]
+#   ["lines", ["node", "code", "content"], [[i1, i2, "new lines"], ...]]
+# Long strings that changed in a few lines are stored as line replacements
+# on the old text, everything else whole. apply(old, ops) gives back new.
+
+import copy
+import difflib
+
+# Strings shorter than this are always stored whole
+LINES_MIN = 256
+
+def line_ops(old, new):
+    # Replacements [i1, i2, text] turning the lines of old into new, or None
+    # when storing new whole is smaller
+    a, b = old.splitlines(keepends=True), new.splitlines(keepends=True)
+    ops = [[i1, i2, "".join(b[j1:j2])] for op, i1, i2, j1, j2
+           in difflib.SequenceMatcher(None, a, b, autojunk=False).get_opcodes() if op != "equal"]
+    if sum(len(text) + 16 for i1, i2, text in ops) >= len(new):
+        return None
+    return ops
+
+def apply_lines(old, ops):
+    a = old.splitlines(keepends=True)
+    # From the end, so earlier indices stay valid
+    for i1, i2, text in reversed(ops):
+        a[i1:i2] = [text]
+    return "".join(a)
+
+def delta(old, new, path=None):
+    path = path or []
+    if isinstance(old, dict) and isinstance(new, dict):
+        ops = []
+        for key in old:
+            if key not in new:
+                ops.append(["del", path + [key]])
+        for key in new:
+            if key not in old:
+                ops.append(["set", path + [key], new[key]])
+            elif old[key] != new[key]:
+                ops += delta(old[key], new[key], path + [key])
+        return ops
+    if old == new:
+        return []
+    if isinstance(old, str) and isinstance(new, str) and len(new) >= LINES_MIN:
+        lines = line_ops(old, new)
+        if lines is not None:
+            return [["lines", path, lines]]
+    return [["set", path, new]]
+
+def apply(old, ops):
+    # New value from old and delta(old, new); old is left as is
+    new = copy.deepcopy(old)
+    for op in ops:
+        path = op[1]
+        if not path:
+            new = op[2] if op[0] == "set" else apply_lines(new, op[2])
+            continue
+        parent = new
+        for key in path[:-1]:
+            parent = parent[key]
+        if op[0] == "del":
+            del parent[path[-1]]
+        elif op[0] == "set":
+            parent[path[-1]] = copy.deepcopy(op[2])
+        else:
+            parent[path[-1]] = apply_lines(parent[path[-1]], op[2])
+    return new
+
+if __name__ == "__main__":
+    import json
+    code = "".join(f"line {i}\n" for i in range(40))
+    old = {"node": {"stage": "CHECK", "code": {"content": code}}, "rev": 1, "spares": None}
+    new = {"node": {"stage": "BUILD", "code": {"content": code.replace("line 7\n", "line seven\n")}}, "rev": 2}
+    ops = delta(old, new)
+    print(json.dumps(ops))
+    print(f"{len(json.dumps(new))} -> {len(json.dumps(ops))} characters, round trip {apply(old, ops) == new}")
@@ -1,28 +1,37 @@
 # KubeVibe 
 # Stage 4 - Deploy
 
-import subprocess
 import os
-from log import log
+from log import log, inlog
+import kube
+import nspool
 
-def deploy(deployfile, rawlogfile):
-    ns = "vibe-test-deploy"
+def deploy(deployfile, rawlogfile, ns="vibe-test-deploy", labels=None, annotations=None, keep=False):
+    # keep: leave a successful deployment running so CONNECT can probe it
+    # without creating it again; CONNECT then tears the namespace down
+    # Returns (ok, namespace used, logs); the namespace is a pool namespace
+    # with NS_POOL=1
     ok = True
+    summ = ""
 
-    p = subprocess.run(f"kubectl create namespace {ns}", shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    log(rawlogfile, p.stdout.decode(), "deploy:namespace")
-    if p.returncode != 0:
+    rc, out, ns = nspool.acquire(ns, labels, annotations)
+    log(rawlogfile, out, "deploy:namespace")
+    summ += inlog(out, "deploy:namespace")
+    if rc != 0:
         ok = False
-    p = subprocess.run(f"kubectl -n {ns} create -f {deployfile}", shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    log(rawlogfile, p.stdout.decode(), "deploy:create")
-    if p.returncode != 0:
-        ok = False
-    p = subprocess.run(f"kubectl delete namespace {ns}", shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    log(rawlogfile, p.stdout.decode(), "deploy:delete")
-    if p.returncode != 0:
+    rc, out = kube.create_manifest(ns, deployfile, labels)
+    log(rawlogfile, out, "deploy:create")
+    summ += inlog(out, "deploy:create")
+    if rc != 0:
         ok = False
+    if keep and ok:
+        return ok, ns, summ
+    # Teardown happens in the background and does not decide the result
+    rc, out = nspool.release(ns)
+    log(rawlogfile, out, "deploy:delete")
+    summ += inlog(out, "deploy:delete")
 
-    return ok
+    return ok, ns, summ
 
 if __name__ == "__main__":
     
@@ -62,7 +71,7 @@ if __name__ == "__main__":
     vfile = os.path.join(D["outputfolder"], D["node"]["manifest"]["file"])
     rawlogfile = os.path.join(D["outputfolder"], D["logfile"])
 
-    success = deploy(vfile, rawlogfile)
+    success, ns, logs = deploy(vfile, rawlogfile)
 
     if success:
         print("success")
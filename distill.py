@@ -0,0 +1,135 @@
+# KubeVibe
+# Log distillation for FIX prompts
+#
+# Stage logs are inlog/log dumps: "--Internal: <date> --<context>--" or
+# "--Log: <date> --<context>--" headers, each followed by raw tool output
+# (docker build steps, kubectl, curl progress meters, probe reports). FIX
+# only needs the lines that say what went wrong. distill() keeps, per
+# section, the error-bearing lines (under their build step), Python
+# tracebacks (first frame, last frames and the exception), drops progress
+# noise and repeats, and cuts the result to FIX_LOG_BUDGET tokens, the
+# latest sections first.
+
+import os
+import re
+
+budget = int(os.getenv("FIX_LOG_BUDGET", "600"))
+# Rough size of a token in characters, good enough for a budget
+CHARS_PER_TOKEN = 4
+# Lines kept from a section with no error-bearing line at all
+TAIL = 4
+
+HEADER_RE = re.compile(r"^--(Log|Internal):\s+(.*?)\s+--(.+?)--\s*$")
+
+NOISE = [
+    re.compile(r"^\s*% Total\s+% Received"),
+    re.compile(r"^\s*Dload\s+Upload"),
+    re.compile(r"^[\s\d.:kMG%-]+$"),  # curl meters, bare numbers and --:--:--
+    re.compile(r"^#\d+ (sha256:|extracting|resolve|transferring|DONE|\[internal\])"),
+    re.compile(r"^#\d+ \d+\.\d+ (Downloading|Collecting|Using cached|Installing collected|Requirement already)"),
+    re.compile(r"^\s*(\||-->|---> [0-9a-f]{12}$|Removing intermediate container)"),
+]
+
+ERROR_RE = re.compile(
+    r"error|fail|fatal|denied|refused|not found|no such|invalid|unknown|cannot|can't|couldn't|unable|"
+    r"exception|traceback|panic|timed? ?out|exit(ed)? (code|status|with) [1-9]|non-zero|"
+    r"backoff|errimagepull|crashloop|oomkilled|evicted|not ready|unhealthy|forbidden|"
+    r"HTTP [45]\d\d|curl: \(\d+\)|\b[45]\d\d (Not Found|Internal Server Error|Bad Request|Forbidden)",
+    re.I)
+
+# Sections that are made of findings only: all their lines count
+FINDINGS = ("check", "validate")
+
+# Build steps (BuildKit plain progress, classic builder): an error inside
+# one is shown under its step line
+STEP_RE = re.compile(r"^(#\d+) \[[^\]]*\d+/\d+\] |^Step \d+/\d+ : ")
+
+def sections(text):
+    # [(context, [lines])] in order; text before the first header is ""
+    out = [("", [])]
+    for line in (text or "").splitlines():
+        m = HEADER_RE.match(line)
+        if m:
+            out.append((m.group(3), []))
+        else:
+            out[-1][1].append(line.rstrip())
+    return [(ctx, lines) for ctx, lines in out if any(l.strip() for l in lines)]
+
+def noise(line):
+    return not line.strip() or any(r.search(line) for r in NOISE)
+
+def traceback(lines, i):
+    # Traceback starting at i -> (kept lines, index after it)
+    j = i + 1
+    while j < len(lines) and (lines[j].startswith((" ", "\t")) or not lines[j].strip()):
+        j += 1
+    frames = [l for l in lines[i + 1:j] if l.strip()]
+    if len(frames) > 8:
+        frames = frames[:2] + ["  ..."] + frames[-4:]
+    return [lines[i]] + frames + lines[j:j + 1], j + 1
+
+def evidence(context, lines):
+    # (error-bearing lines of one section, noise and repeats dropped, True),
+    # or (its last lines, False) when nothing in it looks like an error
+    kept = []
+    steps = {}
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        m = STEP_RE.match(line)
+        if m:
+            steps[m.group(1) or "classic"] = line
+        if line.startswith("Traceback (most recent call last)"):
+            block, i = traceback(lines, i)
+            kept += block
+            continue
+        if not noise(line) and (context.split(":")[0] in FINDINGS or ERROR_RE.search(line)):
+            step = steps.pop(line.split(" ", 1)[0] if line.startswith("#") else "classic", None)
+            if step and step != line:
+                kept.append(step)
+            kept.append(line)
+        i += 1
+    found = bool(kept)
+    if not kept:
+        kept = [l for l in lines if not noise(l)][-TAIL:]
+    # Collapse repeats, keeping the count
+    out = []
+    for line in kept:
+        if out and out[-1][0] == line:
+            out[-1][1] += 1
+        else:
+            out.append([line, 1])
+    return [l if n == 1 else f"{l} (x{n})" for l, n in out], found
+
+def distill(logs, tokens=None):
+    # Compact failure summary of stage logs, within tokens (FIX_LOG_BUDGET)
+    limit = (budget if tokens is None else tokens) * CHARS_PER_TOKEN
+    parts = []
+    for context, lines in sections(logs):
+        kept, found = evidence(context, lines)
+        if kept:
+            parts.append((found, f"[{context or 'log'}]\n" + "\n".join(l[:300] for l in kept)))
+    # With errors somewhere, sections without any are left out
+    if any(found for found, part in parts):
+        parts = [(found, part) for found, part in parts if found]
+    parts = [part for found, part in parts]
+    # Latest sections first: the failure is usually at the end
+    out = []
+    size = 0
+    for part in reversed(parts):
+        if size + len(part) > limit:
+            if not out:
+                out.append(part[:limit - 4] + "\n...")
+            break
+        out.append(part)
+        size += len(part) + 1
+    return "\n".join(reversed(out))
+
+if __name__ == "__main__":
+    import sys
+    from log import render
+    # A run log (JSONL) reads as its legacy text
+    text = "".join(render(open(sys.argv[1]) if len(sys.argv) > 1 else sys.stdin))
+    short = distill(text)
+    print(short)
+    print(f"-- {len(text)} -> {len(short)} characters")
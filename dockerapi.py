@@ -0,0 +1,225 @@
+# KubeVibe
+# Image builds from memory: the build context is a tar assembled from the
+# artifacts in D["node"], sent either to the Docker Engine API over its unix
+# socket (POST /build) or to `docker build -` on stdin. Nothing is written
+# to disk and nobody changes directory. Progress comes back as events:
+#   {"type": "step", "step": "2/4", "text": "COPY requirements.txt ."}
+#   {"type": "cached", "step": "2/4"}
+#   {"type": "log", "text": "..."}
+#   {"type": "image", "id": "sha256:..."}
+#   {"type": "error", "text": "..."}
+#
+# The Engine API only drives the classic builder (BuildKit needs a gRPC
+# session), so DOCKER_BUILD_BACKEND=auto uses it when BuildKit caching is
+# off and the socket is there, `docker build -` otherwise; api or cli force
+# either one.
+
+import os
+import io
+import re
+import json
+import time
+import socket
+import tarfile
+import threading
+import subprocess
+import http.client
+import urllib.parse
+
+backend = os.getenv("DOCKER_BUILD_BACKEND", "auto")
+buildTimeout = float(os.getenv("DOCKER_BUILD_TIMEOUT", "900"))
+
+def socket_path():
+    host = os.getenv("DOCKER_HOST", "")
+    if host.startswith("unix://"):
+        return host[len("unix://"):]
+    if host:
+        return None
+    return "/var/run/docker.sock"
+
+def available():
+    path = socket_path()
+    return bool(path) and os.path.exists(path)
+
+def build_context(files):
+    # {name: content} -> tar bytes. Fixed mtimes and owners, so the same
+    # artifacts give the same context and hit the same layer cache.
+    buf = io.BytesIO()
+    tar = tarfile.open(fileobj=buf, mode="w")
+    for name in sorted(files):
+        data = (files[name] or "").encode()
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mode = 0o644
+        tar.addfile(info, io.BytesIO(data))
+    tar.close()
+    return buf.getvalue()
+
+class UnixConnection(http.client.HTTPConnection):
+
+    def __init__(self, path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+STEP_RE = re.compile(r"^Step (\d+/\d+) : (.*)")
+PLAIN_STEP_RE = re.compile(r"^#(\d+) \[[^\]]*?(\d+/\d+)\] (.*)")
+PLAIN_CACHED_RE = re.compile(r"^#(\d+) CACHED")
+PLAIN_ERROR_RE = re.compile(r"^(?:#\d+ )?ERROR:? (.*)")
+PLAIN_IMAGE_RE = re.compile(r"writing image (sha256:[0-9a-f]+)")
+
+def api_events(message, state):
+    # Engine API JSON messages (classic builder) -> events
+    if "errorDetail" in message or "error" in message:
+        yield {"type": "error", "text": message.get("error") or message["errorDetail"].get("message", "")}
+    elif "aux" in message and isinstance(message["aux"], dict) and "ID" in message["aux"]:
+        yield {"type": "image", "id": message["aux"]["ID"]}
+    elif "stream" in message:
+        for line in message["stream"].splitlines():
+            m = STEP_RE.match(line)
+            if m:
+                state["step"] = m.group(1)
+                yield {"type": "step", "step": m.group(1), "text": m.group(2)}
+            elif line.strip() == "---> Using cache":
+                yield {"type": "cached", "step": state.get("step")}
+            elif line.strip():
+                yield {"type": "log", "text": line}
+
+def plain_events(line, state):
+    # BuildKit --progress=plain lines -> events
+    m = PLAIN_STEP_RE.match(line)
+    if m:
+        state[m.group(1)] = m.group(2)
+        yield {"type": "step", "step": m.group(2), "text": m.group(3)}
+        return
+    m = PLAIN_CACHED_RE.match(line)
+    if m:
+        if m.group(1) in state:
+            yield {"type": "cached", "step": state[m.group(1)]}
+        return
+    m = PLAIN_ERROR_RE.match(line)
+    if m:
+        yield {"type": "error", "text": m.group(1)}
+        return
+    m = PLAIN_IMAGE_RE.search(line)
+    if m:
+        yield {"type": "image", "id": m.group(1)}
+    yield {"type": "log", "text": line}
+
+def api_build(context, tags, dockerfile="Dockerfile", on_event=None):
+    # POST /build on the daemon socket. Returns (ok, events, output text).
+    query = [("t", t) for t in tags] + [("dockerfile", dockerfile), ("rm", "1"), ("forcerm", "1")]
+    conn = UnixConnection(socket_path(), timeout=buildTimeout)
+    events, out = [], []
+    state = {}
+    ok = True
+    try:
+        conn.request("POST", "/build?" + urllib.parse.urlencode(query), context, {"Content-Type": "application/x-tar"})
+        resp = conn.getresponse()
+        if resp.status >= 300:
+            data = resp.read().decode(errors="replace")
+            try:
+                data = json.loads(data).get("message", data)
+            except ValueError:
+                pass
+            ev = {"type": "error", "text": f"HTTP {resp.status}: {data}"}
+            events.append(ev)
+            out.append(ev["text"] + "\n")
+            return False, events, "".join(out)
+        # One JSON object per line, sometimes several per chunk
+        decoder = json.JSONDecoder()
+        for raw in resp:
+            text = raw.decode(errors="replace").strip()
+            while text:
+                message, end = decoder.raw_decode(text)
+                text = text[end:].lstrip()
+                out.append(message.get("stream") or (message.get("error", "") + "\n" if "error" in message else ""))
+                for ev in api_events(message, state):
+                    ok = ok and ev["type"] != "error"
+                    events.append(ev)
+                    if on_event:
+                        on_event(ev)
+    except (OSError, http.client.HTTPException, ValueError) as e:
+        ev = {"type": "error", "text": f"{type(e).__name__}: {e}"}
+        events.append(ev)
+        out.append(ev["text"] + "\n")
+        ok = False
+    finally:
+        conn.close()
+    return ok, events, "".join(out)
+
+def cli_build(context, tags, dockerfile="Dockerfile", on_event=None, env=None, flags=""):
+    # docker build - with the context tar on stdin. Same return as api_build.
+    cmd = ["docker", "build"] + flags.split() + ["-f", dockerfile]
+    for t in tags:
+        cmd += ["-t", t]
+    cmd.append("-")
+    events, out = [], []
+    state = {}
+    ok = True
+    try:
+        p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                             env=dict(os.environ, **(env or {})))
+    except OSError as e:
+        ev = {"type": "error", "text": f"{type(e).__name__}: {e}"}
+        return False, [ev], ev["text"] + "\n"
+    # A thread feeds stdin so a large context cannot deadlock against output
+    def feed():
+        try:
+            p.stdin.write(context)
+        except OSError:
+            pass
+        finally:
+            p.stdin.close()
+    threading.Thread(target=feed, daemon=True).start()
+    for raw in p.stdout:
+        line = raw.decode(errors="replace")
+        out.append(line)
+        for ev in plain_events(line.rstrip("\n"), state):
+            events.append(ev)
+            if on_event:
+                on_event(ev)
+    ok = p.wait() == 0
+    if not ok and not any(ev["type"] == "error" for ev in events):
+        events.append({"type": "error", "text": f"docker build exited with {p.returncode}"})
+    return ok, events, "".join(out)
+
+def use_api(buildkit):
+    if backend == "api":
+        return True
+    if backend == "cli":
+        return False
+    return not buildkit and available()
+
+def summary(events, t0=None):
+    # Steps with their cache status, image id and errors of one build
+    steps = {}
+    for ev in events:
+        if ev["type"] == "step":
+            steps.setdefault(ev["step"], {"step": ev["step"], "text": ev["text"], "cached": False})
+        elif ev["type"] == "cached" and ev["step"] in steps:
+            steps[ev["step"]]["cached"] = True
+    res = {
+        "steps": list(steps.values()),
+        "image": next((ev["id"] for ev in reversed(events) if ev["type"] == "image"), None),
+        "errors": [ev["text"] for ev in events if ev["type"] == "error"]
+    }
+    if t0 is not None:
+        res["time"] = round(time.time() - t0, 3)
+    return res
+
+if __name__ == "__main__":
+    files = {
+        "Dockerfile": "FROM python:3.11-slim\nCOPY myapp.py /myapp.py\nCMD [\"python\", \"/myapp.py\"]\n",
+        "myapp.py": "print('hello')\n"
+    }
+    ctx = build_context(files)
+    print(f"context {len(ctx)} bytes, socket {socket_path()} ({'available' if available() else 'not available'})")
+    t0 = time.time()
+    build = api_build if use_api(False) else cli_build
+    ok, events, out = build(ctx, ["kubevibe-test:latest"], on_event=lambda ev: print(json.dumps(ev)))
+    print(json.dumps(summary(events, t0), indent=2))
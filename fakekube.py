@@ -0,0 +1,258 @@
+# KubeVibe
+# Stand-in Kubernetes API server for exercising kapi.py and the cluster
+# stages without a cluster. Keeps objects in memory and fakes what the
+# pipeline looks at: a Running pod per Deployment, a ClusterIP per Service,
+# EndpointSlices that turn ready when a pod matches the Service selector.
+#
+#   python3 fakekube.py [port]      prints the KUBECONFIG to export
+#
+# FAKEKUBE_CLUSTER_IP sets the ClusterIP handed out (default 127.0.0.1),
+# FAKEKUBE_POD_REASON makes every container wait with that reason
+# (e.g. ImagePullBackOff).
+
+import os
+import sys
+import json
+import time
+import uuid
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import yaml
+
+clusterIP = os.getenv("FAKEKUBE_CLUSTER_IP", "127.0.0.1")
+podReason = os.getenv("FAKEKUBE_POD_REASON")
+
+class Store:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.namespaces = {}
+        self.objects = {}  # (namespace, resource) -> {name: object}
+        self.requests = 0
+        self.connections = 0
+
+    def pods(self, ns):
+        pods = []
+        for dep in self.objects.get((ns, "deployments"), {}).values():
+            template = dep.get("spec", {}).get("template", {})
+            containers = template.get("spec", {}).get("containers", [])
+            statuses = []
+            for c in containers:
+                state = {"waiting": {"reason": podReason, "message": "fake"}} if podReason else {"running": {}}
+                statuses.append({"name": c.get("name", "c"), "image": c.get("image"), "ready": not podReason, "state": state})
+            for i in range(dep.get("spec", {}).get("replicas", 1)):
+                pods.append({
+                    "apiVersion": "v1",
+                    "kind": "Pod",
+                    "metadata": {"name": f"{dep['metadata']['name']}-fake-{i}", "namespace": ns,
+                                 "labels": template.get("metadata", {}).get("labels", {})},
+                    "status": {"phase": "Pending" if podReason else "Running", "containerStatuses": statuses}
+                })
+        return pods
+
+    def endpointslices(self, ns):
+        slices = []
+        pods = self.pods(ns)
+        for svc in self.objects.get((ns, "services"), {}).values():
+            selector = svc.get("spec", {}).get("selector") or {}
+            endpoints = []
+            for pod in pods:
+                labels = pod["metadata"]["labels"]
+                if selector and all(labels.get(k) == v for k, v in selector.items()):
+                    ready = all(cs["ready"] for cs in pod["status"]["containerStatuses"])
+                    endpoints.append({"addresses": ["10.0.0.1"], "conditions": {"ready": ready}})
+            slices.append({
+                "apiVersion": "discovery.k8s.io/v1",
+                "kind": "EndpointSlice",
+                "metadata": {"name": f"{svc['metadata']['name']}-fake", "namespace": ns,
+                             "labels": {"kubernetes.io/service-name": svc["metadata"]["name"]}},
+                "endpoints": endpoints
+            })
+        return slices
+
+    def items(self, ns, resource):
+        if resource == "pods":
+            return self.pods(ns)
+        if resource == "endpointslices":
+            return self.endpointslices(ns)
+        return list(self.objects.get((ns, resource), {}).values())
+
+def selected(obj, selector):
+    labels = obj.get("metadata", {}).get("labels") or {}
+    for term in filter(None, (selector or "").split(",")):
+        k, _, v = term.partition("=")
+        if labels.get(k) != v:
+            return False
+    return True
+
+def status(code, reason, message):
+    return code, {"kind": "Status", "apiVersion": "v1", "status": "Failure", "reason": reason, "message": message, "code": code}
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    store = None
+
+    def log_message(self, *args):
+        pass
+
+    def handle(self):
+        # Clients dropping kept-alive connections at exit are not errors
+        try:
+            super().handle()
+        except ConnectionResetError:
+            pass
+
+    def setup(self):
+        super().setup()
+        with self.store.lock:
+            self.store.connections += 1
+
+    def send(self, code, doc):
+        data = json.dumps(doc).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def body(self):
+        n = int(self.headers.get("Content-Length") or 0)
+        data = self.rfile.read(n) if n else b""
+        return yaml.safe_load(data) if data else {}
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def do_PATCH(self):
+        self.dispatch("PATCH")
+
+    def do_DELETE(self):
+        self.dispatch("DELETE")
+
+    def dispatch(self, method):
+        u = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(u.query))
+        parts = [p for p in u.path.split("/") if p]
+        body = self.body() if method in ("POST", "PATCH", "DELETE") else None
+        with self.store.lock:
+            self.store.requests += 1
+        # /api/v1/... or /apis/<group>/<version>/...
+        rest = parts[2:] if parts[:1] == ["api"] else parts[3:]
+        if method == "GET" and query.get("watch") in ("1", "true"):
+            return self.watch(rest, query)
+        with self.store.lock:
+            code, doc = self.route(method, rest, query, body)
+        self.send(code, doc)
+
+    def route(self, method, rest, query, body):
+        s = self.store
+        if rest == ["namespaces"]:
+            if method == "GET":
+                return 200, {"kind": "NamespaceList", "items": [n for n in s.namespaces.values() if selected(n, query.get("labelSelector"))]}
+            if method == "POST":
+                name = body["metadata"]["name"]
+                if name in s.namespaces:
+                    return status(409, "AlreadyExists", f'namespaces "{name}" already exists')
+                body["metadata"]["uid"] = str(uuid.uuid4())
+                body["status"] = {"phase": "Active"}
+                s.namespaces[name] = body
+                return 201, body
+        if len(rest) == 2 and rest[0] == "namespaces":
+            name = rest[1]
+            if name not in s.namespaces:
+                return status(404, "NotFound", f'namespaces "{name}" not found')
+            if method == "DELETE":
+                for key in [k for k in s.objects if k[0] == name]:
+                    del s.objects[key]
+                return 200, s.namespaces.pop(name)
+            return 200, s.namespaces[name]
+        if len(rest) >= 3 and rest[0] == "namespaces":
+            ns, resource = rest[1], rest[2]
+            name = rest[3] if len(rest) > 3 else None
+            if ns not in s.namespaces:
+                return status(404, "NotFound", f'namespaces "{ns}" not found')
+            objs = s.objects.setdefault((ns, resource), {})
+            if method == "GET" and not name:
+                return 200, {"kind": "List", "items": [o for o in s.items(ns, resource) if selected(o, query.get("labelSelector"))]}
+            if method == "GET":
+                if name not in objs:
+                    return status(404, "NotFound", f'{resource} "{name}" not found')
+                return 200, objs[name]
+            if method in ("POST", "PATCH"):
+                name = name or body["metadata"]["name"]
+                if method == "POST" and name in objs:
+                    return status(409, "AlreadyExists", f'{resource} "{name}" already exists')
+                body.setdefault("metadata", {})["namespace"] = ns
+                if resource == "services":
+                    body.setdefault("spec", {}).setdefault("clusterIP", clusterIP)
+                created = name not in objs
+                objs[name] = body
+                return (201 if created else 200), body
+            if method == "DELETE" and not name:
+                gone = [n for n, o in objs.items() if selected(o, query.get("labelSelector"))]
+                return 200, {"kind": "List", "items": [objs.pop(n) for n in gone]}
+            if method == "DELETE":
+                if name not in objs:
+                    return status(404, "NotFound", f'{resource} "{name}" not found')
+                return 200, objs.pop(name)
+        return status(404, "NotFound", "the server could not find the requested resource")
+
+    def watch(self, rest, query):
+        # ADDED for the current objects, then the stream stays open until
+        # timeoutSeconds (capped) or the client goes away
+        ns, resource = rest[1], rest[2]
+        with self.store.lock:
+            items = self.store.items(ns, resource)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for item in items:
+                line = json.dumps({"type": "ADDED", "object": item}).encode() + b"\n"
+                self.wfile.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+            self.wfile.flush()
+            time.sleep(min(float(query.get("timeoutSeconds", 5)), 5))
+            self.wfile.write(b"0\r\n\r\n")
+        except OSError:
+            pass
+        self.close_connection = True
+
+def serve(port=0):
+    # Starts the server on a thread, returns (server, store)
+    store = Store()
+    handler = type("FakeKubeHandler", (Handler,), {"store": store})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, store
+
+def kubeconfig(server, path):
+    config = {
+        "apiVersion": "v1",
+        "kind": "Config",
+        "current-context": "fakekube",
+        "clusters": [{"name": "fakekube", "cluster": {"server": f"http://127.0.0.1:{server.server_address[1]}"}}],
+        "users": [{"name": "fakekube", "user": {"token": "fake"}}],
+        "contexts": [{"name": "fakekube", "context": {"cluster": "fakekube", "user": "fakekube"}}]
+    }
+    f = open(path, "w")
+    yaml.dump(config, f)
+    f.close()
+    return path
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 0
+    server, store = serve(port)
+    path = kubeconfig(server, f"/tmp/fakekube-{server.server_address[1]}.yaml")
+    print(f"export KUBECONFIG={path}")
+    try:
+        while True:
+            time.sleep(10)
+            print(f"{store.requests} requests on {store.connections} connections, {len(store.namespaces)} namespaces")
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -1,21 +1,43 @@
 import os
+import ast
 import json
 import time
-import urllib.request
 import re
-import time
+import yaml
 from ctl import *
 from log import log
 import datetime
+from concurrent.futures import ThreadPoolExecutor
 import schemas as sch
+import llm
+from llm import extractanswer
+from distill import distill
+import screen
+import fixmemo
 
-PHASE_RE = re.compile(r"^--Log:\s+(.*?)\s+--phase--\s*$")
-CTX_RE = re.compile(r"^--Log:\s+(.*?)\s+--([^-]+)--\s*$")
-DASH_LINE = re.compile(r"⁻-Log:")
+# patch: the model answers with search/replace edits, applied here, and the
+# full rewrite is only asked for when they do not apply. rewrite: always the
+# four files in full.
+fixMode = os.getenv("FIX_MODE", "patch")
 
-def finderror(outputfolder, model, txt, context=None, llmUrl = "localhost:11435"):
-    
-    rawlogfile = os.path.join(outputfolder, "kubevibe.rawlog")
+# Speculative FIX: FIX_CANDIDATES answers are asked for at once, with
+# different seeds and temperatures (and models, FIX_MODELS=a,b), screened
+# locally (screen.py) and the best one applied. The others are kept and
+# tried first by the next FIX if the same stage (or an earlier one) fails.
+candidates = int(os.getenv("FIX_CANDIDATES", "3"))
+temperatures = [float(t) for t in os.getenv("FIX_TEMPERATURES", "0.2,0.7,1.0").split(",")]
+models = [m for m in os.getenv("FIX_MODELS", "").split(",") if m]
+
+ORDER = ["GENERATE", "CHECK", "BUILD", "VALIDATE", "DEPLOY", "CONNECT", "CHART"]
+
+FILES = {
+    "myapp.py": "code",
+    "Dockerfile": "container",
+    "vibe.yaml": "manifest",
+    "requirements.txt": "requirements"
+}
+
+def fix_data(model, txt, context=None, patch=False, options=None):
 
     if context:
         txt = f"Context: {context}\nTask: {txt}"
@@ -29,26 +51,18 @@ def finderror(outputfolder, model, txt, context=None, llmUrl = "localhost:11435"
         "think": False
     }
 
-    data["format"] = sch.fix_schema()
+    data["format"] = sch.fix_patch_schema() if patch else sch.fix_schema()
+    if options:
+        data["options"] = options
 
-    dataserial = json.dumps(data)
-    databinary = dataserial.encode()
-    log(rawlogfile, f"Request for generate:\n{json.dumps(data, indent=3)}", "control")
+    return data
 
-    try:
-        f = urllib.request.urlopen(f"http://{llmUrl}/api/generate", databinary, timeout=300)
-        answerserial = f.read().decode()
-    except:
-        answerserial = None
+def finderror(outputfolder, model, txt, context=None, llmUrl = None, patch=False):
     
-    f = open(os.path.join(outputfolder, "kubevibe.rawlog"), "a")
-    print(f"--Log: {datetime.datetime.now()} --artifact-generation-- Raw request", file=f)
-    print(txt, file=f)
-    print(f"--Log: {datetime.datetime.now()} --artifact-generation-- Raw response", file=f)
-    print(answerserial, file=f)
-    f.close()
+    rawlogfile = os.path.join(outputfolder, "kubevibe.rawlog")
+    data = fix_data(model, txt, context, patch)
 
-    return answerserial
+    return llm.request(data, data["format"], rawlogfile, "fix", 300, llmUrl, "fix")
 
 def diff_json_strings(json1: dict, json2: dict) -> dict:
     """
@@ -67,12 +81,9 @@ def diff_json_strings(json1: dict, json2: dict) -> dict:
     return diffs
 
 
-def generateFixed(D):
-    model = D["model"]
-    outputfolder = D["outputfolder"]
-    ok = True
-    stage = D["node"]["stage"]
-    print(f"Error during {stage} with")
+def fix_prompt(D, patch=False):
+    # The stage that failed, also when a previous FIX changed nothing
+    stage = D.get("failed") or D["node"]["stage"]
 
     core = {
         "code" : D["node"]["code"]["content"],
@@ -105,44 +116,291 @@ vibe.yaml:
 --
 requirements.txt:
 {core['requirements']}
+--
+Failure evidence from the {stage} logs:
+{distill(core['logs']) or "(no logs)"}
 
 - Identify the single primary root cause tied to {stage}.
-- Edit only artifacts with the improved solution
+"""
+    if patch:
+        txt += """- Answer with edits: each names a file, an exact excerpt of its current content to change
+  ("search": whole lines, copied verbatim, found only once in the file) and the text replacing it ("replace")
+- An empty "search" replaces the whole file with "replace"
+- Leave files that need no change out of the edits
+"""
+    else:
+        txt += """- Edit only artifacts with the improved solution
 - If other artifact is not required to be fixed, dont write anything on their JSON slot
 """
-    #print(txt)
+    if D.get("noops"):
+        # The previous answers changed nothing: ask for another approach
+        txt += f"""
+- The last {D['noops']} fix attempt(s) changed none of the artifacts {stage} uses and the failure remains.
+  The root cause is not where it was looked for: take a different approach.
+"""
+
+    return core, txt
 
+def collect_fixes(core, ans):
+    # Artifacts whose new content differs from the current one. Short slots
+    # are the model's way of saying "unchanged".
     fixed = {
         "code": core["code"],
         "container": core["container"],
         "manifest": core["manifest"],
         "requirements": core["requirements"]
     }
-    diffs = {}
-        #time.sleep(1)
-        #print("+")
-    an = finderror(outputfolder, model, txt, None, "localhost:11434")
-    
-    if an:
-        ans = json.loads(json.loads(an)["response"])
-        newContainerfile = ans["Dockerfile"]
-        newYamlfile = ans["vibe.yaml"]
-        newCodefile = ans["myapp.py"]
-        newRequirements = ans["requirements.txt"]
-        maxNullSize = 50
-        if len(newContainerfile) > maxNullSize:
-            fixed["container"] = newContainerfile
-        if len(newYamlfile) > maxNullSize:
-            fixed["manifest"] = newYamlfile
-        if len(newCodefile) > maxNullSize:
-            fixed["code"] = newCodefile
-        if len(newRequirements) > maxNullSize:
-            fixed["requirements"] = newRequirements
-    
+
+    newContainerfile = ans["Dockerfile"]
+    newYamlfile = ans["vibe.yaml"]
+    newCodefile = ans["myapp.py"]
+    newRequirements = ans["requirements.txt"]
+    maxNullSize = 50
+    if len(newContainerfile) > maxNullSize:
+        fixed["container"] = newContainerfile
+    if len(newYamlfile) > maxNullSize:
+        fixed["manifest"] = newYamlfile
+    if len(newCodefile) > maxNullSize:
+        fixed["code"] = newCodefile
+    if len(newRequirements) > maxNullSize:
+        fixed["requirements"] = newRequirements
+
+    return diff_json_strings(core, fixed)
+
+def find_lines(text, search):
+    # (start, end) of the only run of lines of text equal to those of
+    # search but for surrounding whitespace, None if none or several
+    lines = text.splitlines(keepends=True)
+    want = [l.strip() for l in search.strip("\n").splitlines()]
+    if not want:
+        return None
+    found = []
+    for i in range(len(lines) - len(want) + 1):
+        if [l.strip() for l in lines[i:i + len(want)]] == want:
+            found.append(i)
+    if len(found) != 1:
+        return None
+    start = sum(len(l) for l in lines[:found[0]])
+    end = start + sum(len(l) for l in lines[found[0]:found[0] + len(want)])
+    # Keep the line break the excerpt ended without
+    if not search.endswith("\n") and lines[found[0] + len(want) - 1].endswith("\n"):
+        end -= 1
+    return start, end
+
+def parses(key, text):
+    try:
+        if key == "code":
+            ast.parse(text)
+        elif key == "manifest":
+            list(yaml.safe_load_all(text))
+    except (SyntaxError, ValueError, yaml.YAMLError):
+        return False
+    return True
+
+def apply_edits(core, edits):
+    # Applies search/replace edits to the artifacts. Returns (artifacts,
+    # errors); with errors the patch is not to be used.
+    fixed = {key: core[key] or "" for key in FILES.values()}
+    errors = []
+    for i, edit in enumerate(edits):
+        if not isinstance(edit, dict):
+            errors.append(f"edit {i}: not an object: {edit!r}")
+            continue
+        name = edit.get("file")
+        key = FILES.get(name) if isinstance(name, str) else None
+        search, replace = edit.get("search") or "", edit.get("replace") or ""
+        if key is None:
+            errors.append(f"edit {i}: unknown file {name}")
+            continue
+        if not isinstance(search, str) or not isinstance(replace, str):
+            errors.append(f"edit {i}: search and replace must be strings")
+            continue
+        if not search:
+            # Whole file; an empty one would wipe the artifact
+            if not replace.strip():
+                errors.append(f"edit {i}: empty search and empty replace for {name}")
+                continue
+            fixed[key] = replace
+            continue
+        # Whole lines as given, whole lines but for indentation and
+        # trailing blanks (models get those wrong), then anywhere
+        text = fixed[key]
+        starts = [m.start() for m in re.finditer(re.escape(search), text)]
+        lined = [p for p in starts if p == 0 or text[p - 1] == "\n"]
+        if len(lined) == 1:
+            span = (lined[0], lined[0] + len(search))
+        else:
+            span = find_lines(text, search) if not lined else None
+            if span is None and len(starts) == 1:
+                span = (starts[0], starts[0] + len(search))
+        if span is None:
+            errors.append(f"edit {i}: search text found {len(starts)} times in {name}" if starts else f"edit {i}: search text not found in {name}")
+            continue
+        fixed[key] = text[:span[0]] + replace + text[span[1]:]
+    # Whatever parsed before must still parse
+    for key in ("code", "manifest"):
+        if fixed[key] != (core[key] or "") and parses(key, core[key] or "") and not parses(key, fixed[key]):
+            errors.append(f"{key} no longer parses after the edits")
+    return fixed, errors
+
+def collect_patch(core, ans, rawlogfile=None):
+    # Artifacts changed by the edits of ans, None when they do not apply
+    fixed, errors = apply_edits(core, ans.get("edits") or [])
+    if errors:
+        if rawlogfile:
+            log(rawlogfile, "\n".join(errors) + "\nfalling back to a full rewrite", "fix:patch")
+        return None
+    return diff_json_strings(core, fixed)
+
+def candidate_requests(D, txt, patch=False, n=None):
+    # Request payloads of the candidates; the first one is the plain request
+    n = candidates if n is None else n
+    out = []
+    for i in range(max(1, n)):
+        model = models[i % len(models)] if models else D["model"]
+        options = {"seed": i, "temperature": temperatures[(i - 1) % len(temperatures)]} if i else None
+        out.append(fix_data(model, txt, patch=patch, options=options))
+    return out
+
+def candidate_fixes(core, answers, patch, rawlogfile=None):
+    # Fixes of each answer: {} when the model gave none, None when its
+    # patch did not apply
+    out = []
+    for answer in answers:
+        ans = extractanswer(answer)
+        if not ans:
+            out.append({})
+        elif patch:
+            out.append(collect_patch(core, ans, rawlogfile))
+        else:
+            out.append(collect_fixes(core, ans))
+    return out
+
+def artifacts(core, fixes=None):
+    out = {key: core[key] for key in FILES.values()}
+    for key in fixes or {}:
+        out[key] = fixes[key]["json2"]
+    return out
+
+def choose(D, core, results, rawlogfile=None):
+    # Fixes of the best screened candidate; the runners-up become spares
+    # for the next FIX
+    results = [r for r in results if r is not None]
+    if len(results) < 2:
+        D["spares"] = None
+        return results[0] if results else {}
+    base = artifacts(core)
+    ranked = screen.rank(base, [artifacts(core, r) for r in results])
+    if rawlogfile:
+        log(rawlogfile, screen.report(ranked), "fix:screen")
+    spares = [a for a, problems in ranked[1:] if a != base]
+    D["spares"] = {"stage": D.get("failed") or D["node"]["stage"], "candidates": spares} if spares else None
+    return diff_json_strings(core, ranked[0][0])
+
+def take_spare(D):
+    # Fixes turning the artifacts into the next kept candidate, when the
+    # stage it was made for (or an earlier one) failed again; None otherwise
+    spares = D.get("spares")
+    if not spares:
+        return None
+    stage = D.get("failed") or D["node"]["stage"]
+    # The applied candidate got further: the others are not worth a try
+    if stage not in ORDER or ORDER.index(stage) > ORDER.index(spares["stage"]):
+        D["spares"] = None
+        return None
+    spare = spares["candidates"].pop(0)
+    if not spares["candidates"]:
+        D["spares"] = None
+    core = {key: D["node"][key]["content"] for key in FILES.values()}
+    return diff_json_strings(core, spare)
+
+def recall(D, rawlogfile=None):
+    # Fixes memoized for the current failure (fixmemo.py) that apply to the
+    # artifacts and were not tried in this run yet; None without any
+    if not fixmemo.enabled:
+        return None
+    stage = D.get("failed") or D["node"]["stage"]
+    core = {key: D["node"][key]["content"] or "" for key in FILES.values()}
+    k, text, found = fixmemo.patches(stage, D["node"]["logs"])
+    tried = D.setdefault("memotried", [])
+    for edits in found:
+        pid = fixmemo.patch_id(edits)
+        # Whole-file edits only fill files that are empty
+        if pid in tried or any(not e["search"] and core.get(FILES.get(e["file"])) for e in edits):
+            continue
+        fixed, errors = apply_edits(core, edits)
         diffs = diff_json_strings(core, fixed)
-        #print(diffs)
-    else:
-        ok = True #False. We let this like this to allow direct retry
+        if not errors and diffs:
+            tried.append(pid)
+            fixmemo.count("hit", rawlogfile, k)
+            fixmemo.remember(D, diffs, True, edits)
+            return diffs
+    fixmemo.count("miss", rawlogfile, k)
+    return None
+
+def known_fix(D, rawlogfile=None):
+    # A fix that needs no model: memoized for this failure, else a candidate
+    # kept by the previous FIX
+    diffs = recall(D, rawlogfile)
+    if diffs:
+        log(rawlogfile, f"applying a memoized fix ({', '.join(diffs)})", "fix-memo")
+        return diffs
+    diffs = take_spare(D)
+    if diffs:
+        log(rawlogfile, f"trying a candidate kept from the previous FIX ({', '.join(diffs)})", "fix:screen")
+        fixmemo.remember(D, diffs)
+    return diffs
+
+def plan_fix(D, rawlogfile=None):
+    # Work of a FIX before the model: (fix, None) when one is known, else
+    # (None, plan) with the candidate requests to send. Both engines send
+    # them their own way, then go on with choose_fix.
+    diffs = known_fix(D, rawlogfile)
+    if diffs:
+        return diffs, None
+    patch = fixMode == "patch"
+    core, txt = fix_prompt(D, patch)
+    return None, {"core": core, "patch": patch, "requests": candidate_requests(D, txt, patch)}
+
+def choose_fix(D, plan, answers, rawlogfile=None):
+    # Fix chosen among the answers to plan["requests"]. None when a full
+    # rewrite is needed: plan["rewrite"] is then the request for rewrite_fix
+    results = candidate_fixes(plan["core"], answers, plan["patch"], rawlogfile)
+    diffs = None
+    if not plan["patch"] or any(r is not None for r in results):
+        diffs = choose(D, plan["core"], results, rawlogfile)
+    if diffs is None:
+        plan["core"], txt = fix_prompt(D)
+        plan["rewrite"] = fix_data(D["model"], txt)
+    elif diffs:
+        fixmemo.remember(D, diffs)
+    return diffs
+
+def rewrite_fix(D, plan, answer):
+    ans = extractanswer(answer)
+    diffs = collect_fixes(plan["core"], ans) if ans else {}
+    if diffs:
+        fixmemo.remember(D, diffs)
+    return diffs
+
+def generateFixed(D):
+    outputfolder = D["outputfolder"]
+    rawlogfile = os.path.join(outputfolder, "kubevibe.rawlog")
+    ok = True #False. We let this like this to allow direct retry
+    stage = D["node"]["stage"]
+    print(f"Error during {stage} with")
+
+    diffs, plan = plan_fix(D, rawlogfile)
+    if plan is None:
+        return diffs, ok
+
+    requests = plan["requests"]
+    with ThreadPoolExecutor(max_workers=len(requests)) as pool:
+        answers = list(pool.map(lambda data: llm.request(data, data["format"], rawlogfile, "fix", 300, None, "fix"), requests))
+    diffs = choose_fix(D, plan, answers, rawlogfile)
+    if diffs is None:
+        data = plan["rewrite"]
+        diffs = rewrite_fix(D, plan, llm.request(data, data["format"], rawlogfile, "fix", 300, None, "fix"))
     
     #if len(diffs) == 0:
     #    ok = False
@@ -224,7 +482,7 @@ if __name__ == "__main__":
     #for i in lines:
     #    print(i)
 
-    #print(PHASE_RE.match("--Log: 2025-10-23 16:04:16.036003 --phase--"))
+    #print(distill(logs))
 
     print(json.dumps(D, indent=4))
 
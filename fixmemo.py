@@ -0,0 +1,196 @@
+# KubeVibe
+# Failure-signature memo for FIX
+#
+# The same failures come back run after run: EXPOSE typos, exec-form CMD
+# with single quotes, flask missing from requirements.txt, targetPort
+# mismatches. With FIX_MEMO=1 every fix that got the pipeline past the
+# stage it was made for is stored, as line edits, under the signature of
+# the failure: the stage plus its distilled logs, with timestamps,
+# addresses, hashes and durations blanked out. The next FIX with the same
+# signature tries those edits first, best record first, and only asks the
+# model when none of them applies.
+#
+#   python3 fixmemo.py        entries and their win rates
+
+import os
+import re
+import json
+import fcntl
+import difflib
+import hashlib
+import tempfile
+import threading
+from log import log
+from distill import distill
+
+enabled = bool(int(os.getenv("FIX_MEMO", "0")))
+memoDir = os.path.expanduser(os.getenv("FIX_MEMO_DIR", "~/.cache/kubevibe/fixmemo"))
+# Patches kept per signature, the ones with the worst record go first
+maxPatches = int(os.getenv("FIX_MEMO_PATCHES", "5"))
+
+FILES = {
+    "myapp.py": "code",
+    "Dockerfile": "container",
+    "vibe.yaml": "manifest",
+    "requirements.txt": "requirements"
+}
+
+VOLATILE = [
+    (re.compile(r"\d{4}-\d\d-\d\d[ T]\d\d:\d\d:\d\d(\.\d+)?"), "<time>"),
+    (re.compile(r"\b\d{1,3}(\.\d{1,3}){3}\b"), "<ip>"),
+    (re.compile(r"\b(sha256:)?[0-9a-f]{12,64}\b"), "<hash>"),
+    (re.compile(r"\b\d+(\.\d+)?\s?(ms|s)\b"), "<time>"),
+    (re.compile(r"\bvibe-[a-z0-9-]+"), "<namespace>"),
+    (re.compile(r"^#\d+ (\d+\.\d+ )?", re.M), "#"),
+    (re.compile(r" \(x\d+\)$", re.M), ""),
+]
+
+counters = {"hit": 0, "miss": 0, "store": 0, "win": 0}
+_lock = threading.Lock()
+
+def normalize(text):
+    for pattern, repl in VOLATILE:
+        text = pattern.sub(repl, text)
+    return text.strip()
+
+def signature(stage, logs):
+    # (key, normalized failure text)
+    text = f"{stage}\n{normalize(distill(logs))}"
+    return hashlib.sha256(text.encode()).hexdigest(), text
+
+def path(k):
+    return os.path.join(memoDir, k[:2], f"{k}.json")
+
+def count(event, rawlogfile=None, k=""):
+    with _lock:
+        counters[event] += 1
+        c = dict(counters)
+    if rawlogfile:
+        log(rawlogfile, f"{event} {k[:16]} (hits {c['hit']}, misses {c['miss']}, stored {c['store']}, wins {c['win']})", "fix-memo")
+
+def patch_id(edits):
+    return hashlib.sha256(json.dumps(edits, sort_keys=True).encode()).hexdigest()[:16]
+
+def score(patch):
+    # Wins over tries, smoothed so one lucky try does not beat a long record
+    return (patch["wins"] + 1) / (patch["tries"] + 2)
+
+def load(k):
+    try:
+        with open(path(k)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def patches(stage, logs):
+    # (key, signature text, [edits] best first) of a failure
+    k, text = signature(stage, logs)
+    entry = load(k) if enabled else None
+    found = sorted(entry["patches"], key=score, reverse=True) if entry else []
+    return k, text, [p["edits"] for p in found]
+
+def unique(text, search):
+    # search occurs once in text, overlapping occurrences counted
+    return bool(search) and len(re.findall(f"(?={re.escape(search)})", text)) == 1
+
+def edits_from(diffs):
+    # Line edits turning json1 into json2 for every changed artifact. An
+    # edit takes unchanged lines around it (a pure insertion at least one)
+    # until its search text occurs once in the file; when no context makes
+    # it unique the fix is not memoized. A file that was empty is replaced
+    # whole (search "").
+    names = {key: name for name, key in FILES.items()}
+    edits = []
+    for key, d in diffs.items():
+        old, new = d["json1"] or "", d["json2"] or ""
+        if not old.strip():
+            edits.append({"file": names[key], "search": "", "replace": new})
+            continue
+        a, b = old.splitlines(keepends=True), new.splitlines(keepends=True)
+        ops = [o for o in difflib.SequenceMatcher(None, a, b, autojunk=False).get_opcodes() if o[0] != "equal"]
+        for n, (op, i1, i2, j1, j2) in enumerate(ops):
+            # Context stops at the neighbouring edits, which change it
+            lo = ops[n - 1][2] if n else 0
+            hi = ops[n + 1][1] if n + 1 < len(ops) else len(a)
+            before = True
+            while not unique(old, "".join(a[i1:i2])):
+                if before and i1 > lo:
+                    i1, j1 = i1 - 1, j1 - 1
+                elif i2 < hi:
+                    i2, j2 = i2 + 1, j2 + 1
+                elif i1 > lo:
+                    i1, j1 = i1 - 1, j1 - 1
+                else:
+                    return []
+                before = not before
+            edits.append({"file": names[key], "search": "".join(a[i1:i2]), "replace": "".join(b[j1:j2])})
+    return edits
+
+def record(k, text, edits, won, rawlogfile=None):
+    # One more try (and maybe win) for edits under signature k
+    if not enabled or not edits:
+        return
+    os.makedirs(memoDir, exist_ok=True)
+    with open(os.path.join(memoDir, ".lock"), "w") as lockf:
+        fcntl.flock(lockf, fcntl.LOCK_EX)
+        entry = load(k) or {"signature": text, "patches": []}
+        pid = patch_id(edits)
+        patch = next((p for p in entry["patches"] if patch_id(p["edits"]) == pid), None)
+        if patch is None:
+            if not won:
+                return
+            patch = {"edits": edits, "wins": 0, "tries": 0}
+            entry["patches"].append(patch)
+            count("store", rawlogfile, k)
+        patch["tries"] += 1
+        patch["wins"] += int(won)
+        entry["patches"] = sorted(entry["patches"], key=score, reverse=True)[:maxPatches]
+        target = path(k)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # Write-then-rename so concurrent readers never see a partial entry
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(target), suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(entry, f, indent=1)
+        os.replace(tmp, target)
+
+def remember(D, diffs, memoized=False, edits=None):
+    # The fix just applied waits for the stage it was made for. A fix still
+    # waiting when the next FIX comes did not work.
+    if not enabled:
+        return
+    settle(D, None, False)
+    stage = D.get("failed") or D["node"]["stage"]
+    k, text = signature(stage, D["node"]["logs"])
+    edits = edits if edits is not None else edits_from(diffs)
+    if edits:
+        D["memo"] = {"key": k, "signature": text, "stage": stage, "edits": edits, "memoized": memoized}
+
+def settle(D, stage, success):
+    # Outcome of the waiting fix once its stage ran again (stage None: a
+    # new FIX came first)
+    pending = D.get("memo")
+    if not pending or stage not in (None, pending["stage"]):
+        return
+    D["memo"] = None
+    won = bool(success) and stage is not None
+    rawlogfile = os.path.join(D["outputfolder"], D["logfile"])
+    if won and pending["memoized"]:
+        count("win", rawlogfile, pending["key"])
+    record(pending["key"], pending["signature"], pending["edits"], won, rawlogfile)
+
+def stats():
+    with _lock:
+        return dict(counters)
+
+if __name__ == "__main__":
+    for root, dirs, files in os.walk(memoDir):
+        for name in sorted(files):
+            if not name.endswith(".json"):
+                continue
+            entry = load(name[:-5])
+            if not entry:
+                continue
+            print(f"{name[:16]}  {entry['signature'].splitlines()[0]}: {entry['signature'].splitlines()[-1][:80]}")
+            for p in entry["patches"]:
+                touched = ", ".join(sorted({e["file"] for e in p["edits"]}))
+                print(f"    {p['wins']}/{p['tries']} won  {touched}")
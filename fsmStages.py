@@ -1,7 +1,18 @@
+import os
+import hashlib
+
+# Static cross-artifact check between GENERATE/FIX and BUILD (check.py)
+checkstage = bool(int(os.getenv("CHECK_STAGE", "1")))
+# After a FIX, re-enter at the first stage whose inputs changed and reuse
+# the result of stages whose inputs did not (FIX_REENTRY=0: always CHECK)
+reentryfix = bool(int(os.getenv("FIX_REENTRY", "1")))
+# Consecutive fixes that change nothing before regenerating from scratch
+noopLimit = int(os.getenv("FIX_NOOP_LIMIT", "2"))
 
 stages = [
     #"START",
     "GENERATE",
+    "CHECK",
     "BUILD",
     "VALIDATE",
     "DEPLOY",
@@ -13,7 +24,8 @@ stages = [
 ]
 
 NEXT_ON_SUCCESS = {
-    "GENERATE": "BUILD",
+    "GENERATE": "CHECK",
+    "CHECK": "BUILD",
     "BUILD": "VALIDATE",
     "VALIDATE": "DEPLOY",
     "DEPLOY": "CONNECT",
@@ -23,6 +35,7 @@ NEXT_ON_SUCCESS = {
 
 NEXT_ON_FAIL = {
     "GENERATE": "FIX",
+    "CHECK": "FIX",
     "BUILD": "FIX",
     "VALIDATE": "FIX",
     "DEPLOY": "FIX",
@@ -33,19 +46,23 @@ NEXT_ON_FAIL = {
 
 actions = {
     ("START", 1): "GENERATE",
-    ("GENERATE", 1): "BUILD",
+    ("GENERATE", 1): "CHECK",
+    ("CHECK", 1): "BUILD",
     ("BUILD", 1): "VALIDATE",
     ("VALIDATE", 1): "DEPLOY",
     ("DEPLOY", 1): "CONNECT",
     ("CONNECT", 1): "CHART",
     ("CHART", 1): "SUCCESS",
+    ("FIX", 1): "CHECK",
     ("FIX", 1): "BUILD",
     ("FIX", 1): "VALIDATE",
     ("FIX", 1): "DEPLOY",
     ("FIX", 1): "CONNECT",
     ("FIX", 1): "CHART",
+    ("FIX", 1): "GENERATE",
     ("FIX", 0): "FIX",
     ("GENERATE", 0): "FIX",
+    ("CHECK", 0): "FIX",
     ("BUILD", 0): "FIX",
     ("VALIDATE", 0): "FIX",
     ("DEPLOY", 0): "FIX",
@@ -54,3 +71,69 @@ actions = {
     ("FIX", 0): "FAIL"
 }
 
+# Artifacts of D["node"] each stage reads. The manifest BUILD writes is
+# refreshed by FIX, so BUILD only depends on what goes into the image.
+PIPELINE = ["CHECK", "BUILD", "VALIDATE", "DEPLOY", "CONNECT", "CHART"]
+ARTIFACTS = ("code", "container", "manifest", "requirements")
+INPUTS = {
+    "CHECK": ARTIFACTS,
+    "BUILD": ("code", "container", "requirements"),
+    "VALIDATE": ("manifest",),
+    "DEPLOY": ARTIFACTS,
+    "CONNECT": ARTIFACTS,
+    "CHART": ("manifest",)
+}
+# Stages whose result only depends on their inputs (no cluster involved)
+CACHEABLE = ("CHECK", "BUILD", "VALIDATE")
+
+def digest(node, stage):
+    h = hashlib.sha256()
+    for key in INPUTS[stage]:
+        data = (node[key].get("content") or "").encode()
+        h.update(f"{key}:{len(data)}:".encode() + data)
+    return h.hexdigest()
+
+def reentry(failed, changed):
+    # Earliest stage reading a changed artifact, and never past the stage
+    # that failed: the ones before it passed with the same inputs
+    order = [s for s in PIPELINE if checkstage or s != "CHECK"]
+    limit = order.index(failed) if failed in order else 0
+    for s in order[:limit]:
+        if set(INPUTS[s]) & set(changed):
+            return s
+    return order[limit]
+
+def effective(failed, changed):
+    # What a fix changed that can change the outcome. A fix leaving the
+    # inputs of the failed stage alone (a manifest fix for a failed BUILD)
+    # would only run it again on the same inputs, after whatever earlier
+    # stage reads what it touched: it counts as a fix that changed
+    # nothing ([]).
+    if not changed or failed not in INPUTS:
+        return changed
+    if not set(INPUTS[failed]) & set(changed):
+        return []
+    return changed
+
+def next_stage(stage, success, fixfromzero=False, changed=None, failed=None, noops=0):
+    # changed: artifacts the FIX rewrote (None: unknown), failed: the stage
+    # that sent the FSM to FIX, noops: fixes in a row that changed nothing
+    if stage == "FIX":
+        if not success:
+            return NEXT_ON_FAIL.get("FIX", "FIX")
+        if fixfromzero:
+            nxt = "GENERATE"
+        elif changed is None or not reentryfix:
+            nxt = "CHECK"
+        elif not changed:
+            # Nothing to run again: another FIX, or start over
+            return "GENERATE" if noops >= noopLimit else "FIX"
+        else:
+            nxt = reentry(failed, changed)
+    elif success:
+        nxt = NEXT_ON_SUCCESS[stage]
+    else:
+        nxt = "GENERATE" if fixfromzero else NEXT_ON_FAIL[stage]
+    if nxt == "CHECK" and not checkstage:
+        return "BUILD"
+    return nxt
@@ -1,16 +1,12 @@
 # KubeVibe
 # Stage 1 - GENERATE
 
-import json
 import os
-import datetime
-import urllib.request
 import schemas as sch
-from log import log
+import llm
+from llm import extractanswer
 
-def generate(outputfolder, model, txt, context=None, llmUrl = "localhost:11435"):
-    
-    rawlogfile = os.path.join(outputfolder, "kubevibe.rawlog")
+def generation_request(model, txt, context=None):
 
     if context:
         txt = f"Context: {context}\nTask: {txt}"
@@ -26,37 +22,14 @@ def generate(outputfolder, model, txt, context=None, llmUrl = "localhost:11435")
 
     data["format"] = sch.artifacts_schema()
 
-    dataserial = json.dumps(data)
-    databinary = dataserial.encode()
-    log(rawlogfile, f"Request for generate:\n{json.dumps(data, indent=3)}", "control")
+    return data
 
-    try:
-        f = urllib.request.urlopen(f"http://{llmUrl}/api/generate", databinary, timeout=300)
-        answerserial = f.read().decode()
-    except:
-        answerserial = None
-    
-    f = open(os.path.join(outputfolder, "kubevibe.rawlog"), "a")
-    print(f"--Log: {datetime.datetime.now()} --artifact-generation-- Raw request", file=f)
-    print(txt, file=f)
-    print(f"--Log: {datetime.datetime.now()} --artifact-generation-- Raw response", file=f)
-    print(answerserial, file=f)
-    f.close()
-
-    return answerserial
-
-def extractanswer(answerserial):
-    if answerserial:
-        answer = json.loads(answerserial)
-        responseserial = answer["response"]
-        try:
-            response = json.loads(responseserial)
-        except:
-            response = None
-    else:
-        response = None
+def generate(outputfolder, model, txt, context=None, llmUrl = None):
     
-    return response
+    rawlogfile = os.path.join(outputfolder, "kubevibe.rawlog")
+    data = generation_request(model, txt, context)
+
+    return llm.request(data, data["format"], rawlogfile, "artifact-generation", 300, llmUrl, "generate")
 
 if __name__ == "__main__":
     txt = "develop a credit card checker service"
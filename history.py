@@ -0,0 +1,144 @@
+# KubeVibe
+# FSM history
+#
+# tvibe and atvibe record the node after every step. A FIX loop goes
+# through many nodes that share most of their content, so a step is not
+# kept as a copy: every long string of the node (artifact contents, logs)
+# is stored once as an immutable version addressed by its sha256, and the
+# step itself is a delta (delta.py) of the node's skeleton, with the
+# versions replaced by their hashes, against the previous step. Every
+# HISTORY_KEYFRAME steps the skeleton is kept whole, so rebuilding a step
+# applies a few deltas at most. Versions beyond HISTORY_MEMORY_MB go to
+# disk, the oldest first (HISTORY_SPILL=0 keeps everything in memory).
+#
+#   history[i]        node of step i, rebuilt, as it was at that step
+
+import os
+import hashlib
+import collections
+import delta
+
+memoryBudget = int(float(os.getenv("HISTORY_MEMORY_MB", "32")) * 1024 * 1024)
+spill = bool(int(os.getenv("HISTORY_SPILL", "1")))
+keyframeEvery = int(os.getenv("HISTORY_KEYFRAME", "16"))
+
+# Strings at least this long are stored as versions
+VERSION_MIN = 256
+REF = "$version"
+
+class History:
+
+    def __init__(self, spilldir=None):
+        self.versions = collections.OrderedDict()  # hash -> text, oldest first
+        self.spilled = set()
+        self.spilldir = spilldir if spill else None
+        self.steps = []  # skeletons (keyframes) or deltas
+        self.last = None
+        self.memory = 0
+        self.logical = 0
+
+    def put(self, text):
+        k = hashlib.sha256(text.encode()).hexdigest()
+        self.logical += len(text)
+        if k in self.versions:
+            self.versions.move_to_end(k)
+        elif k not in self.spilled:
+            self.versions[k] = text
+            self.memory += len(text)
+            self.evict()
+        return {REF: k}
+
+    def evict(self):
+        # Oldest versions to disk until under budget; the newest stays
+        while self.spilldir and self.memory > memoryBudget and len(self.versions) > 1:
+            k, text = self.versions.popitem(last=False)
+            os.makedirs(self.spilldir, exist_ok=True)
+            f = open(os.path.join(self.spilldir, k), "w")
+            f.write(text)
+            f.close()
+            self.spilled.add(k)
+            self.memory -= len(text)
+
+    def get(self, k):
+        if k in self.versions:
+            return self.versions[k]
+        f = open(os.path.join(self.spilldir, k))
+        text = f.read()
+        f.close()
+        return text
+
+    def skeleton(self, value):
+        # value with its long strings replaced by version references
+        if isinstance(value, dict):
+            return {key: self.skeleton(v) for key, v in value.items()}
+        if isinstance(value, list):
+            return [self.skeleton(v) for v in value]
+        if isinstance(value, str) and len(value) >= VERSION_MIN:
+            return self.put(value)
+        return value
+
+    def resolve(self, value):
+        if isinstance(value, dict):
+            if len(value) == 1 and REF in value:
+                return self.get(value[REF])
+            return {key: self.resolve(v) for key, v in value.items()}
+        if isinstance(value, list):
+            return [self.resolve(v) for v in value]
+        return value
+
+    def append(self, node):
+        # Records node as the next step, by value: later changes to node
+        # do not reach the history
+        sk = self.skeleton(node)
+        if len(self.steps) % keyframeEvery == 0:
+            self.steps.append(sk)
+        else:
+            self.steps.append(delta.delta(self.last, sk))
+        self.last = sk
+        return len(self.steps) - 1
+
+    def node(self, i):
+        i = range(len(self.steps))[i]
+        k = i - i % keyframeEvery
+        sk = self.steps[k]
+        for ops in self.steps[k + 1:i + 1]:
+            sk = delta.apply(sk, ops)
+        return self.resolve(sk)
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.node(j) for j in range(len(self.steps))[i]]
+        return self.node(i)
+
+    def __iter__(self):
+        return (self.node(i) for i in range(len(self.steps)))
+
+    def stats(self):
+        return {
+            "steps": len(self.steps),
+            "versions": len(self.versions) + len(self.spilled),
+            "spilled": len(self.spilled),
+            "memory": self.memory,
+            "logical": self.logical
+        }
+
+if __name__ == "__main__":
+    import json
+    import tempfile
+    memoryBudget = 4096
+    code = "".join(f"print({i})\n" for i in range(100))
+    h = History(tempfile.mkdtemp())
+    node = {"code": {"file": "myapp.py", "content": code}, "stage": "", "logs": ""}
+    nodes = []
+    for step in range(40):
+        node["stage"] = ["CHECK", "BUILD", "FIX"][step % 3]
+        node["logs"] = f"step {step}\n" * 40
+        if node["stage"] == "FIX":
+            node["code"]["content"] += f"print('fix {step}')\n"
+        h.append(node)
+        nodes.append(json.loads(json.dumps(node)))
+    print(json.dumps(h.stats()))
+    print(f"rebuilt exactly: {all(h[i] == nodes[i] for i in range(len(h)))}")
@@ -1,46 +1,35 @@
 import json
-import urllib.request
 import time 
 import sys
 import os
-import subprocess
 from json_to_verb import dict_to_text
 from ctl import *
 from log import *
 import schemas2 as sch
 import prompts as pts
+import llm
 
-llmUrl = "localhost:11434"
+llmUrl = llm.llmUrl
 
 # Receives a curated intent to charge few-shot prompting through examples
 
-def deployment_to_text(bankpath, deployment_name, pythonfile="myapp.py", containerfile="Dockerfile", yamlfile="vibe.yaml"):
-    origdir = os.getcwd()
-    #print(origdir)
-    os.chdir(bankpath)
+def read_bank_file(bankpath, deployment_name, name):
+    # Returns (ok, content). Paths are joined, never chdir'd into: curation
+    # runs on worker threads of akubevibe.py next to other runs.
+    try:
+        f = open(os.path.join(bankpath, deployment_name, name))
+        content = f.read()
+        f.close()
+        return True, content
+    except OSError as e:
+        return False, str(e)
 
+def deployment_to_text(bankpath, deployment_name, pythonfile="myapp.py", containerfile="Dockerfile", yamlfile="vibe.yaml"):
     shot_string = f"Deployment: {deployment_name}\n" # String to construct by iteration
-    pythonfile = pythonfile
-    containerfile = containerfile
-    yamlfile = yamlfile
-
-    preret1 = True
-    p1 = subprocess.run(f"cat {deployment_name}/{pythonfile}", shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    if p1.returncode != 0:
-        preret1 = False
-    pythonfilecontent = p1.stdout.decode()
-
-    preret2 = True
-    p2 = subprocess.run(f"cat {deployment_name}/{containerfile}", shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    if p2.returncode != 0:
-        preret2 = False
-    containerfilecontent = p2.stdout.decode()
-
-    preret3 = True
-    p3 = subprocess.run(f"cat {deployment_name}/{yamlfile}", shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    if p3.returncode != 0:
-        preret3 = False
-    yamlfilecontent = p3.stdout.decode()
+
+    preret1, pythonfilecontent = read_bank_file(bankpath, deployment_name, pythonfile)
+    preret2, containerfilecontent = read_bank_file(bankpath, deployment_name, containerfile)
+    preret3, yamlfilecontent = read_bank_file(bankpath, deployment_name, yamlfile)
 
     if (preret1 and preret2 and preret3):        
         shot_string = shot_string + f"{pythonfile}:\n{pythonfilecontent}\n\n{containerfile}:\n{containerfilecontent}\n\n{yamlfile}:\n{yamlfilecontent}\n"
@@ -58,7 +47,6 @@ def charge_few_shot(rawlogfile, intent, n=2):
     # the user requests, and based on that we should be able to separate a set of reference deployments for it
     # currently we will just use the predefined path from the results of the previous experiment and the already known names
 
-    origdir = os.getcwd()
     bankpath = "results/qwen3:14b"
     deployments = ["1"]
     
@@ -71,7 +59,6 @@ def charge_few_shot(rawlogfile, intent, n=2):
         #print(deploystring)
         charged_intent = charged_intent + deploystring
     
-    os.chdir(origdir)
     log(rawlogfile, f"Few-shot charged with {deployments} from {bankpath}", "intent-extraction")
 
     return charged_intent, True
@@ -137,21 +124,11 @@ def curate(rawlogfile, coreintent, method, model):
         print("Method not recognized")
         return None, True
 
-    dataserial = json.dumps(data)
-    databinary = dataserial.encode()
-
-    log(rawlogfile, f"Request for curating:\n{json.dumps(data, indent=4)}", "control")
-
-    try:
-        f = urllib.request.urlopen(f"http://{llmUrl}/api/generate", databinary, timeout=90)
-        answerserial = f.read().decode()
-    except:
-        answerserial = None
+    outer = llm.request(data, None, rawlogfile, "curating", 90, llmUrl, "curate")
     
-    if not answerserial:
+    if not outer:
         return None, False
     
-    outer = json.loads(answerserial)
     curatedintent = outer.get("response", "")
 
     return curatedintent, True
@@ -193,21 +170,12 @@ def judge(rawlogfile, coreintent, method, model, hands_free=True):
                 "retry"
             ]
         data["format"] = schema
-        dataserial = json.dumps(data)
-        databinary = dataserial.encode()
-
-        log(rawlogfile, f"Request for judge\n{json.dumps(data, indent=4)}", "control")
 
-        try:
-            f = urllib.request.urlopen(f"http://{llmUrl}/api/generate", databinary, timeout=90)
-            answerserial = f.read().decode()
-        except:
-            answerserial = None
+        outer = llm.request(data, None, rawlogfile, "judge", 90, llmUrl, "judge")
         
-        if not answerserial:
+        if not outer:
             return None, False
 
-        outer = json.loads(answerserial)
         grade = outer.get("response", "")
 
         grade = json.loads(grade)
@@ -0,0 +1,203 @@
+# KubeVibe
+# Incremental JSON parser used to validate streamed structured outputs
+
+import re
+
+NUMBER_RE = re.compile(r"-?(0|[1-9][0-9]*)(\.[0-9]+)?([eE][+-]?[0-9]+)?$")
+NUMBER_CHARS = set("0123456789+-.eE")
+LITERALS = ("true", "false", "null")
+WHITESPACE = " \t\n\r"
+ESCAPES = set('"\\/bfnrtu')
+HEX = set("0123456789abcdefABCDEF")
+
+class StreamError(Exception):
+    pass
+
+def kind_of(c):
+    if c == '"':
+        return "string"
+    if c == "{":
+        return "object"
+    if c == "[":
+        return "array"
+    if c == "-" or c.isdigit():
+        return "number"
+    if c in "tf":
+        return "boolean"
+    if c == "n":
+        return "null"
+    return None
+
+def accepts(schema, kind):
+    if not schema or "type" not in schema:
+        return True
+    types = schema["type"]
+    if isinstance(types, str):
+        types = [types]
+    if kind == "number" and "integer" in types:
+        return True
+    return kind in types
+
+class JSONStream:
+    """
+    Feeds JSON text chunk by chunk and raises StreamError as soon as the
+    document can no longer be valid: syntax errors, values of the wrong type,
+    keys not declared in the schema, duplicated keys, missing required keys
+    when an object closes, or a string growing beyond maxfield characters.
+    String values are not kept, only their length, so memory stays flat.
+    """
+
+    def __init__(self, schema=None, maxfield=65536):
+        self.maxfield = maxfield
+        self.stack = []
+        self.expect = "value"     # value, key, key_or_end, value_or_end, colon, comma_or_end, end
+        self.schema = schema      # schema of the next value
+        self.string = None        # None or the length of the string being read
+        self.key = None           # characters of the key being read
+        self.escape = 0           # 1 after '\', 2..5 while reading \uXXXX
+        self.literal = None
+        self.pos = 0
+        self.done = False
+
+    def fail(self, msg):
+        raise StreamError(f"{msg} at offset {self.pos}")
+
+    def feed(self, text):
+        for c in text:
+            self.step(c)
+            self.pos += 1
+
+    def step(self, c):
+        if self.string is not None:
+            return self.step_string(c)
+        if self.literal is not None:
+            if c in NUMBER_CHARS or c.isalpha():
+                self.literal += c
+                if self.literal[0] in "tfn" and not any(l.startswith(self.literal) for l in LITERALS):
+                    self.fail(f"invalid literal {self.literal!r}")
+                return
+            self.end_literal()
+        if c in WHITESPACE:
+            return
+
+        if self.expect in ("value", "value_or_end"):
+            if c == "]" and self.expect == "value_or_end":
+                return self.close("array")
+            return self.start_value(c)
+        if self.expect in ("key", "key_or_end"):
+            if c == "}" and self.expect == "key_or_end":
+                return self.close("object")
+            if c != '"':
+                self.fail(f"expected key, got {c!r}")
+            self.string = 0
+            self.key = []
+            return
+        if self.expect == "colon":
+            if c != ":":
+                self.fail(f"expected ':', got {c!r}")
+            frame = self.stack[-1]
+            self.schema = frame["schema"].get("properties", {}).get(frame["key"]) if frame["schema"] else None
+            self.expect = "value"
+            return
+        if self.expect == "comma_or_end":
+            frame = self.stack[-1]
+            if c == ",":
+                self.expect = "key" if frame["kind"] == "object" else "value"
+                if frame["kind"] == "array":
+                    self.schema = frame["schema"].get("items") if frame["schema"] else None
+                return
+            if c == "}" and frame["kind"] == "object":
+                return self.close("object")
+            if c == "]" and frame["kind"] == "array":
+                return self.close("array")
+            self.fail(f"expected ',' or end of {frame['kind']}, got {c!r}")
+        if self.expect == "end":
+            self.fail(f"trailing data {c!r}")
+
+    def step_string(self, c):
+        if self.escape == 1:
+            if c not in ESCAPES:
+                self.fail(f"invalid escape \\{c}")
+            self.escape = 2 if c == "u" else 0
+        elif self.escape >= 2:
+            if c not in HEX:
+                self.fail("invalid unicode escape")
+            self.escape = 0 if self.escape == 5 else self.escape + 1
+        elif c == "\\":
+            self.escape = 1
+            return
+        elif c == '"':
+            self.string = None
+            if self.key is not None:
+                return self.end_key("".join(self.key))
+            return self.end_value()
+        elif ord(c) < 0x20:
+            self.fail("control character in string")
+
+        if self.key is not None:
+            self.key.append(c)
+        self.string += 1
+        if self.string > self.maxfield:
+            self.fail(f"string longer than {self.maxfield} characters")
+
+    def start_value(self, c):
+        kind = kind_of(c)
+        if kind is None:
+            self.fail(f"unexpected {c!r}")
+        if not accepts(self.schema, kind):
+            self.fail(f"expected {self.schema['type']}, got {kind}")
+        if kind == "string":
+            self.string = 0
+        elif kind == "object":
+            self.stack.append({"kind": "object", "schema": self.schema, "keys": set(), "key": None})
+            self.expect = "key_or_end"
+        elif kind == "array":
+            self.stack.append({"kind": "array", "schema": self.schema})
+            self.schema = self.schema.get("items") if self.schema else None
+            self.expect = "value_or_end"
+        else:
+            self.literal = c
+
+    def end_literal(self):
+        lit = self.literal
+        self.literal = None
+        if lit[0] in "tfn":
+            if lit not in LITERALS:
+                self.fail(f"invalid literal {lit!r}")
+        elif not NUMBER_RE.match(lit):
+            self.fail(f"invalid number {lit!r}")
+        self.end_value()
+
+    def end_key(self, key):
+        self.key = None
+        frame = self.stack[-1]
+        schema = frame["schema"]
+        if key in frame["keys"]:
+            self.fail(f"duplicated key {key!r}")
+        if schema and "properties" in schema and key not in schema["properties"]:
+            self.fail(f"unexpected key {key!r}")
+        frame["keys"].add(key)
+        frame["key"] = key
+        self.expect = "colon"
+
+    def end_value(self):
+        if not self.stack:
+            self.expect = "end"
+            self.done = True
+        else:
+            self.expect = "comma_or_end"
+
+    def close(self, kind):
+        frame = self.stack.pop()
+        if kind == "object" and frame["schema"]:
+            missing = [k for k in frame["schema"].get("required", []) if k not in frame["keys"]]
+            if missing:
+                self.fail(f"missing required keys {missing}")
+        self.end_value()
+
+    def finish(self):
+        # Called at end of stream
+        if self.literal is not None:
+            self.end_literal()
+        if not self.done:
+            self.fail("truncated document")
@@ -0,0 +1,315 @@
+# KubeVibe
+# Kubernetes API client: talks to the API server directly over a kept-alive,
+# authenticated connection instead of starting kubectl for every operation.
+# Only what the pipeline needs: namespaces, apply, get/list, delete and watch.
+
+import os
+import ssl
+import json
+import base64
+import tempfile
+import threading
+import http.client
+import urllib.parse
+import yaml
+
+FIELD_MANAGER = "kubevibe"
+SA_DIR = "/var/run/secrets/kubernetes.io/serviceaccount"
+
+# Errors raised when a kept-alive connection was closed by the server while idle
+STALE_ERRORS = (http.client.RemoteDisconnected, http.client.CannotSendRequest, BrokenPipeError, ConnectionResetError)
+
+# (apiVersion, kind) -> (resource, namespaced) for the kinds generated
+# manifests use; anything else is looked up through API discovery
+RESOURCES = {
+    ("v1", "Namespace"): ("namespaces", False),
+    ("v1", "Pod"): ("pods", True),
+    ("v1", "Service"): ("services", True),
+    ("v1", "ConfigMap"): ("configmaps", True),
+    ("v1", "Secret"): ("secrets", True),
+    ("v1", "ServiceAccount"): ("serviceaccounts", True),
+    ("v1", "PersistentVolumeClaim"): ("persistentvolumeclaims", True),
+    ("apps/v1", "Deployment"): ("deployments", True),
+    ("apps/v1", "StatefulSet"): ("statefulsets", True),
+    ("apps/v1", "DaemonSet"): ("daemonsets", True),
+    ("apps/v1", "ReplicaSet"): ("replicasets", True),
+    ("batch/v1", "Job"): ("jobs", True),
+    ("batch/v1", "CronJob"): ("cronjobs", True),
+    ("networking.k8s.io/v1", "Ingress"): ("ingresses", True),
+    ("networking.k8s.io/v1", "NetworkPolicy"): ("networkpolicies", True),
+    ("autoscaling/v1", "HorizontalPodAutoscaler"): ("horizontalpodautoscalers", True),
+    ("autoscaling/v2", "HorizontalPodAutoscaler"): ("horizontalpodautoscalers", True),
+    ("policy/v1", "PodDisruptionBudget"): ("poddisruptionbudgets", True),
+    ("rbac.authorization.k8s.io/v1", "Role"): ("roles", True),
+    ("rbac.authorization.k8s.io/v1", "RoleBinding"): ("rolebindings", True),
+    ("discovery.k8s.io/v1", "EndpointSlice"): ("endpointslices", True)
+}
+
+class ConfigError(Exception):
+    pass
+
+class APIError(Exception):
+    # Non-2xx answer; message is the one from the Status object, as kubectl prints it
+    def __init__(self, status, message, reason=""):
+        super().__init__(message)
+        self.status = status
+        self.reason = reason
+
+def _named(entries, name, what):
+    for e in entries or []:
+        if e.get("name") == name:
+            return e.get(what) or {}
+    raise ConfigError(f"{what} {name} not found in kubeconfig")
+
+def _data_file(data):
+    # ssl wants client certificates as files
+    f = tempfile.NamedTemporaryFile("wb", delete=False)
+    f.write(base64.b64decode(data))
+    f.close()
+    return f.name
+
+def load_kubeconfig(path=None, context=None):
+    # Returns (server, ssl context or None, headers, default namespace)
+    if path is None:
+        paths = [p for p in os.getenv("KUBECONFIG", "").split(os.pathsep) if p]
+        paths = [p for p in paths + [os.path.expanduser("~/.kube/config")] if os.path.exists(p)]
+        if not paths:
+            return load_incluster()
+        path = paths[0]
+    f = open(path)
+    config = yaml.safe_load(f) or {}
+    f.close()
+
+    context = context or os.getenv("KUBECONTEXT") or config.get("current-context")
+    if not context:
+        raise ConfigError(f"no current-context in {path}")
+    ctx = _named(config.get("contexts"), context, "context")
+    cluster = _named(config.get("clusters"), ctx.get("cluster"), "cluster")
+    user = _named(config.get("users"), ctx.get("user"), "user") if ctx.get("user") else {}
+
+    server = cluster.get("server")
+    if not server:
+        raise ConfigError(f"cluster {ctx.get('cluster')} has no server")
+    if "exec" in user or "auth-provider" in user:
+        raise ConfigError("exec and auth-provider credentials are only supported through kubectl")
+
+    headers = {}
+    if user.get("token"):
+        headers["Authorization"] = f"Bearer {user['token']}"
+    elif user.get("tokenFile"):
+        f = open(user["tokenFile"])
+        headers["Authorization"] = f"Bearer {f.read().strip()}"
+        f.close()
+    elif user.get("username"):
+        cred = base64.b64encode(f"{user['username']}:{user.get('password', '')}".encode()).decode()
+        headers["Authorization"] = f"Basic {cred}"
+
+    sslctx = None
+    if server.startswith("https"):
+        if cluster.get("insecure-skip-tls-verify"):
+            sslctx = ssl._create_unverified_context()
+        elif cluster.get("certificate-authority-data"):
+            sslctx = ssl.create_default_context(cadata=base64.b64decode(cluster["certificate-authority-data"]).decode())
+        else:
+            sslctx = ssl.create_default_context(cafile=cluster.get("certificate-authority"))
+        cert, key = user.get("client-certificate"), user.get("client-key")
+        tmp = []
+        if user.get("client-certificate-data"):
+            cert = _data_file(user["client-certificate-data"])
+            tmp.append(cert)
+        if user.get("client-key-data"):
+            key = _data_file(user["client-key-data"])
+            tmp.append(key)
+        try:
+            if cert:
+                sslctx.load_cert_chain(cert, key)
+        finally:
+            for t in tmp:
+                os.unlink(t)
+
+    return server, sslctx, headers, ctx.get("namespace", "default")
+
+def load_incluster():
+    host, port = os.getenv("KUBERNETES_SERVICE_HOST"), os.getenv("KUBERNETES_SERVICE_PORT", "443")
+    if not host or not os.path.exists(f"{SA_DIR}/token"):
+        raise ConfigError("no kubeconfig found and not running in a cluster")
+    f = open(f"{SA_DIR}/token")
+    token = f.read().strip()
+    f.close()
+    sslctx = ssl.create_default_context(cafile=f"{SA_DIR}/ca.crt")
+    return f"https://{host}:{port}", sslctx, {"Authorization": f"Bearer {token}"}, "default"
+
+class Watch:
+    # One watch request on its own connection. events() yields the decoded
+    # watch events; close() from another thread ends it.
+
+    def __init__(self, conn, resp):
+        self.conn = conn
+        self.resp = resp
+
+    def events(self):
+        try:
+            while True:
+                line = self.resp.readline()
+                if not line:
+                    return
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+        except (OSError, ValueError, http.client.HTTPException, AttributeError):
+            # AttributeError: the connection was closed under readline
+            return
+
+    def close(self):
+        try:
+            if self.conn.sock:
+                self.conn.sock.shutdown(2)
+        except OSError:
+            pass
+        self.conn.close()
+
+class Client:
+
+    def __init__(self, server, sslctx=None, headers=None, timeout=30):
+        u = urllib.parse.urlsplit(server)
+        self.server = server
+        self.https = u.scheme == "https"
+        self.host = u.hostname
+        self.port = u.port or (443 if self.https else 80)
+        self.prefix = u.path.rstrip("/")
+        self.sslctx = sslctx
+        self.headers = dict(headers or {})
+        self.timeout = timeout
+        self.local = threading.local()
+        self.discovered = {}
+
+    def connect(self, timeout=None):
+        timeout = timeout or self.timeout
+        if self.https:
+            return http.client.HTTPSConnection(self.host, self.port, timeout=timeout, context=self.sslctx)
+        return http.client.HTTPConnection(self.host, self.port, timeout=timeout)
+
+    def conn(self):
+        # One kept-alive connection per thread. A forked child (batch
+        # workers) must not share the parent's socket.
+        if getattr(self.local, "conn", None) is None or self.local.pid != os.getpid():
+            self.local.conn = self.connect()
+            self.local.pid = os.getpid()
+        return self.local.conn
+
+    def url(self, path, query=None):
+        query = {k: v for k, v in (query or {}).items() if v is not None}
+        return self.prefix + path + ("?" + urllib.parse.urlencode(query) if query else "")
+
+    def request(self, method, path, body=None, query=None, ctype="application/json"):
+        # Returns the decoded answer, raises APIError on a non-2xx status.
+        # A request on a reused connection that the server already closed is
+        # retried once on a fresh one.
+        headers = dict(self.headers)
+        headers["Accept"] = "application/json"
+        if body is not None:
+            headers["Content-Type"] = ctype
+            body = json.dumps(body).encode() if not isinstance(body, bytes) else body
+        for attempt in (0, 1):
+            conn = self.conn()
+            try:
+                conn.request(method, self.url(path, query), body, headers)
+                resp = conn.getresponse()
+                data = resp.read()
+                break
+            except STALE_ERRORS:
+                conn.close()
+                self.local.conn = None
+                if attempt:
+                    raise
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                self.local.conn = None
+                raise
+        try:
+            doc = json.loads(data) if data else {}
+        except ValueError:
+            doc = {"message": data.decode(errors="replace")}
+        if resp.status >= 300:
+            raise APIError(resp.status, doc.get("message") or f"HTTP {resp.status}", doc.get("reason", ""))
+        return doc
+
+    def resource(self, apiVersion, kind):
+        key = (apiVersion, kind)
+        if key in RESOURCES:
+            return RESOURCES[key]
+        if key not in self.discovered:
+            base = "/api/v1" if apiVersion == "v1" else f"/apis/{apiVersion}"
+            try:
+                doc = self.request("GET", base)
+            except APIError:
+                doc = {}
+            for r in doc.get("resources", []):
+                if "/" not in r["name"]:
+                    self.discovered[(apiVersion, r["kind"])] = (r["name"], r.get("namespaced", False))
+        if key not in self.discovered:
+            raise APIError(404, f'no matches for kind "{kind}" in version "{apiVersion}"', "NotFound")
+        return self.discovered[key]
+
+    def path(self, apiVersion, kind, ns=None, name=None):
+        resource, namespaced = self.resource(apiVersion, kind)
+        p = "/api/v1" if apiVersion == "v1" else f"/apis/{apiVersion}"
+        if namespaced and ns:
+            p += f"/namespaces/{ns}"
+        p += f"/{resource}"
+        if name:
+            p += f"/{name}"
+        return p
+
+    def get(self, apiVersion, kind, ns=None, name=None, selector=None):
+        return self.request("GET", self.path(apiVersion, kind, ns, name), query={"labelSelector": selector})
+
+    def list(self, apiVersion, kind, ns=None, selector=None):
+        # List items come without kind and apiVersion, put them back
+        doc = self.get(apiVersion, kind, ns, None, selector)
+        for item in doc.get("items", []):
+            item.setdefault("kind", kind)
+            item.setdefault("apiVersion", apiVersion)
+        return doc
+
+    def create(self, doc, ns=None, strict=False):
+        # strict: unknown or duplicate fields are errors, as with kubectl create
+        query = {"fieldValidation": "Strict"} if strict else None
+        return self.request("POST", self.path(doc["apiVersion"], doc["kind"], ns), doc, query)
+
+    def apply(self, doc, ns=None):
+        # Server-side apply: creates or updates, field manager kubevibe
+        name = doc.get("metadata", {}).get("name")
+        if not name:
+            raise APIError(422, f"{doc.get('kind')} without metadata.name", "Invalid")
+        return self.request("PATCH", self.path(doc["apiVersion"], doc["kind"], ns, name), doc,
+                            {"fieldManager": FIELD_MANAGER, "force": "true"}, "application/apply-patch+yaml")
+
+    def delete(self, apiVersion, kind, ns=None, name=None):
+        return self.request("DELETE", self.path(apiVersion, kind, ns, name), {"propagationPolicy": "Background"})
+
+    def delete_collection(self, apiVersion, kind, ns=None, selector=None):
+        return self.request("DELETE", self.path(apiVersion, kind, ns), {"propagationPolicy": "Background"},
+                            {"labelSelector": selector})
+
+    def watch(self, apiVersion, kind, ns=None, timeout=300):
+        conn = self.connect(timeout + 10)
+        headers = dict(self.headers)
+        headers["Accept"] = "application/json"
+        conn.request("GET", self.url(self.path(apiVersion, kind, ns), {"watch": "1", "timeoutSeconds": int(timeout)}), None, headers)
+        resp = conn.getresponse()
+        if resp.status >= 300:
+            data = resp.read()
+            conn.close()
+            raise APIError(resp.status, data.decode(errors="replace"))
+        return Watch(conn, resp)
+
+def from_config(path=None, context=None):
+    server, sslctx, headers, namespace = load_kubeconfig(path, context)
+    return Client(server, sslctx, headers)
+
+if __name__ == "__main__":
+    c = from_config()
+    print(c.server)
+    for ns in c.list("v1", "Namespace")["items"]:
+        print(ns["metadata"]["name"])
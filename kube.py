@@ -0,0 +1,550 @@
+# KubeVibe
+# Cluster access shared by the stages that touch the test cluster
+
+import os
+import re
+import json
+import time
+import uuid
+import queue
+import socket
+import datetime
+import threading
+import subprocess
+import multiprocessing.util
+import http.client
+import yaml
+import kapi
+from ctl import printcol
+
+# Every namespace created by the pipeline carries these labels, so cleanup
+# can select exactly the namespaces of one run and never touch anyone else's.
+MANAGED_LABEL = "kubevibe/managed"
+RUN_LABEL = "kubevibe/run"
+STAGE_LABEL = "kubevibe/stage"
+
+# Upper bound for the readiness wait in CONNECT (seconds)
+readyTimeout = float(os.getenv("READY_TIMEOUT", "90"))
+# Container waiting reasons that will not resolve by waiting longer
+FATAL_REASONS = ("ImagePullBackOff", "ErrImagePull", "CrashLoopBackOff", "InvalidImageName", "CreateContainerConfigError")
+
+# Namespace teardown: a reaper thread deletes released namespaces in bulk,
+# without waiting for finalizers, and reports the ones stuck terminating
+reapInterval = float(os.getenv("NS_REAP_INTERVAL", "2"))
+stuckAfter = float(os.getenv("NS_STUCK_AFTER", "120"))
+# Managed namespaces older than this are orphans whoever created them
+orphanAge = float(os.getenv("NS_ORPHAN_AGE", "3600"))
+
+# auto: the API client when a kubeconfig (or in-cluster account) is usable,
+# kubectl otherwise; api / kubectl force one of them
+backend = os.getenv("KUBE_BACKEND", "auto")
+
+_api = None
+_api_loaded = False
+_api_lock = threading.Lock()
+
+def api():
+    # Shared API client of this process, None when kubectl is used
+    global _api, _api_loaded
+    if backend == "kubectl":
+        return None
+    with _api_lock:
+        if not _api_loaded:
+            _api_loaded = True
+            try:
+                _api = kapi.from_config()
+            except (kapi.ConfigError, OSError, ValueError, yaml.YAMLError):
+                if backend == "api":
+                    raise
+                _api = None
+    return _api
+
+def native(fn, msg=None):
+    # Runs an API call, returns (returncode, output) like kubectl does: msg on
+    # success (or the answer itself), the server's message on failure
+    try:
+        doc = fn()
+        return 0, doc if msg is None else msg
+    except (kapi.APIError, OSError, http.client.HTTPException) as e:
+        return 1, f"Error from server: {e}\n"
+
+def run_id():
+    return uuid.uuid4().hex[:8]
+
+def kubectl(args, stdin=None):
+    # Returns (returncode, combined output)
+    p = subprocess.run(f"kubectl {args}", shell=True, input=stdin.encode() if stdin else None,
+                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    return p.returncode, p.stdout.decode()
+
+def kubectl_json(args):
+    # Parsed JSON output of a kubectl get, None on failure (stderr is dropped
+    # so deprecation warnings do not end up in the document)
+    p = subprocess.run(f"kubectl {args} -o json", shell=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    if p.returncode != 0:
+        return None
+    try:
+        return json.loads(p.stdout.decode())
+    except json.JSONDecodeError:
+        return None
+
+def label_value(s):
+    # Label values: at most 63 characters of [A-Za-z0-9_.-], alphanumeric at both ends
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", str(s))[:63].strip("_.-")
+
+def namespaces(runid):
+    # Namespace per cluster-facing stage, derived from the run ID
+    return {
+        "deploy": f"vibe-test-deploy-{runid}",
+        "connect": f"vibe-test-service-{runid}"
+    }
+
+def stage_namespace(D, stage):
+    # A fresh namespace for every DEPLOY or CONNECT of a run. The previous
+    # one is torn down in the background (release_namespace) and may still
+    # be Terminating when the next one is needed, so a name is never reused.
+    D["nsseq"] = D.get("nsseq", 0) + 1
+    return f"{D['namespaces'][stage]}-{D['nsseq']}"
+
+def run_metadata(D, stage):
+    labels = {
+        MANAGED_LABEL: "true",
+        RUN_LABEL: label_value(D["runid"]),
+        STAGE_LABEL: label_value(stage)
+    }
+    annotations = {
+        "kubevibe/model": str(D.get("model", "")),
+        "kubevibe/outputfolder": str(D.get("outputfolder", "")),
+        "kubevibe/host": socket.gethostname(),
+        "kubevibe/pid": str(os.getpid()),
+        "kubevibe/created": datetime.datetime.now(datetime.timezone.utc).isoformat()
+    }
+    return labels, annotations
+
+def namespace_doc(ns, labels=None, annotations=None):
+    doc = {
+        "apiVersion": "v1",
+        "kind": "Namespace",
+        "metadata": {"name": ns}
+    }
+    if labels:
+        doc["metadata"]["labels"] = labels
+    if annotations:
+        doc["metadata"]["annotations"] = annotations
+    return doc
+
+def namespace_manifest(ns, labels=None, annotations=None):
+    return yaml.dump(namespace_doc(ns, labels, annotations))
+
+def create_namespace(ns, labels=None, annotations=None):
+    a = api()
+    if a:
+        return native(lambda: a.create(namespace_doc(ns, labels, annotations)), f"namespace/{ns} created\n")
+    if not labels and not annotations:
+        return kubectl(f"create namespace {ns}")
+    return kubectl("create -f -", namespace_manifest(ns, labels, annotations))
+
+def delete_namespace(ns):
+    a = api()
+    if a:
+        return native(lambda: a.delete("v1", "Namespace", None, ns), f'namespace "{ns}" deleted\n')
+    return kubectl(f"delete namespace {ns}")
+
+# Kinds created per namespace through the API client, so a wipe only has
+# to delete those
+created = {}
+
+def create_docs(a, docs, ns):
+    # Every document is created even if an earlier one failed, like kubectl
+    # create: an object that already exists is an error, never an update,
+    # and fields the schema does not know are rejected
+    rc, out = 0, ""
+    for doc in docs:
+        if not isinstance(doc, dict):
+            continue
+        kind = doc.get("kind", "?")
+        name = doc.get("metadata", {}).get("name", "?")
+        other = doc.get("metadata", {}).get("namespace")
+        if other and other != ns:
+            rc, out = 1, out + f"error: the namespace from the provided object \"{other}\" does not match the namespace \"{ns}\"\n"
+            continue
+        r, o = native(lambda: a.create(doc, ns, strict=True), f"{kind.lower()}/{name} created\n")
+        rc = rc or r
+        out += o
+        created.setdefault(ns, set()).add((doc.get("apiVersion"), kind))
+    return rc, out
+
+def label_docs(docs, labels):
+    # Puts labels on every object of a manifest so its objects can be found
+    # (and wiped) by selector
+    for doc in docs:
+        if isinstance(doc, dict) and labels:
+            meta = doc.setdefault("metadata", {}) or {}
+            doc["metadata"] = meta
+            meta["labels"] = {**(meta.get("labels") or {}), **labels}
+    return docs
+
+def load_manifest(deployfile):
+    f = open(deployfile)
+    docs = list(yaml.safe_load_all(f))
+    f.close()
+    return docs
+
+def labeled_manifest(deployfile, labels):
+    # Manifest text for kubectl create -f - with labels added, "" if unreadable
+    try:
+        return yaml.safe_dump_all([d for d in label_docs(load_manifest(deployfile), labels) if d is not None])
+    except (OSError, yaml.YAMLError):
+        return ""
+
+def create_manifest(ns, deployfile, labels=None):
+    # Creates every object of a manifest file in ns, labels added to each
+    a = api()
+    if not a:
+        if labels:
+            return kubectl(f"-n {ns} create -f -", labeled_manifest(deployfile, labels))
+        return kubectl(f"-n {ns} create -f {deployfile}")
+    try:
+        docs = load_manifest(deployfile)
+    except (OSError, yaml.YAMLError) as e:
+        return 1, f"error: {e}\n"
+    return create_docs(a, label_docs(docs, labels), ns)
+
+# What a namespace wipe deletes (by label), for kubectl
+WIPE_KINDS = "all,configmaps,secrets,ingresses,networkpolicies,persistentvolumeclaims,serviceaccounts,roles,rolebindings,poddisruptionbudgets"
+
+def wipe_namespace(ns, selector):
+    # Deletes the labeled objects of ns without waiting for them to go
+    a = api()
+    if not a:
+        return kubectl(f"-n {ns} delete {WIPE_KINDS} -l {selector} --ignore-not-found --wait=false")
+    rc, out = 0, ""
+    kinds = created.pop(ns, None) or list(kapi.RESOURCES)
+    done = set()
+    for apiVersion, kind in kinds:
+        try:
+            resource, namespaced = a.resource(apiVersion, kind)
+        except (kapi.APIError, OSError, http.client.HTTPException):
+            continue
+        if not namespaced or kind == "EndpointSlice" or resource in done:
+            continue
+        done.add(resource)
+        r, o = native(lambda: a.delete_collection(apiVersion, kind, ns, selector), "")
+        if r != 0 and "not found" not in o:
+            rc, out = r, out + o
+    return rc, out
+
+def namespace_empty(ns, selector):
+    # No pods left at all (pods of deleted Deployments are not labeled) and
+    # none of the labeled Services
+    a = api()
+    if a:
+        try:
+            return not a.list("v1", "Pod", ns)["items"] and not a.list("v1", "Service", ns, selector)["items"]
+        except (kapi.APIError, OSError, http.client.HTTPException):
+            return False
+    pods = kubectl_json(f"-n {ns} get pods")
+    svcs = kubectl_json(f"-n {ns} get svc -l {selector}")
+    return pods is not None and svcs is not None and not pods["items"] and not svcs["items"]
+
+def namespace_active(ns):
+    # The namespace exists and is not being deleted
+    a = api()
+    if a:
+        rc, doc = native(lambda: a.get("v1", "Namespace", None, ns))
+    else:
+        doc = kubectl_json(f"get namespace {ns}")
+        rc = 0 if doc else 1
+    return rc == 0 and isinstance(doc, dict) and doc.get("status", {}).get("phase") == "Active"
+
+def get_services(ns):
+    a = api()
+    if a:
+        rc, doc = native(lambda: a.list("v1", "Service", ns))
+        return doc if rc == 0 else None
+    return kubectl_json(f"-n {ns} get svc")
+
+READY_QUERY = "get pods,endpointslices"
+
+def readiness(doc):
+    # Looks at one snapshot of the pods and endpoint slices of a namespace.
+    # Returns ("ready"|"failed"|"waiting", reason)
+    if not doc:
+        return "waiting", "no answer from the cluster"
+    pods = [i for i in doc.get("items", []) if i.get("kind") == "Pod"]
+    slices = [i for i in doc.get("items", []) if i.get("kind") == "EndpointSlice"]
+
+    for pod in pods:
+        name = pod["metadata"]["name"]
+        status = pod.get("status", {})
+        if status.get("phase") == "Failed":
+            return "failed", f"pod {name} failed: {status.get('reason', '')} {status.get('message', '')}".strip()
+        for cs in status.get("initContainerStatuses", []) + status.get("containerStatuses", []):
+            waiting = cs.get("state", {}).get("waiting") or {}
+            if waiting.get("reason") in FATAL_REASONS:
+                return "failed", f"pod {name} container {cs['name']}: {waiting['reason']}: {waiting.get('message', '')}".strip()
+
+    for s in slices:
+        for ep in s.get("endpoints") or []:
+            if ep.get("conditions", {}).get("ready"):
+                return "ready", f"service {s['metadata'].get('labels', {}).get('kubernetes.io/service-name', '?')} has ready endpoints"
+
+    if not pods:
+        return "waiting", "no pods yet"
+    if not slices:
+        return "waiting", "no service endpoints yet"
+    return "waiting", f"{len(pods)} pods, no ready endpoints yet"
+
+def snapshot(ns):
+    # Pods and endpoint slices of ns as one list document, None on failure
+    a = api()
+    if not a:
+        return kubectl_json(f"-n {ns} {READY_QUERY}")
+    try:
+        items = a.list("v1", "Pod", ns)["items"] + a.list("discovery.k8s.io/v1", "EndpointSlice", ns)["items"]
+    except (kapi.APIError, OSError, http.client.HTTPException):
+        return None
+    return {"kind": "List", "items": items}
+
+def watch_pods(ns, bound, wake):
+    # Puts something on wake for every pod event in ns until the returned
+    # stop function is called
+    a = api()
+    if a:
+        try:
+            w = a.watch("v1", "Pod", ns, bound)
+        except (kapi.APIError, OSError, http.client.HTTPException):
+            return lambda: None
+        events, stop = w.events(), w.close
+    else:
+        p = subprocess.Popen(["kubectl", "-n", ns, "get", "pods", "--watch", "-o", "name"],
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        def stop():
+            p.kill()
+            p.wait()
+        events = p.stdout
+
+    def pump():
+        for ev in events:
+            wake.put(ev)
+    threading.Thread(target=pump, daemon=True).start()
+    return stop
+
+def wait_ready(ns, bound=None, tick=1.0):
+    # Event driven: a pod watch wakes the loop on every pod change and the
+    # namespace is re-evaluated then (or every tick, since endpoints lag pods
+    # slightly). Returns (ok, reason) as soon as the Service has a ready
+    # endpoint, a pod is stuck on a fatal reason, or the bound runs out.
+    bound = readyTimeout if bound is None else bound
+    deadline = time.time() + bound
+    wake = queue.Queue()
+    stop = watch_pods(ns, bound, wake)
+    try:
+        while True:
+            state, reason = readiness(snapshot(ns))
+            if state != "waiting":
+                return state == "ready", reason
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False, f"not ready after {bound:g} s: {reason}"
+            try:
+                wake.get(timeout=min(tick, remaining))
+            except queue.Empty:
+                pass
+    finally:
+        stop()
+
+def managed_namespaces(selector=None):
+    selector = f"{MANAGED_LABEL}=true" + (f",{selector}" if selector else "")
+    a = api()
+    if a:
+        rc, doc = native(lambda: a.list("v1", "Namespace", None, selector))
+        return doc["items"] if rc == 0 else None
+    doc = kubectl_json(f"get namespace -l {selector}")
+    return doc["items"] if doc else None
+
+def delete_namespaces(names):
+    # One request per namespace with the API client, one kubectl otherwise;
+    # neither waits for the namespaces to be gone
+    a = api()
+    if not a:
+        return kubectl(f"delete namespace {' '.join(names)} --ignore-not-found --wait=false")
+    rc, out = 0, ""
+    for name in names:
+        r, o = native(lambda: a.delete("v1", "Namespace", None, name), f'namespace "{name}" deleted\n')
+        if r != 0 and "not found" not in o:
+            rc = r
+        out += o
+    return rc, out
+
+def terminating_reason(item):
+    # Why a namespace is still terminating, from its status conditions
+    # (NamespaceContentRemaining, NamespaceFinalizersRemaining, ...)
+    reasons = [f"{c['type']}: {c.get('message', '')}" for c in item.get("status", {}).get("conditions", [])
+               if c.get("status") == "True"]
+    finalizers = item.get("spec", {}).get("finalizers") or []
+    if finalizers:
+        reasons.append(f"finalizers: {', '.join(finalizers)}")
+    return "; ".join(reasons) or "no condition reported"
+
+class Reaper:
+    # Stages hand their namespaces over with release() and move on. The
+    # thread deletes whatever was released since its last round in one go,
+    # then watches the deleted namespaces disappear.
+
+    def __init__(self, interval=2.0, stuck=120.0):
+        self.interval = interval
+        self.stuckAfter = stuck
+        self.queue = queue.Queue()
+        self.pending = {}  # namespace -> time of deletion
+        self.stuck = {}    # namespace -> reason, reported once
+        self.thread = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def release(self, ns):
+        with self.lock:
+            # Threads do not survive fork, start one per process
+            if self.thread is None or self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.pending = {}
+                self.thread = threading.Thread(target=self.loop, daemon=True)
+                self.thread.start()
+                # Flushed at exit of this process (pool workers included),
+                # after the namespace pool has released its namespaces
+                multiprocessing.util.Finalize(self, self.flush, exitpriority=0)
+        self.queue.put(ns)
+
+    def take(self, timeout):
+        names = []
+        try:
+            names.append(self.queue.get(timeout=timeout))
+            while True:
+                names.append(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+        return names
+
+    def delete(self, names):
+        if not names:
+            return
+        rc, out = delete_namespaces(names)
+        now = time.time()
+        for name in names:
+            self.pending[name] = now
+
+    def check(self):
+        if not self.pending:
+            return
+        items = managed_namespaces()
+        if items is None:
+            return
+        alive = {i["metadata"]["name"]: i for i in items}
+        now = time.time()
+        for name, t in list(self.pending.items()):
+            if name not in alive:
+                del self.pending[name]
+            elif now - t > self.stuckAfter:
+                reason = terminating_reason(alive[name])
+                self.stuck[name] = reason
+                printcol("yellow", f"namespace {name} stuck terminating for {now - t:.0f} s: {reason}")
+                del self.pending[name]
+
+    def loop(self):
+        while True:
+            self.delete(self.take(self.interval))
+            try:
+                self.check()
+            except Exception as e:
+                printcol("yellow", f"reaper: {type(e).__name__}: {e}")
+
+    def flush(self):
+        # Deletes what is still queued from the calling thread (at exit)
+        self.delete(self.take(0))
+
+reaper = Reaper(reapInterval, stuckAfter)
+
+def release_namespace(ns):
+    # Teardown without waiting: the namespace goes to the reaper
+    reaper.release(ns)
+    return 0, f'namespace "{ns}" released\n'
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, OverflowError):
+        return True
+    return True
+
+def orphans(items):
+    # Managed namespaces whose creator is gone: created on this host by a
+    # pid that no longer exists, or older than orphanAge when they come from
+    # another host (or do not say). A live pid of this host keeps its own,
+    # however long its run takes.
+    host = socket.gethostname()
+    now = datetime.datetime.now(datetime.timezone.utc)
+    found = []
+    for item in items:
+        if item.get("status", {}).get("phase") == "Terminating":
+            continue
+        ann = item["metadata"].get("annotations") or {}
+        try:
+            created = datetime.datetime.fromisoformat(ann.get("kubevibe/created") or item["metadata"]["creationTimestamp"].replace("Z", "+00:00"))
+            age = (now - created).total_seconds()
+        except (KeyError, ValueError, AttributeError):
+            age = 0
+        if ann.get("kubevibe/host") == host and ann.get("kubevibe/pid", "").isdigit():
+            if not pid_alive(int(ann["kubevibe/pid"])):
+                found.append(item["metadata"]["name"])
+        elif age > orphanAge:
+            found.append(item["metadata"]["name"])
+    return found
+
+def sweep_orphans():
+    # Run once at startup: deletes the namespaces left behind by crashed runs
+    items = managed_namespaces()
+    if not items:
+        return []
+    names = orphans(items)
+    if names:
+        printcol("yellow", f"Sweeping {len(names)} orphaned namespaces")
+        delete_namespaces(names)
+    return names
+
+def cleanup_args(runid):
+    # Selection is by label, not by name, so only this run's namespaces go
+    return f"delete namespace -l {RUN_LABEL}={label_value(runid)},{MANAGED_LABEL}=true --ignore-not-found --wait=false"
+
+def delete_selected(a, selector):
+    # Namespaces cannot be deleted by collection, so list and delete each
+    rc, doc = native(lambda: a.list("v1", "Namespace", None, selector))
+    if rc != 0:
+        return rc, doc
+    out = ""
+    for item in doc["items"]:
+        name = item["metadata"]["name"]
+        r, o = native(lambda: a.delete("v1", "Namespace", None, name), f'namespace "{name}" deleted\n')
+        if r != 0 and "not found" not in o:
+            rc = r
+        out += o
+    return rc, out
+
+def cleanup_run(runid):
+    # Deletes whatever namespaces of this run are still around (e.g. after a
+    # crash in the middle of a stage)
+    a = api()
+    if a:
+        return delete_selected(a, f"{RUN_LABEL}={label_value(runid)},{MANAGED_LABEL}=true")
+    return kubectl(cleanup_args(runid))
+
+if __name__ == "__main__":
+    a = api()
+    if a:
+        for item in a.list("v1", "Namespace", None, f"{MANAGED_LABEL}=true")["items"]:
+            labels = item["metadata"].get("labels", {})
+            print(item["metadata"]["name"], labels.get(RUN_LABEL, ""), labels.get(STAGE_LABEL, ""))
+    else:
+        rc, out = kubectl(f"get namespace -l {MANAGED_LABEL}=true -L {RUN_LABEL},{STAGE_LABEL}")
+        print(out)
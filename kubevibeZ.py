@@ -10,10 +10,12 @@ import shutil
 import copy
 import random
 import fsmStages as fsm
-from log import log
+from log import log, inlog
+import log as runlog
 from parameters import CONTEXT
 from ctl import *
 from generate import *
+from check import check
 from build import *
 from validate import *
 from deploy import *
@@ -21,12 +23,21 @@ from connect import *
 from chart import *
 from fix import *
 import schemas as sch
+import llm
+import kube
+import nspool
+import delivery
+import buildcache
+import fixmemo
+from history import History
 import fsmStages as stg
 from intent import get_intent
 
-llmUrl = "localhost:11434"
-imageRep = "satt70"
-fixfromzero = False
+llmUrl = llm.llmUrl
+imageRep = delivery.imageRep
+fixfromzero = bool(int(os.getenv("FIXFZERO", "0")))
+# Apply the manifest once for DEPLOY and CONNECT, tear it down after CONNECT
+mergedeployconnect = bool(int(os.getenv("MERGE_DEPLOY_CONNECT", "0")))
 
 def handle_generate(D):
     success = 0
@@ -38,7 +49,14 @@ def handle_generate(D):
     t0 = time.time()
 
     ans = extractanswer(generate(outputfolder, model, intent, context, llmUrl))
-    
+    success = store_artifacts(D, ans)
+
+    tf = time.time()
+    tm = tf - t0
+
+    return tm, ans, success
+
+def store_artifacts(D, ans):
     if ans:
         codefilecontent = ans["pythonfilecontent"]
         containerfilecontent = ans["containerfilecontent"]
@@ -47,21 +65,35 @@ def handle_generate(D):
         D["node"]["code"]["content"] = codefilecontent
         D["node"]["container"]["content"] = containerfilecontent
         D["node"]["manifest"]["content"] = yamlfilecontent
+        # Candidates kept by FIX were made for other artifacts
+        D["spares"] = None
 
         if "requirements" in ans:
             D["node"]["requirements"]["file"] = "requirements.txt"
             D["node"]["requirements"]["content"] = ans["requirements"]
 
-        success = 1
-    else:
-        D["node"]["code"]["content"] = "Error while generating"
-        D["node"]["container"]["content"] = "Error while generating"
-        D["node"]["manifest"]["content"] = "Error while generating"
+        return 1
+
+    D["node"]["code"]["content"] = "Error while generating"
+    D["node"]["container"]["content"] = "Error while generating"
+    D["node"]["manifest"]["content"] = "Error while generating"
+    return 0
 
+def handle_check(D):
+    success = 0
+    rawlogfile = os.path.join(D["outputfolder"], D["logfile"])
+
+    t0 = time.time()
+    ok, issues, out = check(D, imageRep)
+    log(rawlogfile, out, "check")
     tf = time.time()
+
+    if ok:
+        success = 1
+
     tm = tf - t0
 
-    return tm, ans, success
+    return tm, issues, success, inlog(out, "check")
 
 def handle_build(D):
     success = 1
@@ -72,13 +104,15 @@ def handle_build(D):
     resultdata = {}
 
     t0 = time.time()
+    d = None
+    logs = ""
     try:
         d = yaml.safe_load_all(D["node"]["manifest"]["content"])
         d = list(d)
     except:
         printcol("red", "Error", end="\n", flush=True)
         success = 0
-    
+
     cf = None
     if "content" in D["node"]["container"]:
         cf = D["node"]["container"]["content"]
@@ -91,28 +125,54 @@ def handle_build(D):
     if "content" in D["node"]["requirements"]:
         rqs = D["node"]["requirements"]["content"]
 
+    # Immutable tag from the artifacts: concurrent runs never deploy each
+    # other's build, and a FIX that left them alone rebuilds nothing
+    tag = content_tag(cf, pf, rqs)
+    resultdata["image"] = delivery.image_ref(tag, imageRep)
+
     if cf and pf:
-        ret, logs = preprocess(outputfolder, cf, pf, rqs, os.path.abspath(rawlogfile))
+        ret, logs, info = preprocess(outputfolder, cf, pf, rqs, os.path.abspath(rawlogfile), imageRep, tag)
         if ret == False:
             printcol("red", "Error", end="\n", flush=True)
             success = 0
+        resultdata["cache"] = buildcache.cache_stats(logs)
+        resultdata["build"] = info
     
-    vibefile = os.path.join(outputfolder, D["node"]["manifest"]["file"])
-
-    f = open(vibefile, "w")
-    f.write(smartyamldump(d))
-    f.close()
+    write_manifest(D, d, tag)
 
     tf = time.time()
     tm = tf - t0
 
     return tm, resultdata, success, logs
 
+def write_manifest(D, d, tag):
+    vibefile = os.path.join(D["outputfolder"], D["node"]["manifest"]["file"])
+
+    if d and tag != "latest":
+        d = retag(d, f"{imageRep}/myapp", tag, delivery.pull_policy())
+
+    f = open(vibefile, "w")
+    f.write(smartyamldump(d))
+    f.close()
+
+def refresh_manifest(D):
+    # vibe.yaml as BUILD would write it, for stages re-entered after BUILD.
+    # A manifest that does not parse is written as is, for VALIDATE to report.
+    node = D["node"]
+    try:
+        d = list(yaml.safe_load_all(node["manifest"]["content"]))
+    except yaml.YAMLError:
+        f = open(os.path.join(D["outputfolder"], node["manifest"]["file"]), "w")
+        f.write(node["manifest"]["content"] or "")
+        f.close()
+        return
+    write_manifest(D, d, content_tag(node["container"].get("content"), node["code"].get("content"), node["requirements"].get("content")))
+
 def handle_validate(D):
     success = 0
 
     t0 = time.time()
-    ok = validate(D)
+    ok, errors, logs = validate(D)
     tf = time.time()
 
     if ok:
@@ -120,7 +180,7 @@ def handle_validate(D):
     
     tm = tf-t0
 
-    return tm, "", success
+    return tm, errors, success, logs
 
 def handle_deploy(D):
     success = 0
@@ -134,7 +194,10 @@ def handle_deploy(D):
     vfile = os.path.join(outputfolder, vibefile)
     rawlogfile = os.path.join(outputfolder, logfile)
 
-    ok = deploy(vfile, rawlogfile)
+    labels, annotations = kube.run_metadata(D, "deploy")
+    ok, ns, logs = deploy(vfile, rawlogfile, kube.stage_namespace(D, "deploy"), labels, annotations, mergedeployconnect)
+    if ok and mergedeployconnect:
+        D["live"] = ns
 
     if ok:
         success = 1
@@ -143,7 +206,7 @@ def handle_deploy(D):
 
     tm = tf-t0
 
-    return tm, "", success
+    return tm, "", success, logs
 
 def handle_connect(D):
     success = 0
@@ -157,7 +220,12 @@ def handle_connect(D):
     vfile = os.path.join(outputfolder, vibefile)
     rawlogfile = os.path.join(outputfolder, logfile)
 
-    ok, endpoint, logs = connect(vfile, rawlogfile)
+    labels, annotations = kube.run_metadata(D, "connect")
+    live = D.pop("live", None)
+    if live:
+        ok, endpoint, logs = connect(vfile, rawlogfile, live, live=True)
+    else:
+        ok, endpoint, logs = connect(vfile, rawlogfile, kube.stage_namespace(D, "connect"), labels, annotations)
 
     if ok==True:
         success = 1
@@ -193,6 +261,10 @@ def handle_fix(D):
 
     #print(f"Error during {stage} with")
     ans, success = fix(D)
+    # Artifacts rewritten, for the FSM to know where to re-enter
+    D["fixed"] = sorted(ans) if success else None
+    if success and "manifest" in ans:
+        refresh_manifest(D)
     #print(json.dumps(D["node"], indent=4))
     #printcol("green", "fix", end="\n", flush=True)
 
@@ -203,6 +275,7 @@ def handle_fix(D):
 
 HANDLERS = {
     "GENERATE": handle_generate,
+    "CHECK": handle_check,
     "BUILD": handle_build,
     "VALIDATE": handle_validate,
     "DEPLOY": handle_deploy,
@@ -215,8 +288,8 @@ def execute_stage(stage, D):
 
     print(colorise("green",f"{stage.lower()}"))
     rawlogfile = os.path.join(D["outputfolder"], D["logfile"])
-    log(rawlogfile, stage, "phase")
-    log(rawlogfile, json.dumps(D, indent=4), "D")
+    runlog.phase(rawlogfile, stage)
+    runlog.state(rawlogfile, D)
     #print("Current State:")
     #print(json.dumps(D, indent=4))
     #print(f"Stage to apply: {stage}")
@@ -225,13 +298,25 @@ def execute_stage(stage, D):
     opts = ["y", "n"]
 
     #ans = input("> ").strip().lower()
-    if stage in ("BUILD", "CONNECT"):
+    digest = fsm.digest(D["node"], stage) if stage in fsm.CACHEABLE and fsm.reentryfix else None
+    if digest and D.setdefault("passed", {}).get(stage) == digest:
+        # Passed before with byte-identical inputs: reuse the result
+        log(rawlogfile, f"{stage} inputs unchanged, result reused", "phase")
+        if stage == "BUILD":
+            refresh_manifest(D)
+        tm, ans, success = 0, "reused", 1
+        D["node"]["logs"] = ""
+        print("reused")
+    elif stage in ("CHECK", "BUILD", "VALIDATE", "DEPLOY", "CONNECT"):
         tm, ans, success, logs = HANDLERS.get(stage)(D)
         print(f"tm: {tm}\nans: {ans}\nsuccess: {str(success)}, ")
-        D["logs"] = logs
+        # Logs of the last stage that ran, for FIX
+        D["node"]["logs"] = logs
         #print(colorise("violet", logs))
-    elif stage in ("GENERATE", "VALIDATE", "DEPLOY", "CHART", "FIX"):
+    elif stage in ("GENERATE", "CHART", "FIX"):
         tm, ans, success = HANDLERS.get(stage)(D)
+        if stage != "FIX":
+            D["node"]["logs"] = ""
         #print(f"tm: {tm}\nans: {ans}\nsuccess: {str(success)}, ")
         print(f"tm: {tm}\nsuccess: {str(success)}")
     else:
@@ -243,6 +328,11 @@ def execute_stage(stage, D):
     if ans == "z":
         state = D["node"]
         return state, 2, True
+
+    if stage != "FIX":
+        fixmemo.settle(D, stage, success)
+    if digest and success:
+        D["passed"][stage] = digest
     
     D["node"]["stage"] = stage
     D["node"]["result"] = success
@@ -282,7 +372,7 @@ def node(codefilecontent, containerfilecontent, yamlfilecontent, stage, stage_re
 
 def tvibe(D, timeout=None, tries = None):
     intent = D["intent"]
-    history = []
+    history = History(os.path.join(D["outputfolder"], "history"))
     trace = []
     it = 0
     fcount = 0
@@ -292,9 +382,12 @@ def tvibe(D, timeout=None, tries = None):
     print(f"Intent: {intent}")
     current = node("", "", "", "", 0)
     stage = "GENERATE"
+    D["failed"] = None
+    D["fixed"] = None
+    D["noops"] = 0
 
     while True:
-        history.append(current.copy())
+        history.append(current)
         D["node"] = current.copy()
 
         if stage in ("SUCCESS", "FAIL"):
@@ -323,32 +416,16 @@ def tvibe(D, timeout=None, tries = None):
             break
         
         # Decide next stage
-        if stage == "FIX":
-            if success == 0:
-                fcount += 1
-                next_stage = fsm.NEXT_ON_FAIL.get("FIX", "FIX")
-            else:
-                fcount = 0
-                if fixfromzero:
-                    next_stage = "GENERATE"
-                else:
-                    next_stage = "BUILD"
-                #i = -1
-                #last = "FIX"
-                #while last == "FIX" and ( i >= - len(history)):
-                #    last = history[i]["stage"]
-                #    i -= 1
-                #next_stage = last if last not in ("", "FIX") else "GENERATE"
-        else:
-            if success == 1:
-                fcount = 0
-                next_stage = fsm.NEXT_ON_SUCCESS[stage]
-            else:
-                fcount += 1
-                if fixfromzero:
-                    next_stage = "GENERATE"
-                else:
-                    next_stage = fsm.NEXT_ON_FAIL[stage]
+        changed = fsm.effective(D["failed"], D["fixed"]) if stage == "FIX" and success else None
+        if changed is not None:
+            D["noops"] = 0 if changed else D["noops"] + 1
+        next_stage = fsm.next_stage(stage, success, fixfromzero, changed, D["failed"], D["noops"])
+        # A fix that changed nothing is no progress
+        fcount = 0 if success and changed != [] else fcount + 1
+        if next_stage == "FIX" and stage != "FIX":
+            D["failed"] = stage
+        elif next_stage == "GENERATE":
+            D["noops"] = 0
 
         #print(f"From {stage} ({'success' if success==1 else 'fail'}) -> {next_stage}")
         trace.append({"step": it+1, "from": stage, "result": success, "to": next_stage})
@@ -366,6 +443,7 @@ def tvibe(D, timeout=None, tries = None):
     
     tf = time.time()
     tm = tf - t0
+    log(os.path.join(D["outputfolder"], D["logfile"]), json.dumps(history.stats()), "history")
     return tm, current, history, trace, success
 
 
@@ -418,11 +496,83 @@ def build_dot_math(stages, actions, trace, out_path="graph.dot"):
         print(f"SVG graph on {out_path}")
 
 
-if __name__ == "__main__":
+def run(prompt, model, outputfolder, intentmethod="none", validationmethod="none", timeout=None, tries=None, do_graph=False, runid=None):
+    # One prompt through intent extraction and the FSM. Returns a summary of
+    # the run; everything else lands in outputfolder.
+    runid = runid or kube.run_id()
+    if not os.path.isdir(outputfolder):
+        os.makedirs(outputfolder)
+    
+    logfile = "kubevibe.rawlog"
+    rawlogfile = os.path.join(outputfolder, logfile)
+    runlog.start(rawlogfile)
 
-    envfixfromzero = os.getenv("FIXFZERO")
-    if envfixfromzero:
-        fixfromzero = bool(int(envfixfromzero))
+    log(rawlogfile, (
+        "Parameters summary:"
+        f"\nUsing model for artifact generation: {model}"
+        f"\nIntent extraction method: {intentmethod}"
+        f"\nIntent validation method: {validationmethod}"
+        f"\nPrompt: {prompt}"
+    ), "control")
+    log(rawlogfile, f"Received intent: {prompt}", "intent-extraction")
+
+    summary = {
+        "prompt": prompt,
+        "model": model,
+        "runid": runid,
+        "outputfolder": outputfolder,
+        "ok": False,
+        "time": 0,
+        "steps": 0,
+        "stage": None
+    }
+
+    tm, intent, intent_success = get_intent(prompt, model, intentmethod, outputfolder, rawlogfile)
+
+    log(rawlogfile, f"Intent extraction applied with result {intent_success} in {tm} seconds", "intent-extraction")
+
+    if not intent_success:
+        print("Fail during intent handling")
+        summary["time"] = tm
+        summary["stage"] = "INTENT"
+        runlog.close(rawlogfile)
+        return summary
+
+    D = {
+        "intent": intent,
+        "node": node("", "", "", "", 0),
+        "outputfolder": outputfolder,
+        "logfile": logfile,
+        "rev": 1,
+        "model": model,
+        "runid": runid,
+        "namespaces": kube.namespaces(runid)
+    }
+
+    try:
+        tt, current, history, trace, ok = tvibe(D, timeout, tries)
+    finally:
+        if D.get("live"):
+            nspool.release(D.pop("live"))
+        rc, out = kube.cleanup_run(runid)
+        log(rawlogfile, out, "cleanup")
+
+    print(f"Process finished in {tt} seconds with result {ok}")
+    log(rawlogfile, f"Process finished in {tt} seconds with result {ok}")
+
+    if do_graph:
+        date_str = datetime.datetime.now().strftime("%d-%m-%Y_%H_%M_%S")
+        output_graph = f"{outputfolder}/{date_str}_dot"
+        build_dot_math(fsm.stages, fsm.actions, trace, output_graph)
+
+    summary["stage"] = trace[-1]["to"] if trace else current["stage"]
+    summary["ok"] = summary["stage"] == "SUCCESS"
+    summary["time"] = tm + tt
+    summary["steps"] = len(trace)
+    runlog.close(rawlogfile)
+    return summary
+
+if __name__ == "__main__":
 
     # Avoid endless loop:
     envtimeout = os.getenv("TIMEOUT")
@@ -443,13 +593,6 @@ if __name__ == "__main__":
     # == Directories ==
     date_str = f"{datetime.datetime.now().strftime("%d-%m-%Y_%H_%M_%S")}"
     outputfolder = f"myto/{model}/{date_str}_output" # we should include the date here to make experiments easier
-    if not os.path.isdir(outputfolder):
-        os.makedirs(outputfolder)
-    
-    logfile = "kubevibe.rawlog"
-    rawlogfile = os.path.join(outputfolder, "kubevibe.rawlog")
-    f = open(rawlogfile, "w")
-    f.close()
 
     # Intent extraction loop
     intentmethod = "none"
@@ -485,46 +628,8 @@ if __name__ == "__main__":
         summ_text += tries_string
     
     print(summ_text)
-    log(rawlogfile, f"{(
-        "Parameters summary:"
-        f"\nUsing model for artifact generation: {model}"
-        f"\nIntent extraction method: {intentmethod}"
-        f"\nIntent validation method: {validationmethod}"
-        f"\nPrompt: {prompt}"
-    )}", "control")
-    log(rawlogfile, f"Received intent: {prompt}", "intent-extraction")
-
-    tm, intent, intent_success = get_intent(prompt, model, intentmethod, outputfolder, rawlogfile)
-
-    log(rawlogfile, f"Intent extraction applied with result {intent_success} in {tm} seconds", "intent-extraction")
-
-    if not intent_success:
-        print("Fail during intent handling")
-        exit
-    #intent = "Develop a credit card validation server"
-
-    D = {
-        "intent": intent,
-        "node": node("", "", "", "", 0),
-        "outputfolder": outputfolder,
-        "logfile": logfile,
-        "rev": 1,
-        "model": model
-    }
-
-    #print(json.dumps(D))
-    tt, current, history, trace, ok = tvibe(D, int(envtimeout) if envtimeout else None, int(envtries) if envtries else None)
-
 
-    print(f"Process finished in {tt} seconds with result {ok}")
-    log(rawlogfile, f"Process finished in {tt} seconds with result {ok}")
-    #print(current)
-    #print(colorise("green", json.dumps(D, indent=4)))
-
-    #print(trace)
-    #print(colorise("green", json.dumps(current, indent=4)))
-    #print(json.dumps(D, indent=4))
-
-    if do_graph:
-        output_graph = f"{outputfolder}/{date_str}_dot"
-        build_dot_math(fsm.stages, fsm.actions, trace, output_graph)
\ No newline at end of file
+    kube.sweep_orphans()
+    nspool.warmup()
+    run(prompt, model, outputfolder, intentmethod, validationmethod,
+        int(envtimeout) if envtimeout else None, int(envtries) if envtries else None, do_graph)
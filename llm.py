@@ -0,0 +1,438 @@
+# KubeVibe
+# LLM client shared by intent curation, generation and fix
+
+import os
+import json
+import time
+import asyncio
+import threading
+import http.client
+from log import log
+from jsonstream import JSONStream, StreamError
+import llmcache
+
+llmUrl = os.getenv("LLM_URL", "localhost:11434")
+
+# Concurrent requests allowed against the same endpoint. Ollama queues
+# requests beyond OLLAMA_NUM_PARALLEL anyway, so keep this aligned with it.
+maxConcurrency = int(os.getenv("LLM_CONCURRENCY", "4"))
+
+# Streaming mode for structured generations (LLM_STREAM=1)
+streaming = bool(int(os.getenv("LLM_STREAM", "0")))
+idleTimeout = float(os.getenv("LLM_IDLE_TIMEOUT", "20"))
+maxField = int(os.getenv("LLM_MAX_FIELD", "65536"))
+
+# Errors raised when a kept-alive connection was closed by the server while idle
+STALE_ERRORS = (http.client.RemoteDisconnected, http.client.CannotSendRequest, BrokenPipeError, ConnectionResetError)
+
+class EndpointPool:
+    # Keep-alive connections to one host:port, bounded by a semaphore
+
+    def __init__(self, endpoint, size):
+        self.endpoint = endpoint
+        self.slots = threading.BoundedSemaphore(size)
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def acquire(self, timeout):
+        self.slots.acquire()
+        with self.lock:
+            conn = self.idle.pop() if self.idle else None
+        if conn is None:
+            conn = http.client.HTTPConnection(self.endpoint, timeout=timeout)
+        else:
+            conn.timeout = timeout
+            if conn.sock:
+                conn.sock.settimeout(timeout)
+        return conn
+
+    def release(self, conn, reuse=True):
+        if reuse:
+            with self.lock:
+                self.idle.append(conn)
+        else:
+            conn.close()
+        self.slots.release()
+
+    def close(self):
+        with self.lock:
+            for conn in self.idle:
+                conn.close()
+            self.idle = []
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def pool(endpoint=None):
+    endpoint = endpoint or llmUrl
+    with _pools_lock:
+        if endpoint not in _pools:
+            _pools[endpoint] = EndpointPool(endpoint, maxConcurrency)
+        return _pools[endpoint]
+
+def post(path, body, timeout=300, endpoint=None):
+    # Sends body (bytes) and returns the decoded response text. A request on a
+    # reused connection that the server already closed is retried once.
+    p = pool(endpoint)
+    headers = {"Content-Type": "application/json", "Connection": "keep-alive"}
+
+    for attempt in (0, 1):
+        conn = p.acquire(timeout)
+        reusable = conn.sock is not None
+        try:
+            conn.request("POST", path, body, headers)
+            resp = conn.getresponse()
+            payload = resp.read().decode()
+        except STALE_ERRORS:
+            p.release(conn, reuse=False)
+            if reusable and attempt == 0:
+                continue
+            raise
+        except Exception:
+            p.release(conn, reuse=False)
+            raise
+        p.release(conn, reuse=not resp.will_close)
+        if resp.status != 200:
+            raise http.client.HTTPException(f"{resp.status} {resp.reason}: {payload}")
+        return payload
+
+def call(data, rawlogfile=None, context="llm", timeout=300, endpoint=None):
+    # Single request/response path for /api/generate. Returns the decoded
+    # Ollama answer (dict) or None when the request failed.
+    body = json.dumps(data)
+    if rawlogfile:
+        log(rawlogfile, f"Request for {context}:\n{body}", "control")
+
+    t0 = time.time()
+    try:
+        answerserial = post("/api/generate", body.encode(), timeout, endpoint)
+        answer = json.loads(answerserial)
+    except Exception as e:
+        answerserial = f"{type(e).__name__}: {e}"
+        answer = None
+    tm = time.time() - t0
+
+    if rawlogfile:
+        log(rawlogfile, f"Raw response ({tm:.2f} s)\n{answerserial}", context)
+
+    return answer
+
+def stream(data, schema=None, rawlogfile=None, context="llm", timeout=300, endpoint=None, idle=None):
+    # Streaming variant of call(). Ollama answers with NDJSON chunks; the
+    # structured output is checked against schema while it arrives and the
+    # request is dropped as soon as it cannot become valid. timeout bounds the
+    # wait for the first token (prompt prefill), idle the gap between tokens.
+    # Returns the same answer shape as call() or None.
+    idle = idle or idleTimeout
+    data = dict(data, stream=True)
+    body = json.dumps(data)
+    if rawlogfile:
+        log(rawlogfile, f"Request for {context} (stream):\n{body}", "control")
+
+    p = pool(endpoint)
+    parser = JSONStream(schema, maxField)
+    chunks = []
+    last = {}
+    reuse = False
+    error = None
+    t0 = time.time()
+
+    conn = p.acquire(timeout)
+    try:
+        conn.request("POST", "/api/generate", body.encode(), {"Content-Type": "application/json"})
+        resp = conn.getresponse()
+        if resp.status != 200:
+            raise http.client.HTTPException(f"{resp.status} {resp.reason}: {resp.read().decode()}")
+        while True:
+            line = resp.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            last = json.loads(line)
+            if "error" in last:
+                raise http.client.HTTPException(last["error"])
+            token = last.get("response", "")
+            if token:
+                if not chunks:
+                    conn.sock.settimeout(idle)
+                chunks.append(token)
+                parser.feed(token)
+            if last.get("done"):
+                parser.finish()
+                resp.read()
+                reuse = not resp.will_close
+                break
+        if not last.get("done"):
+            raise StreamError("stream closed before done")
+    except TimeoutError:
+        error = f"no token received for {idle if chunks else timeout} s"
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    finally:
+        p.release(conn, reuse)
+    tm = time.time() - t0
+
+    text = "".join(chunks)
+    if error:
+        if rawlogfile:
+            log(rawlogfile, f"Stream aborted after {tm:.2f} s and {len(text)} characters: {error}\n{text}", context)
+        return None
+
+    answer = dict(last)
+    answer["response"] = text
+    if rawlogfile:
+        log(rawlogfile, f"Raw response ({tm:.2f} s, streamed)\n{json.dumps(answer)}", context)
+    return answer
+
+def request(data, schema=None, rawlogfile=None, context="llm", timeout=300, endpoint=None, stage=None):
+    # Entry point for pipeline stages. Answers are served from and stored in
+    # the response cache when it is enabled for stage. Structured requests
+    # (schema given) are streamed when LLM_STREAM is enabled.
+    answer = llmcache.get(stage, data, rawlogfile)
+    if answer:
+        return answer
+
+    if streaming and schema is not None:
+        answer = stream(data, schema, rawlogfile, context, timeout, endpoint)
+    else:
+        answer = call(data, rawlogfile, context, timeout, endpoint)
+
+    # Unparseable structured answers are not worth replaying
+    if answer and (not data.get("format") or extractanswer(answer) is not None):
+        llmcache.put(stage, data, answer, rawlogfile)
+    return answer
+
+# == asyncio client ==
+# Same request/response path for the async engine: keep-alive streams per
+# endpoint and event loop, bounded by an asyncio.Semaphore.
+
+class AsyncEndpointPool:
+
+    def __init__(self, endpoint, size):
+        host, _, port = endpoint.rpartition(":")
+        self.host = host or endpoint
+        self.port = int(port) if host else 80
+        self.slots = asyncio.Semaphore(size)
+        self.idle = []
+
+    async def acquire(self, timeout):
+        await self.slots.acquire()
+        while self.idle:
+            reader, writer = self.idle.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer, True
+            writer.close()
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), timeout)
+        except BaseException:
+            self.slots.release()
+            raise
+        return reader, writer, False
+
+    def release(self, reader, writer, reuse=True):
+        if reuse:
+            self.idle.append((reader, writer))
+        else:
+            writer.close()
+        self.slots.release()
+
+_apools = {}
+
+def apool(endpoint=None):
+    endpoint = endpoint or llmUrl
+    key = (endpoint, id(asyncio.get_running_loop()))
+    if key not in _apools:
+        _apools[key] = AsyncEndpointPool(endpoint, maxConcurrency)
+    return _apools[key]
+
+async def aexchange(reader, writer, endpoint, path, body, timeout, idle=None):
+    # Writes one request and yields the response body piece by piece. The
+    # first piece may take timeout seconds, the following ones idle seconds.
+    # The final item is the dict of response headers.
+    idle = idle or timeout
+    writer.write(
+        f"POST {path} HTTP/1.1\r\nHost: {endpoint}\r\nContent-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\nConnection: keep-alive\r\n\r\n".encode() + body
+    )
+    await writer.drain()
+
+    status = await asyncio.wait_for(reader.readline(), timeout)
+    if not status:
+        raise http.client.RemoteDisconnected("connection closed without response")
+    code = int(status.split()[1])
+    headers = {}
+    while True:
+        line = await asyncio.wait_for(reader.readline(), timeout)
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode().partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    wait = timeout
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        while True:
+            size = int((await asyncio.wait_for(reader.readline(), wait)).split(b";")[0], 16)
+            if size == 0:
+                await reader.readline()
+                break
+            piece = await asyncio.wait_for(reader.readexactly(size + 2), wait)
+            if code != 200:
+                raise http.client.HTTPException(f"{code}: {piece[:-2].decode()}")
+            yield piece[:-2]
+            wait = idle
+    else:
+        piece = await asyncio.wait_for(reader.readexactly(int(headers.get("content-length", 0))), timeout)
+        if code != 200:
+            raise http.client.HTTPException(f"{code}: {piece.decode()}")
+        yield piece
+    yield headers
+
+async def acall(data, rawlogfile=None, context="llm", timeout=300, endpoint=None):
+    # Async counterpart of call()
+    body = json.dumps(data)
+    if rawlogfile:
+        log(rawlogfile, f"Request for {context}:\n{body}", "control")
+
+    p = apool(endpoint)
+    t0 = time.time()
+    answer = None
+    for attempt in (0, 1):
+        writer = None
+        reused = reuse = False
+        try:
+            # Connection errors are failed requests too, as in call()
+            reader, writer, reused = await p.acquire(timeout)
+            pieces = []
+            async for piece in aexchange(reader, writer, endpoint or llmUrl, "/api/generate", body.encode(), timeout):
+                pieces.append(piece)
+            headers = pieces.pop()
+            reuse = headers.get("connection", "").lower() != "close"
+            answerserial = b"".join(pieces).decode()
+            answer = json.loads(answerserial)
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError, asyncio.IncompleteReadError) as e:
+            answerserial = f"{type(e).__name__}: {e}"
+            if reused and attempt == 0:
+                continue
+        except Exception as e:
+            answerserial = f"{type(e).__name__}: {e}"
+        finally:
+            if writer is not None:
+                p.release(reader, writer, reuse)
+        break
+    tm = time.time() - t0
+
+    if rawlogfile:
+        log(rawlogfile, f"Raw response ({tm:.2f} s)\n{answerserial}", context)
+
+    return answer
+
+async def astream(data, schema=None, rawlogfile=None, context="llm", timeout=300, endpoint=None, idle=None):
+    # Async counterpart of stream()
+    idle = idle or idleTimeout
+    data = dict(data, stream=True)
+    body = json.dumps(data)
+    if rawlogfile:
+        log(rawlogfile, f"Request for {context} (stream):\n{body}", "control")
+
+    p = apool(endpoint)
+    parser = JSONStream(schema, maxField)
+    chunks = []
+    last = {}
+    pending = b""
+    reuse = False
+    error = None
+    t0 = time.time()
+
+    writer = None
+    try:
+        reader, writer, reused = await p.acquire(timeout)
+        async for piece in aexchange(reader, writer, endpoint or llmUrl, "/api/generate", body.encode(), timeout, idle):
+            if isinstance(piece, dict):
+                reuse = piece.get("connection", "").lower() != "close"
+                break
+            pending += piece
+            *lines, pending = pending.split(b"\n")
+            for line in lines:
+                if not line.strip():
+                    continue
+                last = json.loads(line)
+                if "error" in last:
+                    raise http.client.HTTPException(last["error"])
+                token = last.get("response", "")
+                if token:
+                    chunks.append(token)
+                    parser.feed(token)
+                if last.get("done"):
+                    parser.finish()
+        if not last.get("done"):
+            raise StreamError("stream closed before done")
+    except asyncio.TimeoutError:
+        error = f"no token received for {idle if chunks else timeout} s"
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    finally:
+        if writer is not None:
+            p.release(reader, writer, reuse and not error)
+    tm = time.time() - t0
+
+    text = "".join(chunks)
+    if error:
+        if rawlogfile:
+            log(rawlogfile, f"Stream aborted after {tm:.2f} s and {len(text)} characters: {error}\n{text}", context)
+        return None
+
+    answer = dict(last)
+    answer["response"] = text
+    if rawlogfile:
+        log(rawlogfile, f"Raw response ({tm:.2f} s, streamed)\n{json.dumps(answer)}", context)
+    return answer
+
+async def arequest(data, schema=None, rawlogfile=None, context="llm", timeout=300, endpoint=None, stage=None):
+    # Async counterpart of request()
+    answer = llmcache.get(stage, data, rawlogfile)
+    if answer:
+        return answer
+
+    if streaming and schema is not None:
+        answer = await astream(data, schema, rawlogfile, context, timeout, endpoint)
+    else:
+        answer = await acall(data, rawlogfile, context, timeout, endpoint)
+
+    if answer and (not data.get("format") or extractanswer(answer) is not None):
+        llmcache.put(stage, data, answer, rawlogfile)
+    return answer
+
+def response(answer):
+    # The model output carried in the "response" field of an Ollama answer
+    if isinstance(answer, str):
+        try:
+            answer = json.loads(answer)
+        except ValueError:
+            return None
+    if not isinstance(answer, dict):
+        return None
+    return answer.get("response")
+
+def extractanswer(answer):
+    # Structured output requested through "format" is a JSON document
+    responseserial = response(answer)
+    if not responseserial:
+        return None
+    try:
+        return json.loads(responseserial)
+    except ValueError:
+        return None
+
+if __name__ == "__main__":
+    model = os.getenv("MODEL", "gemma3:27b")
+    data = {
+        "model": model,
+        "prompt": "Reply with a JSON object with key 'ok' set to true",
+        "stream": False,
+        "think": False,
+        "format": "json"
+    }
+    for i in range(3):
+        t0 = time.time()
+        print(extractanswer(call(data)), f"{time.time() - t0:.2f} s")
@@ -0,0 +1,139 @@
+# KubeVibe
+# Persistent content-addressed cache of LLM answers
+
+import os
+import json
+import fcntl
+import hashlib
+import tempfile
+import threading
+from log import log
+
+# LLM_CACHE selects the stages that read and write the cache, e.g.
+# "generate,fix" or "all". Empty disables it.
+STAGES = ("generate", "fix", "curate", "judge")
+
+cacheDir = os.path.expanduser(os.getenv("LLM_CACHE_DIR", "~/.cache/kubevibe/llm"))
+maxBytes = int(float(os.getenv("LLM_CACHE_MAX_MB", "512")) * 1024 * 1024)
+
+def enabled_stages(value=None):
+    value = os.getenv("LLM_CACHE", "") if value is None else value
+    names = {s.strip() for s in value.split(",") if s.strip()}
+    if "all" in names:
+        return set(STAGES)
+    return names & set(STAGES)
+
+enabled = enabled_stages()
+
+counters = {s: {"hit": 0, "miss": 0, "store": 0} for s in STAGES}
+_lock = threading.Lock()
+_size = None
+
+def key(data):
+    # Only fields that change the model output take part in the key
+    material = {
+        "model": data.get("model"),
+        "prompt": data.get("prompt"),
+        "system": data.get("system"),
+        "format": data.get("format"),
+        "options": data.get("options"),
+        "think": data.get("think")
+    }
+    return hashlib.sha256(json.dumps(material, sort_keys=True).encode()).hexdigest()
+
+def path(k):
+    return os.path.join(cacheDir, k[:2], f"{k}.json")
+
+def count(stage, event, rawlogfile, k):
+    with _lock:
+        counters[stage][event] += 1
+        c = dict(counters[stage])
+    if rawlogfile:
+        log(rawlogfile, f"{stage} {event} {k[:16]} (hits {c['hit']}, misses {c['miss']}, stored {c['store']})", "llm-cache")
+
+def get(stage, data, rawlogfile=None):
+    if stage not in enabled:
+        return None
+    k = key(data)
+    try:
+        with open(path(k)) as f:
+            answer = json.load(f)
+        os.utime(path(k))  # recency for LRU eviction
+    except (OSError, ValueError):
+        count(stage, "miss", rawlogfile, k)
+        return None
+    count(stage, "hit", rawlogfile, k)
+    return answer
+
+def put(stage, data, answer, rawlogfile=None):
+    global _size
+    if stage not in enabled or not answer:
+        return
+    k = key(data)
+    entry = json.dumps(answer).encode()
+    target = path(k)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+
+    # Write-then-rename so concurrent readers never see a partial entry
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(target), suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        f.write(entry)
+    os.replace(tmp, target)
+    count(stage, "store", rawlogfile, k)
+
+    with _lock:
+        if _size is None:
+            _size = usage()
+        _size += len(entry)
+        over = _size > maxBytes
+    if over:
+        evict(rawlogfile)
+
+def entries():
+    found = []
+    for root, dirs, files in os.walk(cacheDir):
+        for name in files:
+            if name.endswith(".json"):
+                p = os.path.join(root, name)
+                try:
+                    st = os.stat(p)
+                except OSError:
+                    continue
+                found.append((st.st_mtime, st.st_size, p))
+    return found
+
+def usage():
+    return sum(size for _, size, _ in entries())
+
+def evict(rawlogfile=None, target=None):
+    # Drops least recently used entries until the cache is below 90% of
+    # maxBytes. A lock file serializes eviction between processes.
+    global _size
+    target = int(maxBytes * 0.9) if target is None else target
+    os.makedirs(cacheDir, exist_ok=True)
+    with open(os.path.join(cacheDir, ".lock"), "w") as lockf:
+        fcntl.flock(lockf, fcntl.LOCK_EX)
+        found = sorted(entries())
+        total = sum(size for _, size, _ in found)
+        removed = 0
+        for mtime, size, p in found:
+            if total <= target:
+                break
+            try:
+                os.remove(p)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+    with _lock:
+        _size = total
+    if rawlogfile and removed:
+        log(rawlogfile, f"Evicted {removed} entries, {total} bytes in use", "llm-cache")
+
+def stats():
+    with _lock:
+        return {s: dict(c) for s, c in counters.items() if s in enabled}
+
+if __name__ == "__main__":
+    found = entries()
+    print(f"{cacheDir}: {len(found)} entries, {sum(s for _, s, _ in found)} bytes (max {maxBytes})")
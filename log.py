@@ -1,15 +1,165 @@
+# KubeVibe
+# Run logs
+#
+# Each log file has one writer per process: the file stays open, records
+# are buffered and flushed every LOG_FLUSH seconds (and when a run ends or
+# the process exits), and a lock lets the threads and runs of one process
+# share it. With LOG_FORMAT=jsonl (default) every record is a JSON line
+#   {"ts": "2025-01-01 12:00:00.000000", "stage": "BUILD", "type": "build",
+#    "context": "build:cache", "size": 1234, "text": "..."}
+# and the state D is logged as a delta (delta.py) against the previous
+# record of it instead of a full dump. LOG_FORMAT=text writes the old
+# "--Log: <date> --<context>--" text. render() turns a JSONL log back into
+# that text, with every state rebuilt in full:
+#
+#   python3 log.py kubevibe.rawlog > kubevibe.txt
+
+import os
+import json
+import time
+import atexit
 import datetime
+import threading
+import delta
+
+logFormat = os.getenv("LOG_FORMAT", "jsonl")
+flushEvery = float(os.getenv("LOG_FLUSH", "1"))
+bufferSize = int(os.getenv("LOG_BUFFER", str(256 * 1024)))
+
+_writers = {}
+_lock = threading.Lock()
+_flusher = None
+
+class Writer:
+
+    def __init__(self, path, truncate=False):
+        self.path = path
+        self.f = open(path, "w" if truncate else "a", buffering=bufferSize)
+        self.lock = threading.Lock()
+        self.stage = None
+        self.state = None
+
+    def write(self, text):
+        with self.lock:
+            if self.f.closed:
+                # Late record of a run that was closed
+                with open(self.path, "a") as f:
+                    f.write(text)
+            else:
+                self.f.write(text)
+
+    def record(self, context, text=None, datet=None, **fields):
+        rec = {"ts": str(datet or datetime.datetime.now()), "stage": self.stage, "type": context.split(":")[0],
+               "context": context}
+        if text is not None:
+            rec["size"] = len(text)
+            rec["text"] = text
+        rec.update(fields)
+        self.write(json.dumps(rec) + "\n")
+
+    def flush(self):
+        with self.lock:
+            if not self.f.closed:
+                self.f.flush()
+
+    def close(self):
+        with self.lock:
+            self.f.close()
+
+def _flush_loop():
+    while True:
+        time.sleep(flushEvery)
+        flush()
+
+def writer(path, truncate=False):
+    global _flusher
+    key = os.path.abspath(path)
+    with _lock:
+        w = _writers.get(key)
+        if w is None or truncate:
+            if w is not None:
+                w.close()
+            w = _writers[key] = Writer(path, truncate)
+        if _flusher is None:
+            _flusher = threading.Thread(target=_flush_loop, daemon=True)
+            _flusher.start()
+    return w
+
+def start(rawlogfile):
+    # New, empty log for a run
+    writer(rawlogfile, truncate=True)
+
+def flush():
+    with _lock:
+        writers = list(_writers.values())
+    for w in writers:
+        w.flush()
+
+def close(rawlogfile):
+    # End of a run: flush and release the file
+    with _lock:
+        w = _writers.pop(os.path.abspath(rawlogfile), None)
+    if w is not None:
+        w.close()
+
+def _forked():
+    # Worker processes (batch.py) open their own files and flusher
+    global _writers, _lock, _flusher
+    _writers, _lock, _flusher = {}, threading.Lock(), None
+
+atexit.register(flush)
+# Nothing buffered may be copied into a child, it would be written twice
+os.register_at_fork(before=flush, after_in_child=_forked)
+
+def text_record(context, text, datet=None):
+    return f"--Log: {datet or datetime.datetime.now()} --{context}--\n{text}\n"
 
 def log(rawlogfile, log, context="default", datet = None):
-    f = open(rawlogfile, "a")
-    if datet:
-        print(f"--Log: {datet} --{context}--", file=f)
+    if logFormat == "text":
+        writer(rawlogfile).write(text_record(context, log, datet))
     else:
-        print(f"--Log: {datetime.datetime.now()} --{context}--", file=f)
-    print(log,file=f)
-    f.close()
+        writer(rawlogfile).record(context, str(log), datet)
+
+def phase(rawlogfile, stage):
+    # Start of an FSM stage: later records carry it
+    w = writer(rawlogfile)
+    w.stage = stage
+    log(rawlogfile, stage, "phase")
+
+def state(rawlogfile, D):
+    # The state D, as a delta against the last one logged
+    if logFormat == "text":
+        log(rawlogfile, json.dumps(D, indent=4), "D")
+        return
+    w = writer(rawlogfile)
+    current = json.loads(json.dumps(D))
+    ops = delta.delta(w.state, current) if w.state is not None else [["set", [], current]]
+    w.state = current
+    w.record("D", None, None, type="state", size=len(json.dumps(ops)), delta=ops)
 
 def inlog(log, context="default"):
     temp_str = f"--Internal: {datetime.datetime.now()} --{context}--"
     temp_str += f"\n{log}"
-    return temp_str
\ No newline at end of file
+    return temp_str
+
+def render(lines):
+    # Legacy text of a log, JSONL records or text lines as they come
+    D = None
+    for line in lines:
+        try:
+            rec = json.loads(line) if line.startswith("{") else None
+        except ValueError:
+            rec = None
+        if not isinstance(rec, dict) or "context" not in rec:
+            yield line
+        elif "delta" in rec:
+            D = delta.apply(D, rec["delta"])
+            yield text_record(rec["context"], json.dumps(D, indent=4), rec["ts"])
+        else:
+            yield text_record(rec["context"], rec.get("text", ""), rec["ts"])
+
+if __name__ == "__main__":
+    import sys
+    f = open(sys.argv[1]) if len(sys.argv) > 1 else sys.stdin
+    for text in render(f):
+        sys.stdout.write(text)
@@ -0,0 +1,181 @@
+# KubeVibe
+# Warm namespace pool for DEPLOY and CONNECT
+#
+# With NS_POOL=1 stages lease a namespace that already exists (service
+# account and token provisioned) instead of creating one. Objects created in
+# it carry the managed label; on release they are deleted by selector in the
+# background and the namespace goes back to the pool once it is empty. The
+# pool keeps as many namespaces as the highest number of leases seen at the
+# same time (at least NS_POOL_MIN), so a batch of N concurrent runs warms up
+# to N after its first round.
+
+import os
+import time
+import socket
+import datetime
+import threading
+import multiprocessing.util
+import kube
+from ctl import printcol
+
+enabled = bool(int(os.getenv("NS_POOL", "0")))
+minSize = int(os.getenv("NS_POOL_MIN", "1"))
+wipeTimeout = float(os.getenv("NS_POOL_WIPE_TIMEOUT", "60"))
+
+POOL_LABEL = "kubevibe/pool"
+OBJECT_SELECTOR = f"{kube.MANAGED_LABEL}=true"
+
+class NamespacePool:
+
+    def __init__(self, minsize=1, interval=1.0):
+        self.minsize = minsize
+        self.interval = interval
+        self.cond = threading.Condition()
+        self.pid = None
+
+    def start(self):
+        # Called under cond. State and threads belong to one process.
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.poolid = kube.run_id()
+        self.count = 0
+        self.idle = []
+        self.leased = set()
+        self.busy = 0     # being created or wiped
+        self.peak = 0
+        self.names = set()
+        self.stats = {"leases": 0, "warm": 0, "cold": 0, "returned": 0, "dropped": 0, "stale": 0}
+        threading.Thread(target=self.warm, daemon=True).start()
+        # Runs at exit in this process, batch workers included (atexit
+        # handlers do not run in pool workers)
+        multiprocessing.util.Finalize(self, self.close, exitpriority=10)
+
+    def owns(self, ns):
+        return self.pid == os.getpid() and ns.startswith(f"vibe-pool-{self.poolid}-")
+
+    def create(self):
+        with self.cond:
+            self.count += 1
+            name = f"vibe-pool-{self.poolid}-{self.count}"
+        labels = {kube.MANAGED_LABEL: "true", POOL_LABEL: self.poolid}
+        annotations = {
+            "kubevibe/host": socket.gethostname(),
+            "kubevibe/pid": str(os.getpid()),
+            "kubevibe/created": datetime.datetime.now(datetime.timezone.utc).isoformat()
+        }
+        rc, out = kube.create_namespace(name, labels, annotations)
+        if rc != 0:
+            return None
+        with self.cond:
+            self.names.add(name)
+        return name
+
+    def lease(self):
+        with self.cond:
+            self.start()
+            self.stats["leases"] += 1
+        while True:
+            with self.cond:
+                ns = self.idle.pop() if self.idle else None
+                self.busy += 1
+            if ns is None or kube.namespace_active(ns):
+                break
+            # Deleted or Terminating behind the pool's back: forget it
+            printcol("yellow", f"namespace {ns} is gone or terminating, dropped from the pool")
+            with self.cond:
+                self.busy -= 1
+                self.names.discard(ns)
+                self.stats["stale"] += 1
+        with self.cond:
+            self.stats["warm" if ns else "cold"] += 1
+            if ns is not None:
+                self.busy -= 1
+        if ns is None:
+            # Pool empty: create one now, the warmer sizes up from the new peak
+            ns = self.create()
+            with self.cond:
+                self.busy -= 1
+        if ns is None:
+            return None
+        with self.cond:
+            self.leased.add(ns)
+            self.peak = max(self.peak, len(self.leased))
+            self.cond.notify_all()
+        return ns
+
+    def release(self, ns):
+        with self.cond:
+            self.leased.discard(ns)
+            self.busy += 1
+        threading.Thread(target=self.wipe, args=(ns,), daemon=True).start()
+
+    def wipe(self, ns):
+        kube.wipe_namespace(ns, OBJECT_SELECTOR)
+        deadline = time.time() + wipeTimeout
+        clean = kube.namespace_empty(ns, OBJECT_SELECTOR)
+        while not clean and time.time() < deadline:
+            time.sleep(0.5)
+            clean = kube.namespace_empty(ns, OBJECT_SELECTOR)
+        with self.cond:
+            self.busy -= 1
+            if clean:
+                self.idle.append(ns)
+                self.stats["returned"] += 1
+            else:
+                self.names.discard(ns)
+                self.stats["dropped"] += 1
+            self.cond.notify_all()
+        if not clean:
+            # Something would not go away, the reaper takes the whole namespace
+            printcol("yellow", f"namespace {ns} not empty after {wipeTimeout:g} s, dropped from the pool")
+            kube.release_namespace(ns)
+
+    def warm(self):
+        # Keeps the pool at max(minsize, peak) namespaces
+        while True:
+            with self.cond:
+                self.cond.wait(self.interval)
+                missing = max(self.minsize, self.peak) - (len(self.idle) + len(self.leased) + self.busy)
+                self.busy += max(missing, 0)
+            for i in range(max(missing, 0)):
+                ns = self.create()
+                with self.cond:
+                    self.busy -= 1
+                    if ns:
+                        self.idle.append(ns)
+                        self.cond.notify_all()
+
+    def close(self):
+        # Deletes every namespace of the pool in one go (no new threads
+        # this late in the life of the process)
+        if self.pid != os.getpid():
+            return
+        with self.cond:
+            names, self.names, self.idle = self.names, set(), []
+        if names:
+            kube.delete_namespaces(sorted(names))
+
+pool = NamespacePool(minSize)
+
+def warmup():
+    # Starts filling the pool ahead of the first lease
+    if enabled:
+        with pool.cond:
+            pool.start()
+
+def acquire(ns, labels=None, annotations=None):
+    # Returns (returncode, output, namespace actually used)
+    if not enabled:
+        rc, out = kube.create_namespace(ns, labels, annotations)
+        return rc, out, ns
+    leased = pool.lease()
+    if leased is None:
+        return 1, "error: could not create a namespace for the pool\n", ns
+    return 0, f"namespace/{leased} leased from the pool\n", leased
+
+def release(ns):
+    if enabled and pool.owns(ns):
+        pool.release(ns)
+        return 0, f'namespace "{ns}" returned to the pool\n'
+    return kube.release_namespace(ns)
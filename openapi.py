@@ -0,0 +1,232 @@
+# KubeVibe
+# Offline manifest validation against cached Kubernetes OpenAPI schemas
+#
+# VALIDATE checks vibe.yaml in process instead of running kubectl
+# --dry-run=client: no cluster, no process per check. Schemas are read once
+# per process from K8S_SCHEMA_DIR (every *.json there: swagger.json from
+# /openapi/v2, the /openapi/v3 group documents, or JSON-Schema exports with
+# $defs). Errors come back as dicts addressed by document and field path,
+# e.g. spec.template.spec.containers[0].ports[0].containerPort.
+#
+#   python3 openapi.py fetch       caches the schemas (cluster, else GitHub)
+#   python3 openapi.py vibe.yaml   validates a manifest
+
+import os
+import sys
+import glob
+import json
+import urllib.request
+import yaml
+
+k8sVersion = os.getenv("K8S_VERSION", "1.30")
+schemaDir = os.getenv("K8S_SCHEMA_DIR", os.path.expanduser(f"~/.cache/kubevibe/openapi/v{k8sVersion}"))
+schemaUrl = os.getenv("K8S_OPENAPI_URL", f"https://raw.githubusercontent.com/kubernetes/kubernetes/release-{k8sVersion}/api/openapi-spec/swagger.json")
+
+Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# Definitions that take a string or a number whatever the schema version says
+INT_OR_STRING = ("io.k8s.apimachinery.pkg.util.intstr.IntOrString", "io.k8s.apimachinery.pkg.api.resource.Quantity")
+
+TYPES = {bool: "boolean", int: "integer", float: "number", str: "string", list: "array", dict: "object", type(None): "null"}
+
+def type_name(value):
+    return TYPES.get(type(value), type(value).__name__)
+
+def type_ok(value, expected):
+    t = type_name(value)
+    return t == expected or (expected == "number" and t == "integer")
+
+class Schemas:
+
+    def __init__(self, defs):
+        self.defs = defs
+        self.kinds = {}   # (apiVersion, kind) -> definition name
+        for name, schema in defs.items():
+            for gvk in schema.get("x-kubernetes-group-version-kind", []):
+                apiVersion = f"{gvk['group']}/{gvk['version']}" if gvk.get("group") else gvk["version"]
+                self.kinds[(apiVersion, gvk["kind"])] = name
+
+    def check(self, schema, value, path, errors):
+        # Appends (path, message) for everything wrong in value
+        if value is None:
+            return
+        ref = schema.get("$ref")
+        if ref:
+            name = ref.rsplit("/", 1)[-1]
+            if name in INT_OR_STRING:
+                if type_name(value) not in ("string", "integer", "number"):
+                    errors.append((path, f'invalid type: got "{type_name(value)}", expected "string" or "integer"'))
+                return
+            schema = self.defs.get(name)
+            if schema is None:
+                return
+        if schema.get("x-kubernetes-int-or-string") or schema.get("format") == "int-or-string":
+            if type_name(value) not in ("string", "integer"):
+                errors.append((path, f'invalid type: got "{type_name(value)}", expected "string" or "integer"'))
+            return
+        for sub in schema.get("allOf", []):
+            self.check(sub, value, path, errors)
+        alternatives = schema.get("oneOf") or schema.get("anyOf")
+        if alternatives:
+            tried = []
+            for sub in alternatives:
+                sube = []
+                self.check(sub, value, path, sube)
+                if not sube:
+                    break
+                tried.append(sube)
+            else:
+                errors.extend(min(tried, key=len))
+            return
+
+        expected = schema.get("type")
+        if expected:
+            expected = [t for t in (expected if isinstance(expected, list) else [expected]) if t != "null"]
+            if expected and not any(type_ok(value, t) for t in expected):
+                errors.append((path, f'invalid type: got "{type_name(value)}", expected "{" or ".join(expected)}"'))
+                return
+        if "enum" in schema and value not in schema["enum"]:
+            errors.append((path, f"unsupported value {json.dumps(value)}, expected one of {json.dumps(schema['enum'])}"))
+
+        if isinstance(value, dict):
+            self.check_object(schema, value, path, errors)
+        elif isinstance(value, list) and "items" in schema:
+            for i, item in enumerate(value):
+                self.check(schema["items"], item, f"{path}[{i}]", errors)
+
+    def check_object(self, schema, value, path, errors):
+        props = schema.get("properties")
+        extra = schema.get("additionalProperties")
+        for key in schema.get("required", []):
+            if value.get(key) is None:
+                errors.append((join(path, key), "missing required field"))
+        if props is None and not isinstance(extra, dict):
+            # Free-form object (RawExtension, preserve-unknown-fields)
+            return
+        for key, v in value.items():
+            if props and key in props:
+                self.check(props[key], v, join(path, key), errors)
+            elif isinstance(extra, dict):
+                self.check(extra, v, join(path, key), errors)
+            elif not extra and not schema.get("x-kubernetes-preserve-unknown-fields"):
+                errors.append((join(path, key), "unknown field"))
+
+    def validate_doc(self, doc):
+        # [(path, message)] for one manifest document
+        if not isinstance(doc, dict):
+            return [("", f'invalid type: got "{type_name(doc)}", expected "object"')]
+        errors = []
+        apiVersion, kind = doc.get("apiVersion"), doc.get("kind")
+        if not apiVersion or not kind:
+            for key in ("apiVersion", "kind"):
+                if not doc.get(key):
+                    errors.append((key, "missing required field"))
+            return errors
+        name = self.kinds.get((apiVersion, kind))
+        if name is None:
+            return [("", f'no matches for kind "{kind}" in version "{apiVersion}"')]
+        meta = doc.get("metadata")
+        if not isinstance(meta, dict) or not (meta.get("name") or meta.get("generateName")):
+            errors.append(("metadata.name", "missing required field"))
+        self.check(self.defs[name], doc, "", errors)
+        return errors
+
+def join(path, key):
+    return f"{path}.{key}" if path else key
+
+def load(directory=None):
+    # Merges the definitions of every schema document in the directory
+    defs = {}
+    for fname in sorted(glob.glob(os.path.join(directory or schemaDir, "*.json"))):
+        f = open(fname)
+        try:
+            doc = json.load(f)
+        except ValueError:
+            continue
+        finally:
+            f.close()
+        if not isinstance(doc, dict):
+            continue
+        for section in (doc.get("definitions"), doc.get("components", {}).get("schemas"), doc.get("$defs")):
+            if isinstance(section, dict):
+                defs.update(section)
+    return Schemas(defs)
+
+_schemas = None
+
+def schemas():
+    global _schemas
+    if _schemas is None:
+        _schemas = load()
+    return _schemas
+
+def available():
+    return bool(glob.glob(os.path.join(schemaDir, "*.json")))
+
+def validate_text(text, source="vibe.yaml"):
+    # Returns a list of {doc, kind, name, path, error}; doc counts from 1
+    try:
+        docs = list(yaml.load_all(text, Loader=Loader))
+    except yaml.YAMLError as e:
+        mark = getattr(e, "problem_mark", None)
+        where = f"line {mark.line + 1}, column {mark.column + 1}" if mark else ""
+        return [{"doc": None, "kind": None, "name": None, "path": where, "error": f"invalid YAML: {getattr(e, 'problem', None) or e}"}]
+    return validate_docs(docs, source)
+
+def validate_docs(docs, source="vibe.yaml"):
+    # Same for already parsed documents (parsing costs more than checking)
+    s = schemas()
+    errors = []
+    for i, doc in enumerate(docs):
+        if doc is None:
+            continue
+        kind = doc.get("kind") if isinstance(doc, dict) else None
+        meta = doc.get("metadata") if isinstance(doc, dict) else None
+        name = meta.get("name") if isinstance(meta, dict) else None
+        for path, error in s.validate_doc(doc):
+            errors.append({"doc": i + 1, "kind": kind, "name": name, "path": path, "error": error})
+    if not any(d is not None for d in docs):
+        errors.append({"doc": None, "kind": None, "name": None, "path": "", "error": f"no objects passed to create in {source}"})
+    return errors
+
+def validate_file(path):
+    f = open(path)
+    text = f.read()
+    f.close()
+    return validate_text(text, os.path.basename(path))
+
+def report(errors, source="vibe.yaml"):
+    # kubectl-like text, one line per error
+    lines = []
+    for e in errors:
+        where = f"{e['kind'] or 'document'}/{e['name'] or '?'} (document {e['doc']})" if e["doc"] else source
+        lines.append(f"error validating {where}: {e['path'] or '<root>'}: {e['error']}")
+    return "\n".join(lines) + "\n" if lines else f"{source} valid ({k8sVersion} schemas)\n"
+
+def fetch(directory=None):
+    # Cluster first (/openapi/v2 through the API client), GitHub otherwise
+    directory = directory or schemaDir
+    os.makedirs(directory, exist_ok=True)
+    data = None
+    try:
+        import kapi
+        data = json.dumps(kapi.from_config().request("GET", "/openapi/v2")).encode()
+        source = "cluster"
+    except Exception as e:
+        print(f"cluster schemas unavailable ({e}), downloading {schemaUrl}")
+    if data is None:
+        data = urllib.request.urlopen(schemaUrl, timeout=60).read()
+        source = schemaUrl
+    path = os.path.join(directory, "swagger.json")
+    f = open(path, "wb")
+    f.write(data)
+    f.close()
+    return path, source
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["fetch"]:
+        path, source = fetch()
+        print(f"{path} from {source}, {len(load().kinds)} kinds")
+    else:
+        for fname in sys.argv[1:]:
+            print(report(validate_file(fname), fname), end="")
@@ -39,4 +39,34 @@ def fix_schema():
             }
         },
         "required": ["explanation", "vibe.yaml", "Dockerfile", "requirements.txt", "myapp.py"]
+    }
+
+def fix_patch_schema():
+    return {
+        "type": "object",
+        "properties": {
+            "explanation": {
+                "type": "string"
+            },
+            "edits": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "file": {
+                            "type": "string",
+                            "enum": ["myapp.py", "Dockerfile", "vibe.yaml", "requirements.txt"]
+                        },
+                        "search": {
+                            "type": "string"
+                        },
+                        "replace": {
+                            "type": "string"
+                        }
+                    },
+                    "required": ["file", "search", "replace"]
+                }
+            }
+        },
+        "required": ["explanation", "edits"]
     }
\ No newline at end of file
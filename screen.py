@@ -0,0 +1,71 @@
+# KubeVibe
+# Pre-screening of FIX candidates
+#
+# FIX asks for several candidates at once (fix.py). Before one of them
+# costs a BUILD-VALIDATE-DEPLOY-CONNECT cycle, each is screened here in a
+# few milliseconds: myapp.py compiled, vibe.yaml parsed and validated
+# offline (openapi.py, when schemas are cached) and the artifacts checked
+# for consistency (check.py). Candidates are ranked by problems found,
+# then by the size of their change: the smallest clean fix goes first.
+
+import yaml
+from check import check
+import openapi
+
+ARTIFACTS = ("code", "container", "manifest", "requirements")
+
+def screen(artifacts):
+    # Problems of a set of artifacts ({"code": ..., ...}), as short strings
+    node = {key: {"content": artifacts[key]} for key in ARTIFACTS}
+    ok, issues, out = check({"node": node})
+    problems = [f"{', '.join(i['artifacts'])}: {i['error']}" for i in issues]
+    # Errors only the compiler sees (return outside a function...)
+    if not any(i["error"].startswith("syntax error") for i in issues):
+        try:
+            compile(artifacts["code"] or "", "myapp.py", "exec")
+        except (SyntaxError, ValueError) as e:
+            problems.append(f"myapp.py: {type(e).__name__}: {e}")
+    if openapi.available():
+        try:
+            docs = list(yaml.load_all(artifacts["manifest"] or "", Loader=openapi.Loader))
+            problems += [f"vibe.yaml: {e['path'] or '<root>'}: {e['error']}" for e in openapi.validate_docs(docs)]
+        except yaml.YAMLError:
+            pass  # check reports it
+    return problems
+
+def change_size(base, artifacts):
+    return sum(abs(len(artifacts[key] or "") - len(base[key] or "")) + (artifacts[key] != base[key])
+               for key in ARTIFACTS)
+
+def rank(base, candidates):
+    # [(artifacts, problems)] best first; candidates changing nothing last
+    scored = []
+    seen = set()
+    for artifacts in candidates:
+        sig = tuple(artifacts[key] for key in ARTIFACTS)
+        if sig in seen:
+            continue
+        seen.add(sig)
+        problems = screen(artifacts)
+        noop = all(artifacts[key] == base[key] for key in ARTIFACTS)
+        scored.append((noop, len(problems), change_size(base, artifacts), artifacts, problems))
+    scored.sort(key=lambda s: s[:3])
+    return [(s[3], s[4]) for s in scored]
+
+def report(ranked):
+    lines = []
+    for i, (artifacts, problems) in enumerate(ranked):
+        lines.append(f"candidate {i + 1}: " + ("clean" if not problems else f"{len(problems)} problem(s)"))
+        lines += [f"  {p}" for p in problems[:5]]
+    return "\n".join(lines) + "\n"
+
+if __name__ == "__main__":
+    base = {
+        "code": "from flask import Flask\napp = Flask(__name__)\napp.run(host='0.0.0.0', port=5000)\n",
+        "container": "FROM python:3.11-slim\nCOPY myapp.py .\nCOPY requirements.txt .\nRUN pip install -r requirements.txt\nEXPOSE 5001\nCMD [\"python\", \"myapp.py\"]\n",
+        "manifest": "apiVersion: v1\nkind: Service\nmetadata:\n  name: web\nspec:\n  selector:\n    app: web\n  ports:\n  - port: 80\n    targetPort: 5000\n",
+        "requirements": "flask\n"
+    }
+    good = dict(base, container=base["container"].replace("5001", "5000"))
+    broken = dict(good, code=base["code"] + "def (:\n")
+    print(report(rank(base, [broken, base, good])), end="")
@@ -3,7 +3,15 @@
 
 import subprocess
 import os
-from log import log
+from log import log, inlog
+import openapi
+
+# auto: in-process against the cached schemas when there are any, kubectl
+# dry-run otherwise; openapi or kubectl force one of them
+engine = os.getenv("VALIDATE_ENGINE", "auto")
+
+def use_openapi():
+    return engine == "openapi" or (engine == "auto" and openapi.available())
 
 # D it assumes the structure:
 # D = {
@@ -26,18 +34,28 @@ from log import log
 #     }
 
 def validate(D):
+    # Returns (success, errors, logs); errors are openapi.validate_text
+    # dicts, empty with the kubectl engine
     success = False
     outputfolder = D["outputfolder"]
     logfile = D["logfile"]
     rawlogfile = os.path.join(outputfolder, logfile)
     vibe = D["node"]["manifest"]["file"]
     vibefile = os.path.join(outputfolder, vibe)
-    p = subprocess.run(f"kubectl create --dry-run=client -f {vibefile}", shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    log(rawlogfile, p.stdout.decode(), "validate")
-    if p.returncode == 0:
+    errors = []
+    if use_openapi():
+        errors = openapi.validate_file(vibefile)
+        out = openapi.report(errors, vibe)
+        rc = 1 if errors else 0
+    else:
+        p = subprocess.run(f"kubectl create --dry-run=client -f {vibefile}", shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        out = p.stdout.decode()
+        rc = p.returncode
+    log(rawlogfile, out, "validate")
+    if rc == 0:
         success = True
     
-    return success
+    return success, errors, inlog(out, "validate")
 
 if __name__ == "__main__":
     
@@ -73,8 +91,9 @@ if __name__ == "__main__":
     }
 
     print("validating...")
-    ok = validate(D)
+    ok, errors, logs = validate(D)
     if ok:
         print("valid")
     else:
-        print("not valid")
\ No newline at end of file
+        print("not valid")
+        print(logs)
\ No newline at end of file